@@ -0,0 +1,186 @@
+import argparse
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+
+import netstore
+import preprocessing as pp
+
+
+""" Accessibility evaluator for the assembled network.
+
+Loads the final node and arc files (or columnar stores, see netstore) into a
+CSR adjacency matrix and computes the travel times from every population
+center to every primary care facility with one batched Dijkstra run
+(scipy.sparse.csgraph). From those it computes the gravity accessibility
+metric of the social-transit-solver objective, with the parameters in
+preprocessing.obj_parameters, so a schedule can be pre-screened without the
+C++ solver. Run from the repository root:
+    python accessibility.py [Data/node_data.txt Data/arc_data.txt]
+
+Waiting times are not included here: boarding arcs cost their arc time,
+which is 0 in the files written by transit_processing. See waiting.py for
+frequency dependent boarding costs.
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+min_time = 1.0 # minutes, floor on travel times in the gravity metric
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def adjacency(n, tail, head, cost, positions=False):
+    """Builds an n x n CSR matrix of arc costs from node indices, keeping the
+    cheapest of parallel arcs. Zero cost arcs are kept as explicit zeros,
+    which csgraph treats as arcs.
+
+    With positions=True also returns, per arc, the index of its cost in the
+    matrix data (-1 for a parallel arc that was left out), so that costs can
+    be updated in place.
+    """
+    order = np.lexsort((cost, head, tail))
+    tail, head, cost = tail[order], head[order], cost[order]
+    first = np.ones(len(tail), dtype=bool)
+    first[1:] = (tail[1:] != tail[:-1]) | (head[1:] != head[:-1])
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tail[first], minlength=n), out=indptr[1:])
+    graph = sp.csr_matrix((cost[first].astype(np.float64), head[first], indptr),
+                          shape=(n, n))
+    if not positions:
+        return graph
+    position = np.full(len(order), -1, dtype=np.int64)
+    position[order[first]] = np.arange(first.sum())
+    return graph, position
+
+class Network:
+    """The assembled network as index arrays: arc tails, heads, types, lines
+    and times (by node index), and the node indices, populations and
+    weights of the population centers and facilities.
+    """
+
+    def __init__(self, node_file=pp.final_node_data, arc_file=pp.final_arc_data):
+        nodes = netstore.read_table(node_file)
+        arcs = netstore.read_table(arc_file)
+        ids = np.asarray(nodes['ID'])
+        order = np.argsort(ids, kind='stable')
+        self.node_ids = ids[order]
+        self.node_names = np.asarray(nodes['Name'])[order]
+        self.node_types = np.asarray(nodes['Type'])[order]
+        self.node_lines = np.asarray(nodes['Line'])[order]
+        values = np.asarray(nodes['Value'])[order]
+        self.n = len(ids)
+
+        self.arc_ids = np.asarray(arcs['ID'])
+        self.tail = self.index(arcs['Tail'])
+        self.head = self.index(arcs['Head'])
+        self.arc_types = np.asarray(arcs['Type'])
+        self.arc_lines = np.asarray(arcs['Line'])
+        self.times = np.asarray(arcs['Time'], dtype=np.float64)
+
+        self.pop = np.flatnonzero(self.node_types == pp.nid_pop)
+        self.fac = np.flatnonzero(self.node_types == pp.nid_fac)
+        self.populations = values[self.pop].astype(np.float64)
+        self.weights = values[self.fac].astype(np.float64)
+
+        # Paths may not pass through other population centers or through
+        # facilities, so arcs into population centers and out of facilities
+        # are left out of the search graph
+        self.usable = ((self.node_types[self.head] != pp.nid_pop) &
+                       (self.node_types[self.tail] != pp.nid_fac))
+
+    def index(self, ids):
+        """Converts node IDs to node indices."""
+        return np.searchsorted(self.node_ids, np.asarray(ids))
+
+    def graph(self, times=None, positions=False):
+        """CSR adjacency matrix of the search graph, with the arc times or
+        the given array of arc costs.
+
+        With positions=True also returns, per arc, the index of its cost in
+        the matrix data, or -1 if the arc is not in the search graph (see
+        adjacency).
+        """
+        cost = self.times if times is None else np.asarray(times, np.float64)
+        use = self.usable
+        result = adjacency(self.n, self.tail[use], self.head[use], cost[use],
+                           positions)
+        if not positions:
+            return result
+        position = np.full(len(cost), -1, dtype=np.int64)
+        position[use] = result[1]
+        return result[0], position
+
+    def travel_times(self, times=None, graph=None):
+        """Returns the (population centers x facilities) matrix of shortest
+        travel times (minutes, inf if unreachable), on a prebuilt search
+        graph if given.
+        """
+        if graph is None:
+            graph = self.graph(times)
+        dist = dijkstra(graph, directed=True, indices=self.pop)
+        return dist[:, self.fac]
+
+# -------------------------------------------------------------------------------------------------
+def gravity(times, populations, weights, falloff=pp.obj_parameters[1]):
+    """Gravity accessibility metric of every population center.
+
+    Facility j with weight S_j is reached from center i at time t_ij with
+    impedance f(t) = t^-falloff, taking t at least min_time. The demand on a
+    facility is V_j = sum_k P_k f(t_kj), and the accessibility of center i
+    is A_i = sum_j S_j f(t_ij) / V_j. Unreachable pairs contribute nothing.
+    """
+    impedance = np.maximum(times, min_time)**-falloff # inf -> 0
+    demand = populations @ impedance
+    share = np.divide(weights, demand, out=np.zeros_like(weights),
+                      where=demand > 0)
+    return impedance @ share
+
+def objective(access, lowest=pp.obj_parameters[0],
+              multiplier=pp.obj_parameters[2]):
+    """Objective value: the sum of the lowest accessibility metrics, scaled
+    by the multiplier.
+    """
+    lowest = min(int(lowest), len(access))
+    return multiplier*np.sort(access)[:lowest].sum()
+
+def evaluate(network, times=None, parameters=pp.obj_parameters, graph=None):
+    """Evaluates a network (optionally with other arc costs, or on a prebuilt
+    search graph). Returns the travel time matrix, the accessibility of every
+    population center and the objective value.
+    """
+    lowest, falloff, multiplier = parameters
+    travel = network.travel_times(times, graph)
+    access = gravity(travel, network.populations, network.weights, falloff)
+    return travel, access, objective(access, lowest, multiplier)
+
+def main():
+    parser = argparse.ArgumentParser(description="Computes the gravity "
+                                     "accessibility of the population centers.")
+    parser.add_argument("nodes", nargs="?", default=pp.final_node_data)
+    parser.add_argument("arcs", nargs="?", default=pp.final_arc_data)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    network = Network(args.nodes, args.arcs)
+    loaded = time.perf_counter()
+    travel, access, value = evaluate(network)
+    done = time.perf_counter()
+
+    print(f"{'center':<16}{'population':>11}{'nearest (min)':>14}"
+          f"{'accessibility':>15}")
+    nearest = travel.min(axis=1)
+    for i, node in enumerate(network.pop):
+        print(f"{network.node_names[node]:<16}{network.populations[i]:>11.0f}"
+              f"{nearest[i]:>14.2f}{access[i]:>15.6g}")
+    print("Objective: "+str(value))
+    print(f"Loaded in {loaded - start:.3f} s, evaluated in {done - loaded:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
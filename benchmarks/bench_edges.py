@@ -0,0 +1,60 @@
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import imaging
+from bench_imaging_graph import synthetic_network
+
+""" Draws synthetic bus line graphs of growing size with both edge renderers
+of imaging.teken_lijnen (one LineCollection, or one FancyArrowPatch per
+edge) and reports the time and peak Python memory per edge, including
+saving the figure as PNG. Run from the repository root:
+    python benchmarks/bench_edges.py [--max-patches 5000]
+"""
+
+
+def draw(G, randen):
+    fig = Figure(figsize=(8, 8), dpi=100)
+    ax = fig.add_subplot()
+    ax.set_aspect(1.6)
+    tracemalloc.start()
+    start = time.perf_counter()
+    imaging.teken_lijnen(ax, G, randen)
+    fig.savefig(io.BytesIO(), format="png")
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-patches", type=int, default=5000,
+                        help="largest graph (edges) to draw with patches")
+    args = parser.parse_args()
+
+    print(f"{'edges':>8}{'renderer':>11}{'seconds':>9}{'us/edge':>9}"
+          f"{'peak MB':>9}{'bytes/edge':>12}")
+    for n_stops, n_lines in [(200, 20), (1000, 100), (5000, 500),
+                             (20000, 2000)]:
+        G = imaging.make_graph(synthetic_network(n_stops, n_lines, 30))
+        edges = G.number_of_edges()
+        for randen in ["collectie", "patches"]:
+            if randen == "patches" and edges > args.max_patches:
+                continue
+            seconds, peak = draw(G, randen)
+            print(f"{edges:>8}{randen:>11}{seconds:>9.2f}"
+                  f"{1e6*seconds/edges:>9.1f}{peak/1e6:>9.1f}"
+                  f"{peak/edges:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
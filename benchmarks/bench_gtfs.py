@@ -0,0 +1,158 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gtfs
+import instrument
+import preprocessing as pp
+
+""" Speed and memory of gtfs_extract and transfer_processing on a synthetic
+feed of national size.
+
+Writes an unpacked GTFS feed with the given number of trips (the OVapi feed
+has about 25 million stop times over all its service days), half of which
+run on the extracted date, and a transfer rule for every fourth trip. Reports
+the extraction and transfer times and the peak resident memory, which should
+stay near that of the retained rows. Run from the repository root:
+    python benchmarks/bench_gtfs.py [--trips 1000000] [--length 25]
+"""
+
+date = 20250512
+headways = [(5, 30), (7, 8), (9, 15), (16, 8), (19, 20), (24, 40), (26, None)]
+# (hour, headway in minutes from that hour on), None stops the service
+
+
+def departures(rng):
+    # First departures (seconds) of one line over the service day
+    times = []
+    for (hour, headway), (end, _) in zip(headways, headways[1:]):
+        t = hour*3600 + int(rng.integers(0, 600))
+        while t < end*3600:
+            times.append(t)
+            t += headway*60
+    return times
+
+def two_digits(values):
+    return pd.Series(values).astype(str).str.zfill(2)
+
+def write_feed(folder, n_trips, length, seed=0):
+    """Writes a synthetic feed of about n_trips trips to a folder."""
+    rng = np.random.default_rng(seed)
+    per_line = len(departures(rng))
+    n_lines = max(n_trips // per_line, 1)
+    n_stops = max(n_lines*length // 4, length)
+
+    pd.DataFrame({'route_id': np.arange(n_lines//2 + 1), 'agency_id': "SYN",
+                  'route_short_name': np.arange(n_lines//2 + 1),
+                  'route_long_name': "Synthese", 'route_type': 3}
+                 ).to_csv(os.path.join(folder, "routes.txt"), index=False)
+    pd.DataFrame({'stop_id': np.arange(n_stops),
+                  'stop_name': ["Halte "+str(u) for u in range(n_stops)],
+                  'stop_lat': rng.uniform(50.8, 53.5, n_stops),
+                  'stop_lon': rng.uniform(3.4, 7.2, n_stops)}
+                 ).to_csv(os.path.join(folder, "stops.txt"), index=False)
+    pd.DataFrame({'service_id': [1], 'date': date, 'exception_type': 1}
+                 ).to_csv(os.path.join(folder, "calendar_dates.txt"),
+                          index=False)
+
+    trip_rows = []
+    times = []
+    patterns = []
+    for line in range(n_lines):
+        pattern = rng.choice(n_stops, length, replace=False)
+        patterns.append(pattern)
+        runs = np.r_[0, np.cumsum(rng.integers(60, 240, length - 1))]
+        for k, start in enumerate(departures(rng)):
+            trip = len(trip_rows)
+            trip_rows.append((line//2, 1 + trip % 2, trip, line % 2))
+            times.append((trip, pattern, start + runs))
+    trips = pd.DataFrame(trip_rows, columns=['route_id', 'service_id',
+                                             'trip_id', 'direction_id'])
+    trips['trip_headsign'] = "Richting "+trips['direction_id'].astype(str)
+    trips.to_csv(os.path.join(folder, "trips.txt"), index=False)
+
+    # Trip level transfers between stops of the two trips, a tenth of them
+    # route level and a tenth stop level
+    n_rules = len(trips) // 4
+    lines = 2*trips['route_id'].to_numpy() + trips['direction_id'].to_numpy()
+    a, b = rng.integers(len(trips), size=(2, n_rules))
+    position = rng.integers(length, size=(2, n_rules))
+    patterns = np.array(patterns)
+    level = rng.integers(10, size=n_rules)
+    blank = lambda values, keep: np.where(keep, values.astype(str), '')
+    kind = rng.choice(4, n_rules, p=[0.3, 0.1, 0.5, 0.1])
+    pd.DataFrame({
+        'from_stop_id': patterns[lines[a], position[0]],
+        'to_stop_id': patterns[lines[b], position[1]],
+        'from_route_id': blank(trips['route_id'].to_numpy()[a], level > 0),
+        'to_route_id': blank(trips['route_id'].to_numpy()[b], level > 0),
+        'from_trip_id': blank(a, level > 1), 'to_trip_id': blank(b, level > 1),
+        'transfer_type': kind,
+        'min_transfer_time': blank(rng.integers(60, 600, n_rules), kind == 2)}
+                 ).to_csv(os.path.join(folder, "transfers.txt"), index=False)
+
+    with open(os.path.join(folder, "stop_times.txt"), 'w') as f:
+        print("trip_id,stop_sequence,stop_id,arrival_time,departure_time", file=f)
+        for start in range(0, len(times), 10000):
+            block = times[start:start+10000]
+            seconds = np.concatenate([t for _, _, t in block])
+            clock = (two_digits(seconds // 3600)+":"+
+                     two_digits(seconds // 60 % 60)+":"+two_digits(seconds % 60))
+            frame = pd.DataFrame({
+                'trip_id': np.repeat([t for t, _, _ in block], length),
+                'stop_sequence': np.tile(np.arange(1, length+1), len(block)),
+                'stop_id': np.concatenate([p for _, p, _ in block]),
+                'arrival_time': clock, 'departure_time': clock})
+            frame.to_csv(f, header=False, index=False)
+    return len(trips)*length
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trips", type=int, default=200000)
+    parser.add_argument("--length", type=int, default=25,
+                        help="stops per trip")
+    parser.add_argument("--feed", help="folder for the feed (default: a "
+                        "temporary folder)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        feed = args.feed or folder
+        os.makedirs(feed, exist_ok=True)
+        start = time.perf_counter()
+        rows = write_feed(feed, args.trips, args.length)
+        print(f"Wrote {rows} stop times in {time.perf_counter() - start:.1f} s")
+
+        output = lambda name: os.path.join(folder, name)
+        start = time.perf_counter()
+        gtfs.gtfs_extract(feed, output("busstops.csv"),
+                          output("route_times.csv"), output("routes.csv"),
+                          date=date, headway_output=output("headways.csv"))
+        seconds = time.perf_counter() - start
+        print(f"Extracted in {seconds:.1f} s ({rows/seconds/1e6:.2f} M stop "
+              f"times/s), peak RSS {instrument.max_rss()/1e6:.0f} MB")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            pp.stop_processing(output("busstops.csv"), output("route_times.csv"),
+                               output("stopID_times.csv"))
+            pp.transit_processing(output("busstops.csv"), output("routes.csv"),
+                                  output("stopID_times.csv"),
+                                  output("line_nodes"), output("transit_arcs"),
+                                  sparse=True)
+        start = time.perf_counter()
+        pp.transfer_processing(feed, output("busstops.csv"), output("routes.csv"),
+                               output("transit_arcs"), output("transfer_arcs"))
+        print(f"Transfers in {time.perf_counter() - start:.1f} s, peak RSS "
+              f"{instrument.max_rss()/1e6:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import time
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import imaging
+
+""" Builds the imaging graph (imaging.make_graph) for synthetic networks up to
+national scale (50k stops, 5k lines) and reports the time taken. For the
+second size it also times the old lookup, a linear scan over all stops for
+every route stop. Run from the repository root:
+    python benchmarks/bench_imaging_graph.py
+"""
+
+
+def synthetic_network(n_stops, n_lines, line_length, seed=0):
+    """Returns a Netwerk with random stops and lines of random stops."""
+    rng = np.random.default_rng(seed)
+    netwerk = imaging.Netwerk()
+    plekken = rng.uniform([3.3, 50.7], [7.2, 53.5], size=(n_stops, 2)).tolist()
+    for id, (x, y) in enumerate(plekken):
+        netwerk.maak_bushalte(x, y, "Halte"+str(id), id)
+    for ID in range(n_lines):
+        haltes = rng.choice(n_stops, size=line_length, replace=False).tolist()
+        tijden = rng.integers(0, 5, size=line_length).tolist()
+        netwerk.maak_buslijn(ID, "Lijn"+str(ID), dict(zip(haltes, tijden)))
+    return netwerk
+
+def linear_scan(netwerk):
+    """Looks every route stop up the way zoek_bushalte used to."""
+    instanties = list(netwerk.haltes.values())
+    for lijn in netwerk.lijnen.values():
+        for id in lijn.haltes:
+            next((obj for obj in instanties if obj.ID == id), None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--line-length", type=int, default=30,
+                        help="stops per line")
+    args = parser.parse_args()
+
+    sizes = [(500, 50), (5000, 500), (50000, 5000)]
+    print(f"{'stops':>7}{'lines':>7}{'edges':>9}{'load (s)':>10}{'graph (s)':>11}")
+    for n_stops, n_lines in sizes:
+        start = time.perf_counter()
+        netwerk = synthetic_network(n_stops, n_lines, args.line_length)
+        load = time.perf_counter() - start
+        start = time.perf_counter()
+        G = imaging.make_graph(netwerk)
+        graph = time.perf_counter() - start
+        print(f"{n_stops:>7}{n_lines:>7}{G.number_of_edges():>9}{load:>10.3f}"
+              f"{graph:>11.3f}")
+
+    n_stops, n_lines = sizes[1]
+    start = time.perf_counter()
+    linear_scan(synthetic_network(n_stops, n_lines, args.line_length))
+    scan = time.perf_counter() - start
+    print(f"old linear scan lookups at {n_stops} stops: {scan:.3f} s "
+          "(grows with stops x route stops)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import spatial
+
+""" Scaling of the population center and facility linking of network_assemble
+over worker processes (spatial.link_parallel). Links synthetic centers to
+synthetic stops around Leiden for every center count and job count, checks
+that the links equal the serial ones and reports the speed-up. Run from the
+repository root:
+    python benchmarks/bench_link.py [--stops 5000] [--jobs 1 2 4 8]
+"""
+
+centers = [1000, 10000, 100000]
+bbox = ((52.10, 52.20), (4.40, 4.56)) # (lat, lng) ranges
+
+
+def synthetic_points(n, seed):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.uniform(*bbox[0], n), rng.uniform(*bbox[1], n)])
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stops", type=int, default=5000)
+    parser.add_argument("--cutoff", type=float, default=0.25)
+    parser.add_argument("--jobs", type=int, nargs="+",
+                        default=sorted({1, 2, 4, cores}))
+    args = parser.parse_args()
+
+    stop_index = spatial.StopIndex(range(args.stops),
+                                   synthetic_points(args.stops, 0))
+    print(str(args.stops)+" stops, "+str(cores)+" cores")
+    print(f"{'centers':>8}{'jobs':>6}{'seconds':>9}{'speed-up':>10}{'same':>6}")
+    for n in centers:
+        points = synthetic_points(n, 1)
+        serial = None
+        for jobs in args.jobs:
+            start = time.perf_counter()
+            links, radii = spatial.link_parallel(stop_index, points,
+                                                 args.cutoff, jobs)
+            seconds = time.perf_counter() - start
+            if serial is None:
+                serial = (links, radii, seconds)
+            same = (np.array_equal(radii, serial[1]) and
+                    all(np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1])
+                        for a, b in zip(links, serial[0])))
+            print(f"{n:>8}{jobs:>6}{seconds:>9.2f}{serial[2]/seconds:>10.2f}"
+                  f"{str(same):>6}")
+
+
+if __name__ == "__main__":
+    main()
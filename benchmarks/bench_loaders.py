@@ -0,0 +1,102 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import loaders
+import preprocessing as pp
+
+""" Times loading each raw csv file the old way (read_csv as strings, then a
+Python loop over df.iterrows() fixing decimal commas) against the typed
+loaders. The data lines of every file are repeated to get measurable sizes.
+Run from the repository root:
+    python benchmarks/bench_loaders.py [--repeat 200]
+"""
+
+
+def old_stops(path):
+    stops = {}
+    for i, row in pd.read_csv(path, sep=';').iterrows():
+        stops[row['ID']] = (float(row['lat'].replace(',', '.')),
+                            float(row['lng'].replace(',', '.')))
+    return stops
+
+def old_population(path):
+    populations = []
+    coords = []
+    for i, row in pd.read_csv(path, sep=';').iterrows():
+        populations.append(int(str(row['Inwoners']).replace('.', '')))
+        coords.append((float(row['lat'].replace(',', '.')),
+                       float(row['lng'].replace(',', '.'))))
+    return populations, coords
+
+def old_facilities(path):
+    rows = []
+    for i, row in pd.read_csv(path).iterrows():
+        rows.append((row['Name'], row['lat'], row['lng'],
+                     row['Hoeveelheid artsen']))
+    return rows
+
+def old_routes(path):
+    return [(row['name'], row['frequency']) for i, row in
+            pd.read_csv(path, sep=';').iterrows()]
+
+def old_route_times(path):
+    return [row['bus_stop'] for i, row in
+            pd.read_csv(path, sep=';').iterrows()]
+
+
+files = [
+    ("busstops.csv", pp.stop_data, old_stops, loaders.load_stops),
+    ("pc4.csv", pp.population_clustered, old_population,
+     loaders.load_population),
+    ("healthdata.csv", pp.facility_in, old_facilities, loaders.load_facilities),
+    ("routes.csv", pp.route_data, old_routes, loaders.load_routes),
+    ("route_times.csv", pp.time_data, old_route_times,
+     loaders.load_route_times),
+]
+
+
+def repeat_file(source, target, repeat):
+    """Copies a csv file with its data lines repeated."""
+    with open(source, 'r', encoding='utf-8') as f:
+        header = f.readline()
+        lines = [l if l.endswith('\n') else l+'\n' for l in f if l.strip()]
+    with open(target, 'w', encoding='utf-8') as f:
+        f.write(header)
+        for i in range(repeat):
+            f.writelines(lines)
+    return len(lines)*repeat
+
+def timed(function, path):
+    start = time.perf_counter()
+    function(path)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="times to repeat the data lines of each file")
+    args = parser.parse_args()
+
+    print(f"{'file':<18}{'rows':>9}{'iterrows (s)':>14}{'loader (s)':>12}"
+          f"{'cached (s)':>12}{'speedup':>9}")
+    with tempfile.TemporaryDirectory() as folder:
+        for name, source, old, new in files:
+            path = os.path.join(folder, name)
+            rows = repeat_file(source, path, args.repeat)
+            before = timed(old, path)
+            loaders._cache.clear()
+            after = timed(new, path)
+            cached = timed(new, path)
+            print(f"{name:<18}{rows:>9}{before:>14.4f}{after:>12.4f}"
+                  f"{cached:>12.5f}{before/after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
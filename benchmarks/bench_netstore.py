@@ -0,0 +1,49 @@
+import filecmp
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import preprocessing as pp
+
+""" Runs the network stages once through text intermediates and once through
+columnar stores (see netstore), checks that the final node and arc files are
+byte-for-byte identical and reports the time taken by each. Run from the
+repository root:
+    python benchmarks/bench_netstore.py
+"""
+
+
+def run(folder, suffix):
+    """Runs transit_processing, add_walking and network_assemble with
+    intermediates of the given suffix ("" for stores, ".txt" for text).
+    """
+    nodes = os.path.join(folder, "line_nodes"+suffix)
+    arcs = os.path.join(folder, "line_arcs"+suffix)
+    final_nodes = os.path.join(folder, "node_data.txt")
+    final_arcs = os.path.join(folder, "arc_data.txt")
+
+    start = time.perf_counter()
+    pp.transit_processing(pp.stop_data, pp.route_data, pp.route_times, nodes,
+                          arcs)
+    pp.add_walking(pp.stop_data, arcs)
+    pp.network_assemble(nodes, arcs, pp.population_clustered, pp.facility_in,
+                        pp.stop_data, final_nodes, final_arcs)
+    return time.perf_counter() - start, final_nodes, final_arcs
+
+
+def main():
+    with tempfile.TemporaryDirectory() as text_folder, \
+         tempfile.TemporaryDirectory() as store_folder:
+        text_time, *text_files = run(text_folder, ".txt")
+        store_time, *store_files = run(store_folder, "")
+        for a, b in zip(text_files, store_files):
+            same = filecmp.cmp(a, b, shallow=False)
+            print(os.path.basename(a)+": "+("identical" if same else "DIFFERENT"))
+        print(f"text intermediates:     {text_time:.3f} s")
+        print(f"columnar intermediates: {store_time:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
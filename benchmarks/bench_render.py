@@ -0,0 +1,71 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import rendering
+
+""" Renders a batch of map variants with rendering.render and reports figures
+per second: without caches (every figure decodes its background and reads
+its csv files again, as the imaging.py draw functions do), with the caches
+in one process, and with the caches in a process pool. Run from the
+repository root:
+    python benchmarks/bench_render.py [--figures 24] [--jobs 4]
+"""
+
+
+def variants(n):
+    """n figure specs cycling through the default figures, with different
+    line colors for the bus line maps.
+    """
+    specs = []
+    for i in range(n):
+        base = rendering.default_specs[i % len(rendering.default_specs)]
+        options = dict(base.options)
+        options["seed"] = i
+        specs.append(rendering.FigureSpec(base.name+"_"+str(i), base.kind,
+                                          base.background, options=options))
+    return specs
+
+def clear_caches():
+    rendering._read_image.cache_clear()
+    rendering._read_coords.cache_clear()
+    rendering._read_network.cache_clear()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--figures", type=int, default=24)
+    parser.add_argument("--jobs", type=int, default=rendering.default_jobs)
+    args = parser.parse_args()
+    specs = variants(args.figures)
+
+    with tempfile.TemporaryDirectory() as folder:
+        clear_caches()
+        start = time.perf_counter()
+        for spec in specs:
+            clear_caches()
+            rendering.render_figure(spec, folder)
+        uncached = time.perf_counter() - start
+
+        clear_caches()
+        start = time.perf_counter()
+        rendering.render(specs, folder, jobs=1)
+        cached = time.perf_counter() - start
+
+        clear_caches()
+        start = time.perf_counter()
+        rendering.render(specs, folder, jobs=args.jobs)
+        pool = time.perf_counter() - start
+
+    n = len(specs)
+    print(f"{n} figures")
+    print(f"no caches, 1 process:  {n/uncached:6.2f} figures/s")
+    print(f"caches, 1 process:     {n/cached:6.2f} figures/s")
+    print(f"caches, {args.jobs} processes:   {n/pool:6.2f} figures/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import preprocessing as pp
+
+""" Benchmark of transit_processing for a growing number of stop time rows.
+
+The number of stops and routes is kept fixed, so only the line arc part of
+the work grows with the input. Run from the repository root:
+    python benchmarks/bench_transit_processing.py
+"""
+
+n_stops = 200
+n_routes = 50
+row_counts = [10000, 100000, 1000000]
+
+
+def write_inputs(folder, n_rows, seed=0):
+    """Writes synthetic stop, route and stop time files with n_rows stop
+    times spread evenly over the routes.
+    """
+    rng = np.random.default_rng(seed)
+    stop_file = os.path.join(folder, "busstops.csv")
+    route_file = os.path.join(folder, "routes.csv")
+    time_file = os.path.join(folder, "stopID_times.csv")
+
+    with open(stop_file, 'w') as f:
+        print("ID;Halte;lat;lng", file=f)
+        for s in range(1, n_stops+1):
+            print(str(s)+";Stop "+str(s)+";52,1;4,4", file=f)
+    with open(route_file, 'w') as f:
+        print("ID;name;frequency;starttime;number;direction", file=f)
+        for r in range(1, n_routes+1):
+            print(str(r)+";Route "+str(r)+";2;0;"+str(r)+";-", file=f)
+
+    route_ids = np.repeat(np.arange(1, n_routes+1), n_rows // n_routes)
+    pd.DataFrame({"route_ID": route_ids,
+                  "name": "Route",
+                  "bus_stop": "-",
+                  "StopID": rng.integers(1, n_stops+1, len(route_ids)),
+                  "traveltime to next stop": rng.integers(1, 5, len(route_ids))}
+                 ).to_csv(time_file, index=False)
+    return stop_file, route_file, time_file
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        for n_rows in row_counts:
+            inputs = write_inputs(folder, n_rows)
+            start = time.perf_counter()
+            pp.transit_processing(*inputs, os.path.join(folder, "nodes.txt"),
+                                  os.path.join(folder, "arcs.txt"))
+            elapsed = time.perf_counter() - start
+            print(f"{n_rows:>9} rows: {elapsed:8.3f} s "
+                  f"({1e6*elapsed/n_rows:.2f} us/row)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use("Agg")
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import imaging
+import loaders
+import netstore
+import preprocessing as pp
+import synthetic
+
+""" Benchmark suite for the preprocessing stages on synthetic data sets.
+
+Generates the inputs at every requested scale (see synthetic.scales), runs
+stop_processing, transit_processing, add_walking, network_assemble,
+transit_finalization, misc_files and the imaging graph build on them in
+pipeline order, and records per stage the best wall time of the repeats and
+the peak traced memory (tracemalloc, in a separate run so the tracing does
+not slow down the timed ones). The results are stored as JSON per commit so
+runs can be compared. Run from the repository root:
+    python benchmarks/suite.py [--scales leiden city] [--repeat 3]
+    python benchmarks/suite.py --compare benchmarks/results/abc1234.json
+"""
+
+results_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "results")
+
+
+def stages(files, folder):
+    """Returns (name, function, args, kwargs) of the benchmarked stages, with
+    the arguments the pipeline uses, on the inputs and in the given folder.
+    """
+    path = lambda name: os.path.join(folder, name)
+    return [
+        ("stop_processing", pp.stop_processing,
+         [files["stops"], files["route_times"], path("stopID_times.csv")], {}),
+        ("transit_processing", pp.transit_processing,
+         [files["stops"], files["routes"], path("stopID_times.csv"),
+          path("line_nodes"), path("transit_arcs")], {"sparse": True}),
+        ("add_walking", pp.add_walking,
+         [files["stops"], path("transit_arcs")],
+         {"output_file": path("line_arcs")}),
+        ("network_assemble", pp.network_assemble,
+         [path("line_nodes"), path("line_arcs"), files["population"],
+          files["facilities"], files["stops"], path("network_nodes"),
+          path("network_arcs")], {}),
+        ("transit_finalization", pp.transit_finalization,
+         [files["routes"], path("transit_data.txt")], {}),
+        ("misc_files", pp.misc_files,
+         [path(name) for name in ("vehicle_data.txt", "operator_cost_data.txt",
+                                  "user_cost_data.txt", "assignment_data.txt",
+                                  "objective_data.txt", "problem_data.txt")] +
+         [files["routes"]], {}),
+        ("imaging_graph", imaging_graph,
+         [files["stops"], path("stopID_times.csv"), files["routes"]], {}),
+    ]
+
+def imaging_graph(stop_file, stop_time_file, route_file):
+    netwerk = imaging.import_haltes(imaging.Netwerk(), stop_file)
+    imaging.import_lijnen(netwerk, stop_time_file, route_file)
+    return imaging.make_graph(netwerk)
+
+def run_stage(function, args, kwargs, trace=False):
+    # Runs one stage quietly, returns the wall time or the traced peak
+    loaders._cache.clear() # time the file reads as well
+    with contextlib.redirect_stdout(io.StringIO()):
+        if trace:
+            tracemalloc.start()
+            function(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        return time.perf_counter() - start
+
+def bench_scale(scale, repeat, memory):
+    """Benchmarks all stages at one scale, returns its results."""
+    n_stops, n_routes, n_pop, n_fac = synthetic.scales[scale]
+    with tempfile.TemporaryDirectory() as folder:
+        files = synthetic.write_inputs(folder, n_stops, n_routes, n_pop, n_fac)
+        result = {"stops": n_stops, "routes": n_routes, "population": n_pop,
+                  "facilities": n_fac, "stages": {}}
+        for name, function, args, kwargs in stages(files, folder):
+            seconds = min(run_stage(function, args, kwargs)
+                          for r in range(repeat))
+            stage = {"seconds": seconds}
+            if memory:
+                stage["peak_bytes"] = run_stage(function, args, kwargs, True)
+            result["stages"][name] = stage
+            print(f"{scale:<10}{name:<22}{seconds:>10.3f}"+
+                  (f"{stage['peak_bytes']/1e6:>10.1f}" if memory else ""))
+        result["nodes"], result["arcs"] = [
+            netstore.table_size(os.path.join(folder, name))[0]
+            for name in ("network_nodes", "network_arcs")]
+    return result
+
+def commit():
+    """Short hash of the checked out commit, or None outside a git tree."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(results_folder)
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    """Prints the time and memory ratios (new/old) of two result files."""
+    print(f"{'scale':<10}{'stage':<22}{'old s':>10}{'new s':>10}{'ratio':>8}"
+          f"{'mem ratio':>11}")
+    for scale, result in new["scales"].items():
+        for name, stage in result["stages"].items():
+            before = old["scales"].get(scale, {}).get("stages", {}).get(name)
+            if before is None:
+                continue
+            memory = ""
+            if "peak_bytes" in stage and "peak_bytes" in before:
+                memory = f"{stage['peak_bytes']/max(before['peak_bytes'], 1):>11.2f}"
+            print(f"{scale:<10}{name:<22}{before['seconds']:>10.3f}"
+                  f"{stage['seconds']:>10.3f}"
+                  f"{stage['seconds']/max(before['seconds'], 1e-9):>8.2f}"+memory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the "
+                                     "preprocessing stages on synthetic data.")
+    parser.add_argument("--scales", nargs="+", default=["leiden", "city"],
+                        choices=list(synthetic.scales))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the tracemalloc runs")
+    parser.add_argument("--output", help="result file (default: "
+                        "benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    results = {"commit": commit(),
+               "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "machine": platform.machine(), "cpus": os.cpu_count(),
+               "repeat": args.repeat, "scales": {}}
+    print(f"{'scale':<10}{'stage':<22}{'seconds':>10}"+
+          ("" if args.no_memory else f"{'peak MB':>10}"))
+    for scale in args.scales:
+        results["scales"][scale] = bench_scale(scale, args.repeat,
+                                               not args.no_memory)
+    if resource is not None:
+        # Peak resident size of the whole run, in kilobytes except on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        results["max_rss_bytes"] = rss if sys.platform == "darwin" else rss*1024
+
+    output = args.output or os.path.join(results_folder,
+                                         str(results["commit"])+".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results written to "+output)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
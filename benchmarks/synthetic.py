@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+""" Synthetic inputs for the preprocessing stages, in the formats of the raw
+files (busstops.csv, route_times.csv, routes.csv, pc4.csv) and of the
+geocoded facilities (healthdata.csv).
+
+Stops are spread uniformly over an area that grows with their number, so the
+stop density, and with it the number of walking arcs per stop, stays close to
+that of Leiden. A line starts at a random stop and repeatedly moves to one of
+the nearest stops it has not visited yet.
+"""
+
+# Scales: stops, routes, population centers, facilities
+scales = {"leiden": (100, 50, 16, 37),
+          "city": (1000, 300, 150, 300),
+          "region": (5000, 1500, 800, 1500),
+          "national": (20000, 6000, 4000, 5000)}
+line_length = 20 # stops per line
+origin = (52.13, 4.44) # south west corner (lat, lng)
+leiden_size = (0.06, 0.09) # (lat, lng) extent holding 100 stops
+
+
+def area(n_stops):
+    """(lat, lng) bounds of an area with the stop density of Leiden."""
+    grow = np.sqrt(max(n_stops, 1)/100)
+    return ((origin[0], origin[0] + leiden_size[0]*grow),
+            (origin[1], origin[1] + leiden_size[1]*grow))
+
+def points(n, bounds, rng):
+    return np.column_stack([rng.uniform(*bounds[0], n), rng.uniform(*bounds[1], n)])
+
+def comma(x):
+    # Decimal comma, as in the files exported from Excel
+    return f"{x:.6f}".replace('.', ',')
+
+def thousands(n):
+    # Thousands separated by periods, as in pc4.csv
+    return f"{n:,}".replace(',', '.')
+
+def lines(stops, n_routes, length, rng):
+    """Returns the stop sequences of n_routes lines over the stop coordinates."""
+    tree = cKDTree(stops)
+    k = min(len(stops), 8)
+    result = []
+    for r in range(n_routes):
+        line = [int(rng.integers(len(stops)))]
+        for s in range(min(length, len(stops)) - 1):
+            near = np.atleast_1d(tree.query(stops[line[-1]], k=k)[1]).tolist()
+            near = [u for u in near if u not in line]
+            if not near:
+                break
+            line.append(near[int(rng.integers(min(len(near), 3)))])
+        result.append(line)
+    return result
+
+def write_inputs(folder, n_stops, n_routes, n_pop, n_fac, length=line_length,
+                 seed=0):
+    """Writes a synthetic data set to a folder and returns the file paths by
+    kind: stops, route_times, routes, population and facilities.
+    """
+    rng = np.random.default_rng(seed)
+    bounds = area(n_stops)
+    files = {kind: os.path.join(folder, name) for kind, name in (
+        ("stops", "busstops.csv"), ("route_times", "route_times.csv"),
+        ("routes", "routes.csv"), ("population", "pc4.csv"),
+        ("facilities", "healthdata.csv"))}
+
+    stops = points(n_stops, bounds, rng)
+    with open(files["stops"], 'w', encoding='utf-8-sig') as f:
+        print("ID;Halte;lat;lng", file=f)
+        for i, (lat, lng) in enumerate(stops.tolist()):
+            print(str(i+1)+";Halte "+str(i+1)+", Synthese;"+comma(lat)+";"+
+                  comma(lng), file=f)
+
+    names = [str(r+1)+" - Richting "+str(r+1) for r in range(n_routes)]
+    with open(files["routes"], 'w', encoding='utf-8-sig') as f:
+        print("ID;name;frequency;starttime;number;direction", file=f)
+        for r, name in enumerate(names):
+            print(str(r+1)+";"+name+";"+str(int(rng.integers(1, 7)))+";"+
+                  str(int(rng.integers(0, 60)))+";"+str(r+1)+";Richting "+
+                  str(r+1), file=f)
+    with open(files["route_times"], 'w', encoding='utf-8-sig') as f:
+        print("route_ID;name;bus_stop;traveltime to next stop", file=f)
+        for r, line in enumerate(lines(stops, n_routes, length, rng)):
+            for u in line:
+                print(str(r+1)+";"+names[r]+";Halte "+str(u+1)+", Synthese;"+
+                      str(int(rng.integers(1, 4))), file=f)
+
+    with open(files["population"], 'w', encoding='utf-8-sig') as f:
+        print("ID;lat;lng;Inwoners", file=f)
+        for i, (lat, lng) in enumerate(points(n_pop, bounds, rng).tolist()):
+            print(str(1000+i)+";"+comma(lat)+";"+comma(lng)+";"+
+                  thousands(int(rng.integers(500, 20000))), file=f)
+
+    with open(files["facilities"], 'w', encoding='utf-8-sig') as f:
+        print("Name,Hoeveelheid artsen,Adres,lat,lng", file=f)
+        for i, (lat, lng) in enumerate(points(n_fac, bounds, rng).tolist()):
+            print("Huisartspraktijk "+str(i+1)+","+str(int(rng.integers(1, 5)))+
+                  ",\"Straat "+str(i+1)+", Synthese\","+f"{lat:.5f},{lng:.5f}",
+                  file=f)
+    return files
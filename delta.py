@@ -0,0 +1,446 @@
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+
+import loaders
+import netstore
+import preprocessing as pp
+import spatial
+
+
+""" Incremental re-assembly of the final network after an input edit.
+
+A full rebuild renumbers every node and arc. This module instead compares the
+inputs (stops, route times, routes, population centers and facilities) with
+a snapshot taken at the last build and patches the final node and arc files:
+    an edited or new line gets new boarding nodes and line, boarding and
+    alighting arcs; a removed line loses them
+    an edited, new or removed stop changes its stop node, the walking arcs
+    among the stops within the cutoff of its old and new position (the only
+    pairs it can create or obstruct), and the links of all centers
+    an edited, new or removed population center or facility changes its node
+    and its own links
+Nodes and arcs are matched by what they are (stop, line and end points), not
+by ID. Every node and arc that survives keeps its ID as long as it still lies
+in its block (stops and boarding nodes first, then the centers), new ones
+fill the freed IDs, and a diff of the changed rows is written. Run from the
+repository root after a full build:
+    python delta.py --snapshot          record the current inputs
+    python delta.py                     patch Data/ after editing them
+
+The intermediate files are not patched; the next full pipeline run rebuilds
+them and numbers the network afresh. Networks built on stop clusters or with
+the GTFS transfer rules (pipeline.py --cluster or --transfers) are not
+patched either, as the patch is made from the raw stops and stop times: the
+snapshot records these stages (python delta.py --snapshot --cluster) and
+apply refuses such a network.
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+# Inputs compared against the snapshot
+inputs = {"stops": pp.stop_data, "route_times": pp.time_data,
+          "routes": pp.route_data, "population": pp.population_clustered,
+          "facilities": pp.facility_in}
+snapshot_folder = "Intermediate/delta_snapshot"
+stages_file = "stages.txt" # optional stages the network was built with
+optional_stages = ("cluster_boarding", "transfer_processing") # not patchable
+diff_file = "Data/network_diff.txt"
+diff_columns = ["Change", "Table", "OldID", "NewID", "Name", "Type", "Line",
+                "Value", "Tail", "Head", "Time"]
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def snapshot(files=inputs, folder=snapshot_folder, stages=()):
+    """Copies the inputs to the snapshot folder, as the state the final
+    network files were built from, and records the optional stages of the
+    pipeline (see optional_stages) that took part in the build.
+    """
+    for name in stages:
+        if name not in optional_stages:
+            raise ValueError("Unknown optional stage: "+str(name))
+    os.makedirs(folder, exist_ok=True)
+    for path in files.values():
+        shutil.copy2(path, os.path.join(folder, os.path.basename(path)))
+    with open(os.path.join(folder, stages_file), 'w') as f:
+        for name in stages:
+            f.write(name+"\n")
+
+def snapshot_stages(folder=snapshot_folder):
+    """Returns the optional stages recorded with the snapshot."""
+    path = os.path.join(folder, stages_file)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path+" not found, run python delta.py "
+                                "--snapshot again")
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def check_patchable(stages, stops, nodes, arcs):
+    """Raises a ValueError if the network was not built from the raw stops
+    and stop times alone, so that a patch would differ from a full rebuild.
+
+    Requires the optional stages recorded with the snapshot, the snapshot
+    stops and the keyed network (see read_network). Besides the recorded
+    stages, a network with stop nodes other than the stops (clusters), or
+    with boarding arcs that take time or walking arcs from a boarding node
+    (transfer rules), is refused.
+    """
+    if stages:
+        raise ValueError("The network was built with "+", ".join(stages)+
+                         ", which delta cannot patch; run the full pipeline")
+    if {key[1] for key in nodes if key[0] == "stop"} != set(stops):
+        raise ValueError("The stop nodes of the network are not the stops "
+                         "of the snapshot (clustered?); run the full pipeline")
+    for (kind, line, tail, head), row in arcs.items():
+        if ((kind == pp.aid_board and row[1] != 0) or
+                (kind == pp.aid_walk and tail[0] == "board")):
+            raise ValueError("The network has transfer penalties or arcs, "
+                             "which delta cannot patch; run the full pipeline")
+
+def snapshot_files(files=inputs, folder=snapshot_folder):
+    """Returns the paths of the snapshot copies of the inputs."""
+    snapshots = {kind: os.path.join(folder, os.path.basename(path))
+                 for kind, path in files.items()}
+    for path in snapshots.values():
+        if not os.path.exists(path):
+            raise FileNotFoundError(path+" not found, run a full build and "
+                                    "python delta.py --snapshot first")
+    return snapshots
+
+def read_inputs(files):
+    """Reads the inputs into stops, lines and centers.
+
+    Returns the stops as {ID: (lat, lng)} in file order, the lines as
+    {route ID: [(tail, head, time)]} for the routes in the routes file, and
+    the population centers and facilities as {key: (lat, lng, name, value)}
+    in file order. A center key is ("pop", pc4) or ("fac", name, k) for the
+    k-th facility of that name.
+    """
+    stop_df = loaders.load_stops(files["stops"])
+    stops = dict(zip(stop_df['ID'].tolist(),
+                     map(tuple, loaders.coords(stop_df).tolist())))
+
+    times_df = loaders.load_route_times(files["route_times"])
+    times_df['StopID'] = pp.stop_ids(stop_df, times_df)
+    arc_frame = pp.line_arc_frame(times_df)
+    route_arcs = {r: list(zip(group['tail'].tolist(), group['head'].tolist(),
+                              group['time'].tolist()))
+                  for r, group in arc_frame.groupby('route', sort=False)}
+    lines = {r: route_arcs.get(r, []) for r in
+             loaders.load_routes(files["routes"])['ID'].tolist()}
+
+    centers = {}
+    pop_df = loaders.load_population(files["population"])
+    for i, (pc4, (lat, lng), value) in enumerate(zip(
+            pop_df['ID'].tolist(), loaders.coords(pop_df).tolist(),
+            pop_df['Inwoners'].tolist())):
+        centers[("pop", pc4)] = (lat, lng, str(i)+"_"+str(pc4), value)
+    fac_df = loaders.load_facilities(files["facilities"])
+    seen = {}
+    for name, (lat, lng), value in zip(fac_df['Name'].tolist(),
+                                       loaders.coords(fac_df).tolist(),
+                                       fac_df['Hoeveelheid artsen'].tolist()):
+        seen[name] = seen.get(name, -1) + 1
+        centers[("fac", name, seen[name])] = (lat, lng, str(name), value)
+    return stops, lines, centers
+
+# -------------------------------------------------------------------------------------------------
+def node_key(name, kind, line):
+    """Key of a node of the final network, from its name, type and line."""
+    if kind == pp.nid_stop:
+        return ("stop", int(name[4:]))
+    if kind == pp.nid_board:
+        return ("board", int(name[4:name.index("_Route")]), line)
+    if kind == pp.nid_pop:
+        return ("pop", int(name.split("_", 1)[1]))
+    return ("fac", name)
+
+def read_network(node_file, arc_file):
+    """Reads the final network into keyed rows.
+
+    Returns {node key: [ID, Name, Type, Line, Value]} and {arc key: [ID,
+    Time]}, both in ID order. An arc key is (Type, Line, tail key, head key).
+    Facilities sharing a name are numbered in ID order, as in read_inputs.
+    """
+    nodes = netstore.read_table(node_file, mmap=False)
+    order = np.argsort(nodes['ID'], kind='stable')
+    node_rows = {}
+    by_id = {}
+    seen = {}
+    for row in zip(*(nodes[c][order].tolist() for c in pp.node_columns)):
+        key = node_key(row[1], row[2], row[3])
+        if row[2] == pp.nid_fac:
+            seen[key] = seen.get(key, -1) + 1
+            key = key + (seen[key],)
+        node_rows[key] = list(row)
+        by_id[row[0]] = key
+
+    arcs = netstore.read_table(arc_file, mmap=False)
+    order = np.argsort(arcs['ID'], kind='stable')
+    ints = arcs[netstore.time_flag][order].tolist()
+    arc_rows = {}
+    for i, (arc_id, kind, line, tail, head, t) in enumerate(zip(
+            *(arcs[c][order].tolist() for c in pp.arc_columns))):
+        arc_rows[(kind, line, by_id[tail], by_id[head])] = \
+            [arc_id, int(t) if ints[i] else t]
+    return node_rows, arc_rows
+
+# -------------------------------------------------------------------------------------------------
+def line_rows(r, arcs, stop_order, sparse):
+    """Boarding nodes {key: [Name, Type, Line, Value]} and line, boarding and
+    alighting arcs {key: Time} of one line, as transit_processing makes them.
+    """
+    if sparse:
+        served = {u for a in arcs for u in a[:2]}
+        route_stops = [u for u in stop_order if u in served]
+    else:
+        route_stops = stop_order
+    nodes = {("board", u, r): ["Stop"+str(u)+"_Route"+str(r), pp.nid_board, r,
+                               -1] for u in route_stops}
+    arc_rows = {}
+    for u, v, t in arcs:
+        arc_rows[(pp.aid_line, r, ("board", u, r), ("board", v, r))] = t
+    for u in route_stops:
+        arc_rows[(pp.aid_board, r, ("stop", u), ("board", u, r))] = 0
+    for u in route_stops:
+        arc_rows[(pp.aid_alight, r, ("board", u, r), ("stop", u))] = 0
+    return nodes, arc_rows
+
+def assign_ids(keys, old_ids, start):
+    """Numbers keys consecutively from start, keeping every old ID that falls
+    in that range and handing the remaining IDs to the other keys in order.
+    """
+    stop = start + len(keys)
+    ids = {}
+    movers = []
+    for key in keys:
+        i = old_ids.get(key)
+        if i is not None and start <= i < stop:
+            ids[key] = i
+        else:
+            movers.append(key)
+    taken = set(ids.values())
+    free = (i for i in range(start, stop) if i not in taken)
+    for key, i in zip(movers, free):
+        ids[key] = i
+    return ids
+
+# -------------------------------------------------------------------------------------------------
+def apply(node_file=pp.final_node_data, arc_file=pp.final_arc_data,
+          files=inputs, folder=snapshot_folder, output_diff=diff_file,
+          cutoff=0.25, method=spatial.default_method, sparse=None,
+          update=True):
+    """Patches the final network files for the changes between the snapshot
+    and the current inputs.
+
+    Requires the node and arc files (or columnar stores) built from the
+    snapshot, and accepts the inputs, the snapshot folder, the diff output
+    file, the walking cutoff and distance method of network_assemble, and
+    whether the lines have boarding nodes at every stop (sparse=False) or
+    only at the stops they serve; by default this is read from the network.
+    The snapshot is updated afterwards unless update is False. Prints and
+    returns a summary of the changes. Raises a ValueError for a network the
+    patch cannot reproduce, see check_patchable.
+    """
+    stages = snapshot_stages(folder)
+    old_stops, old_lines, old_centers = read_inputs(snapshot_files(files,
+                                                                   folder))
+    stops, lines, centers = read_inputs(files)
+    old_nodes, old_arcs = read_network(node_file, arc_file)
+    check_patchable(stages, old_stops, old_nodes, old_arcs)
+    nodes = {key: row[1:] for key, row in old_nodes.items()}
+    arcs = {key: row[1] for key, row in old_arcs.items()}
+    if sparse is None:
+        boarding = sum(1 for key in nodes if key[0] == "board")
+        sparse = boarding != len(old_stops)*len(old_lines)
+
+    # Stops
+    moved = [u for u in stops if u in old_stops and stops[u] != old_stops[u]]
+    added = [u for u in stops if u not in old_stops]
+    removed = [u for u in old_stops if u not in stops]
+    for u in removed:
+        del nodes[("stop", u)]
+    for u in added:
+        nodes[("stop", u)] = ["Stop"+str(u), pp.nid_stop, -1, -1]
+
+    # Lines that changed, or all lines when the stops they board at changed
+    changed_lines = [r for r in lines.keys() | old_lines.keys()
+                     if lines.get(r) != old_lines.get(r)]
+    if not sparse and (added or removed):
+        changed_lines = list(lines.keys() | old_lines.keys())
+    changed_lines = sorted(changed_lines)
+    if changed_lines:
+        dropped = set(changed_lines)
+        nodes = {key: row for key, row in nodes.items()
+                 if not (key[0] == "board" and key[2] in dropped)}
+        arcs = {key: t for key, t in arcs.items()
+                if not (key[0] in (pp.aid_line, pp.aid_board, pp.aid_alight)
+                        and key[1] in dropped)}
+        for r in changed_lines:
+            if r in lines:
+                line_nodes, line_arcs = line_rows(r, lines[r], list(stops),
+                                                  sparse)
+                nodes.update(line_nodes)
+                arcs.update(line_arcs)
+
+    stop_index = spatial.StopIndex(list(stops), list(stops.values()), method)
+    ids = stop_index.ids
+    if moved or added or removed:
+        # Walking arcs among the stops near the old and new positions
+        points = [old_stops[u] for u in moved + removed] + \
+                 [stops[u] for u in moved + added]
+        pairs, near = stop_index.walking_pairs_near(points, cutoff)
+        local = {("stop", ids[i]) for i in near.tolist()} | \
+                {("stop", u) for u in removed}
+        arcs = {key: t for key, t in arcs.items() if not (
+            key[0] == pp.aid_walk and key[2] in local and key[3] in local)}
+        for i, j, dist in pairs:
+            a, b = ("stop", ids[i]), ("stop", ids[j])
+            arcs[(pp.aid_walk, -1, a, b)] = dist*pp.km_walk_time
+            arcs[(pp.aid_walk, -1, b, a)] = dist*pp.km_walk_time
+
+    # Centers: relink the changed ones, or all of them when the stops changed
+    relink = [key for key in centers if moved or added or removed or
+              key not in old_centers or centers[key][:2] != old_centers[key][:2]]
+    gone = set(relink) | (old_centers.keys() - centers.keys())
+    arcs = {key: t for key, t in arcs.items() if not (
+        key[0] == pp.aid_walk_health and (key[2] in gone or key[3] in gone))}
+    for key in old_centers.keys() - centers.keys():
+        nodes.pop(key, None)
+    for key, (lat, lng, name, value) in centers.items():
+        kind = pp.nid_pop if key[0] == "pop" else pp.nid_fac
+        nodes[key] = [name, kind, -1, value]
+    links, radii = stop_index.link([centers[key][:2] for key in relink],
+                                   cutoff)
+    for key, (linked, dist) in zip(relink, links):
+        for j, d in zip(linked.tolist(), dist.tolist()):
+            arcs[(pp.aid_walk_health, -1, key, ("stop", ids[j]))] = \
+                d*pp.km_walk_time
+            arcs[(pp.aid_walk_health, -1, ("stop", ids[j]), key)] = \
+                d*pp.km_walk_time
+
+    # Arcs left without an end point
+    arcs = {key: t for key, t in arcs.items()
+            if key[2] in nodes and key[3] in nodes}
+
+    # Stable IDs: stop and boarding nodes first, then the centers
+    start = min((row[0] for row in old_nodes.values()), default=0)
+    old_ids = {key: row[0] for key, row in old_nodes.items()}
+    core = [key for key in nodes if key[0] in ("stop", "board")]
+    node_ids = assign_ids(core, old_ids, start)
+    node_ids.update(assign_ids([key for key in nodes if key[0] in
+                                ("pop", "fac")], old_ids, start + len(core)))
+    arc_start = min((row[0] for row in old_arcs.values()), default=0)
+    arc_ids = assign_ids(list(arcs), {key: row[0] for key, row in
+                                      old_arcs.items()}, arc_start)
+
+    node_order = sorted(nodes, key=node_ids.get)
+    netstore.write_table(node_file, netstore.make_table(pp.node_columns, zip(
+        *[[node_ids[key]] + nodes[key] for key in node_order])))
+    arc_order = sorted(arcs, key=arc_ids.get)
+    arc_rows = [(arc_ids[key], key[0], key[1], node_ids[key[2]],
+                 node_ids[key[3]], arcs[key]) for key in arc_order]
+    netstore.write_table(arc_file, netstore.make_table(
+        pp.arc_columns, zip(*arc_rows) if arc_rows else [[]]*len(pp.arc_columns)))
+
+    summary = write_diff(output_diff, old_nodes, old_arcs, nodes, node_ids,
+                         arcs, arc_ids)
+    summary.update({"lines": len(changed_lines), "stops": len(moved) +
+                    len(added) + len(removed), "relinked": len(relink)})
+    print("Changed "+str(summary["lines"])+" lines and "+str(summary["stops"])+
+          " stops, relinked "+str(summary["relinked"])+" centers.")
+    print("Nodes: "+str(summary["nodes_added"])+" added, "+
+          str(summary["nodes_removed"])+" removed, "+
+          str(summary["nodes_changed"])+" changed. Arcs: "+
+          str(summary["arcs_added"])+" added, "+str(summary["arcs_removed"])+
+          " removed, "+str(summary["arcs_changed"])+" changed.")
+    if update:
+        snapshot(files, folder, stages)
+    return summary
+
+def write_diff(output_file, old_nodes, old_arcs, nodes, node_ids, arcs,
+               arc_ids):
+    """Writes the rows that were added (+), removed (-) or changed (~) in the
+    node and arc files, with their old and new IDs. A row also counts as
+    changed when only its ID or, for an arc, the ID of an end node changed.
+    Arc ends are given as node IDs. Returns the counts per table.
+    """
+    names = {"+": "added", "-": "removed", "~": "changed"}
+    counts = {table+"_"+name: 0 for table in ("nodes", "arcs")
+              for name in names.values()}
+    lines = []
+
+    def add(table, change, old, new, fields):
+        counts[table+"s_"+names[change]] += 1
+        lines.append([change, table, old, new] + fields)
+
+    for key, row in old_nodes.items():
+        if key not in nodes:
+            add("node", "-", row[0], "", row[1:] + [""]*3)
+    for key, row in nodes.items():
+        old = old_nodes.get(key)
+        if old is None:
+            add("node", "+", "", node_ids[key], row + [""]*3)
+        elif old != [node_ids[key]] + row:
+            add("node", "~", old[0], node_ids[key], row + [""]*3)
+
+    for key, (arc_id, t) in old_arcs.items():
+        if key not in arcs:
+            add("arc", "-", arc_id, "", ["", key[0], key[1], "",
+                old_nodes[key[2]][0], old_nodes[key[3]][0], t])
+    for key, t in arcs.items():
+        fields = ["", key[0], key[1], "", node_ids[key[2]], node_ids[key[3]], t]
+        old = old_arcs.get(key)
+        if old is None:
+            add("arc", "+", "", arc_ids[key], fields)
+        elif (old != [arc_ids[key], t] or old_nodes[key[2]][0] != fields[4] or
+              old_nodes[key[3]][0] != fields[5]):
+            add("arc", "~", old[0], arc_ids[key], fields)
+
+    with open(output_file, 'w') as f:
+        f.write("\t".join(diff_columns)+"\n")
+        for line in lines:
+            f.write("\t".join(str(v) for v in line)+"\n")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Patches the final network "
+                                     "files for edited inputs.")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="only record the current inputs")
+    parser.add_argument("--cluster", action="store_true",
+                        help="with --snapshot: the network was built on stop "
+                        "clusters (pipeline.py --cluster)")
+    parser.add_argument("--transfers", action="store_true",
+                        help="with --snapshot: the network has the GTFS "
+                        "transfer rules (pipeline.py --transfers)")
+    parser.add_argument("--nodes", default=pp.final_node_data)
+    parser.add_argument("--arcs", default=pp.final_arc_data)
+    parser.add_argument("--diff", default=diff_file)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="keep the snapshot as it is")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        stages = [name for name, used in zip(optional_stages, (
+            args.cluster, args.transfers)) if used]
+        snapshot(stages=stages)
+        print("Recorded the inputs in "+snapshot_folder)
+        return
+    start = time.perf_counter()
+    apply(args.nodes, args.arcs, output_diff=args.diff,
+          update=not args.dry_run)
+    print(f"Patched in {time.perf_counter() - start:.3f} s, diff written to "
+          f"{args.diff}")
+
+
+if __name__ == "__main__":
+    main()
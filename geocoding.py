@@ -0,0 +1,186 @@
+import concurrent.futures
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+""" Geocoding of facility addresses, used by preprocessing.address_to_coords.
+
+Results are kept in a persistent cache keyed by normalized address, so a rerun
+on unchanged inputs makes no network calls. Addresses that are not cached are
+sent to a provider in batches, concurrently, under a rate limit. Providers are
+pluggable: MapQuestProvider talks to the MapQuest API (or any server speaking
+its batch protocol, such as a local stub), FixtureProvider answers from a file.
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+cache_file = "Intermediate/geocode_cache.json"
+mapquest_url = "http://www.mapquestapi.com/geocoding/v1/batch"
+mapquest_batch = 100 # maximum locations per MapQuest batch request
+default_rate = 5.0 # requests per second
+default_workers = 4 # concurrent requests
+retries = 3 # retries of failed requests (connection errors, 429 and 5xx)
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def normalize_address(address):
+    """Returns the cache key of an address: lower case, single spaces, no
+    spaces around commas.
+    """
+    address = re.sub(r"\s+", " ", str(address)).strip().lower()
+    return re.sub(r"\s*,\s*", ", ", address)
+
+# -------------------------------------------------------------------------------------------------
+class GeocodeCache:
+    """Persistent address -> (lat, lng) cache stored as a JSON file."""
+
+    def __init__(self, path=cache_file):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = {k: tuple(v) for k, v in json.load(f).items()}
+
+    def get(self, address):
+        return self.entries.get(normalize_address(address))
+
+    def put(self, address, coords):
+        with self.lock:
+            self.entries[normalize_address(address)] = tuple(coords)
+
+    def save(self):
+        """Writes the cache, replacing the old file only once complete."""
+        if self.path is None:
+            return
+        with self.lock:
+            entries = dict(self.entries)
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(self.path+".tmp", 'w', encoding='utf-8') as f:
+            json.dump(entries, f, indent=1, ensure_ascii=False, sort_keys=True)
+        os.replace(self.path+".tmp", self.path)
+
+class RateLimiter:
+    """Thread-safe limiter allowing at most `rate` calls per second."""
+
+    def __init__(self, rate=default_rate):
+        self.interval = 1.0/rate if rate else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+# -------------------------------------------------------------------------------------------------
+class MapQuestProvider:
+    """Geocodes through the MapQuest batch endpoint.
+
+    Requires an API key; accepts another endpoint URL (e.g. a local stub)
+    and batch size. Requests share one pooled session that retries failed
+    requests.
+    """
+
+    def __init__(self, api_key, url=mapquest_url, batch_size=mapquest_batch):
+        self.api_key = api_key
+        self.url = url
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=default_workers*2, max_retries=Retry(
+            total=retries, backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504]))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_private(cls, private_file="private.json"):
+        """Reads the API key from the private.json file."""
+        with open(private_file, 'r') as f:
+            return cls(json.load(f)['MapQuest'])
+
+    def geocode_batch(self, addresses):
+        """Returns a list of (lat, lng) for a batch of addresses, in order."""
+        parameters = [("key", self.api_key), ("maxResults", 1)]
+        parameters += [("location", a) for a in addresses]
+        response = self.session.get(self.url, params=parameters, timeout=30)
+        response.raise_for_status()
+        results = response.json()['results']
+        coords = []
+        for result in results:
+            lat_lng = result['locations'][0]['latLng']
+            coords.append((lat_lng['lat'], lat_lng['lng']))
+        return coords
+
+class FixtureProvider:
+    """Geocodes from a JSON file mapping addresses to [lat, lng], for tests
+    and offline runs. Counts the addresses it was asked for in `calls`.
+    """
+
+    batch_size = mapquest_batch
+
+    def __init__(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            self.table = {normalize_address(k): tuple(v) for k, v in
+                          json.load(f).items()}
+        self.calls = 0
+
+    def geocode_batch(self, addresses):
+        self.calls += len(addresses)
+        return [self.table[normalize_address(a)] for a in addresses]
+
+# -------------------------------------------------------------------------------------------------
+def geocode(addresses, provider, cache=None, rate=default_rate,
+            workers=default_workers):
+    """Geocodes a list of addresses, returning a list of (lat, lng).
+
+    Only the unique addresses missing from the cache are sent to the
+    provider, in batches of provider.batch_size, by a pool of worker threads
+    under the rate limit (requests per second). New results are added to the
+    cache and saved.
+    """
+    if cache is None:
+        cache = GeocodeCache(None)
+    missing = {}
+    for address in addresses:
+        if cache.get(address) is None:
+            missing.setdefault(normalize_address(address), address)
+    missing = list(missing.values())
+
+    if len(missing) > 0:
+        limiter = RateLimiter(rate)
+        batches = [missing[i:i+provider.batch_size]
+                   for i in range(0, len(missing), provider.batch_size)]
+
+        def work(batch):
+            limiter.wait()
+            for address, coords in zip(batch, provider.geocode_batch(batch)):
+                cache.put(address, coords)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                for future in [pool.submit(work, b) for b in batches]:
+                    future.result()
+        finally:
+            # Keep whatever was geocoded, also when a batch failed
+            cache.save()
+        print("Geocoded "+str(len(missing))+" addresses in "+str(len(batches))+
+              " requests.")
+
+    return [cache.get(address) for address in addresses]
@@ -0,0 +1,513 @@
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import instrument
+
+
+""" Streaming reader for raw GTFS feeds (e.g. the OVapi gtfs-nl.zip).
+
+Reads the feed tables straight from the zip (or from an unpacked folder such
+as "GTFS unprocessed example/") in chunks, filters them early by agency,
+bounding box and service date, and writes the busstops.csv, route_times.csv
+and routes.csv equivalents used by preprocessing.py. Only the retained subset
+of the feed is ever held in memory, and of stop_times only integer trip and
+stop codes and times in seconds.
+
+The timetable of the retained trips is analysed with grouped NumPy operations:
+per line the headways in every time window, the average run times between
+consecutive stops and the cycle time, from which the fleet implied by the peak
+headway follows. Fleet and cycle time go into routes.csv for
+transit_finalization, the run times into route_times.csv for
+transit_processing.
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+chunk_rows = 500000 # rows per chunk when streaming the large tables
+
+leiden_bbox = (52.116441, 52.18667, 4.435435, 4.550754) # lat min/max, lng min/max
+leiden_agencies = ["QBUZZ", "EBS"]
+bus_route_type = 3 # GTFS route_type of buses
+headway_windows = [0, 7, 9, 16, 19, 24, 30] # hour bounds of the headway
+# windows; departures past the last bound count in the last window
+run_time_decimals = 1 # decimals of the average run times (minutes)
+
+# Columns read from each table, and their types. Columns missing from a feed
+# are skipped.
+table_columns = {
+    "routes.txt": {"route_id": str, "agency_id": "category",
+                   "route_short_name": str, "route_long_name": str,
+                   "route_type": np.int16},
+    "stops.txt": {"stop_id": str, "stop_code": str, "stop_name": str,
+                  "stop_lat": np.float64, "stop_lon": np.float64,
+                  "location_type": "category"},
+    "calendar_dates.txt": {"service_id": str, "date": np.int32,
+                           "exception_type": np.int8},
+    "trips.txt": {"route_id": str, "service_id": str, "trip_id": str,
+                  "trip_headsign": "category", "direction_id": "category"},
+    "stop_times.txt": {"trip_id": str, "stop_sequence": np.int32,
+                       "stop_id": str, "arrival_time": str,
+                       "departure_time": str},
+    "transfers.txt": {"from_stop_id": str, "to_stop_id": str,
+                      "from_route_id": str, "to_route_id": str,
+                      "from_trip_id": str, "to_trip_id": str,
+                      "transfer_type": str, "min_transfer_time": np.float64},
+}
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def read_table(feed, name, chunksize=None, columns=None):
+    """Reads one table of a GTFS feed.
+
+    Requires the feed (a zip file or a folder) and the table file name.
+    Accepts an optional chunk size, in which case an iterator over chunks is
+    returned, and the columns to read (default: those in table_columns).
+    Returns None if the feed does not contain the table.
+    """
+    if columns is None:
+        columns = table_columns[name]
+
+    if os.path.isdir(feed):
+        path = os.path.join(feed, name)
+        if not os.path.exists(path):
+            return None
+        handle = open(path, 'rb')
+    else:
+        archive = zipfile.ZipFile(feed)
+        if name not in archive.namelist():
+            archive.close()
+            return None
+        handle = archive.open(name)
+
+    reader = pd.read_csv(handle, usecols=lambda c: c in columns, dtype=columns,
+                         chunksize=chunksize, encoding='utf-8-sig',
+                         low_memory=False, keep_default_na=False,
+                         na_values={c: [''] for c in columns
+                                    if columns[c] not in (str, "category")})
+    if chunksize is None:
+        handle.close()
+        return reader
+    return _closing(reader, handle)
+
+def _closing(reader, handle):
+    # Yield the chunks of a reader, closing the file handle afterwards
+    try:
+        for chunk in reader:
+            yield chunk
+    finally:
+        handle.close()
+
+# -------------------------------------------------------------------------------------------------
+def parse_gtfs_time(times):
+    """Converts an array of GTFS HH:MM:SS strings to seconds since midnight of
+    the service day. Hours past 24 (trips running after midnight) are kept,
+    empty values become -1.
+
+    Times in the usual two digit form are converted as fixed-width character
+    arrays; other forms (H:MM:SS, hours past 99) are split on the colons.
+    """
+    times = np.asarray(times, dtype=object)
+    chars = times.astype('U9').view(np.uint32).reshape(len(times), 9)
+    digits = chars[:, [0, 1, 3, 4, 6, 7]].astype(np.int32) - ord('0')
+    regular = ((chars[:, 2] == ord(':')) & (chars[:, 5] == ord(':')) &
+               (chars[:, 8] == 0) & ((digits >= 0) & (digits <= 9)).all(axis=1))
+    seconds = ((digits[:, 0]*10 + digits[:, 1])*3600 +
+               (digits[:, 2]*10 + digits[:, 3])*60 + digits[:, 4]*10 + digits[:, 5])
+    seconds[~regular] = _split_times(times[~regular])
+    return seconds
+
+def _split_times(times):
+    # parse_gtfs_time for the times not in the two digit form
+    times = pd.Series(times).fillna('')
+    parts = times.str.split(':', expand=True)
+    if parts.shape[1] < 3:
+        return np.full(len(times), -1, dtype=np.int32)
+    parts = parts.iloc[:, :3].apply(pd.to_numeric, errors='coerce')
+    seconds = (parts[0]*3600 + parts[1]*60 + parts[2]).fillna(-1)
+    return seconds.to_numpy().astype(np.int32)
+
+# -------------------------------------------------------------------------------------------------
+def select_routes(feed, agencies=None, route_types=(bus_route_type,)):
+    """Returns the routes table, restricted to the given agencies and route
+    types (None keeps all).
+    """
+    routes = read_table(feed, "routes.txt")
+    if agencies is not None:
+        routes = routes[routes['agency_id'].isin(agencies)]
+    if route_types is not None and 'route_type' in routes:
+        routes = routes[routes['route_type'].isin(route_types)]
+    return routes.reset_index(drop=True)
+
+def select_stops(feed, bbox=None, chunksize=chunk_rows):
+    """Streams the stops table, keeping the stops (not stations or
+    entrances) inside the bounding box (lat min, lat max, lng min, lng max).
+    """
+    kept = []
+    for chunk in read_table(feed, "stops.txt", chunksize):
+        if 'location_type' in chunk:
+            chunk = chunk[chunk['location_type'].isin(['0', '']) |
+                          chunk['location_type'].isna()]
+        if bbox is not None:
+            chunk = chunk[chunk['stop_lat'].between(bbox[0], bbox[1]) &
+                          chunk['stop_lon'].between(bbox[2], bbox[3])]
+        kept.append(chunk)
+    return pd.concat(kept, ignore_index=True).drop_duplicates('stop_id',
+                                                             ignore_index=True)
+
+def active_services(feed, date, chunksize=chunk_rows):
+    """Returns the set of service IDs running on a date (YYYYMMDD), using the
+    calendar_dates table (the OVapi feed has no calendar table).
+    """
+    services = set()
+    table = read_table(feed, "calendar_dates.txt", chunksize)
+    if table is None:
+        return None
+    for chunk in table:
+        chunk = chunk[(chunk['date'] == int(date)) &
+                      (chunk['exception_type'] == 1)]
+        services.update(chunk['service_id'])
+    return services
+
+def select_trips(feed, route_ids, services=None, chunksize=chunk_rows):
+    """Streams the trips table, keeping the trips of the given routes that
+    run on one of the services (None keeps all).
+    """
+    kept = []
+    route_ids = set(route_ids)
+    for chunk in read_table(feed, "trips.txt", chunksize):
+        keep = chunk['route_id'].isin(route_ids)
+        if services is not None:
+            keep &= chunk['service_id'].isin(services)
+        kept.append(chunk[keep])
+    trips = pd.concat(kept, ignore_index=True).drop_duplicates('trip_id',
+                                                              ignore_index=True)
+    for column in ('trip_headsign', 'direction_id'):
+        if column not in trips:
+            trips[column] = ''
+        trips[column] = trips[column].astype(str)
+    return trips
+
+
+def select_stop_times(feed, trip_ids, stop_ids, chunksize=chunk_rows):
+    """Streams the stop_times table, keeping the rows of the given trips at
+    the given stops.
+
+    Trips and stops are coded as their positions in trip_ids and stop_ids
+    (which must be unique; a hash join per chunk) and times converted to seconds (see
+    parse_gtfs_time), so a kept row takes 20 bytes however long the IDs are.
+    Returns a frame with the trip, stop_sequence, stop, arrival and departure
+    columns, sorted by trip and stop sequence.
+    """
+    trip_index = pd.Index(trip_ids)
+    stop_index = pd.Index(stop_ids)
+    kept = []
+    n_read = 0
+    for chunk in read_table(feed, "stop_times.txt", chunksize):
+        n_read += len(chunk)
+        trips = trip_index.get_indexer(chunk['trip_id'])
+        stops = stop_index.get_indexer(chunk['stop_id'])
+        keep = (trips >= 0) & (stops >= 0)
+        chunk = chunk[keep]
+        kept.append(pd.DataFrame({
+            'trip': trips[keep].astype(np.int32),
+            'stop_sequence': chunk['stop_sequence'].to_numpy(),
+            'stop': stops[keep].astype(np.int32),
+            'arrival': parse_gtfs_time(chunk['arrival_time']),
+            'departure': parse_gtfs_time(chunk['departure_time'])}))
+    stop_times = pd.concat(kept, ignore_index=True)
+    order = np.lexsort((stop_times['stop_sequence'].to_numpy(),
+                        stop_times['trip'].to_numpy()))
+    instrument.rows(n_read, len(stop_times))
+    return stop_times.take(order).reset_index(drop=True)
+
+def select_transfers(feed, stop_ids, route_ids, trip_ids, chunksize=chunk_rows):
+    """Streams the transfers table, keeping the rules between the given stops
+    whose routes and trips, where a rule names them, are among the given ones.
+
+    Stops, routes and trips are coded as their positions in stop_ids,
+    route_ids and trip_ids (which must be unique; a hash join per chunk), -1
+    where a rule leaves them out, so memory is bounded by the kept rules.
+    Returns a frame with the from_stop, to_stop, from_route, to_route,
+    from_trip and to_trip codes, the transfer_type (0 if empty) and the
+    min_transfer_time (seconds, NaN if empty) of the kept rules.
+    """
+    indices = {"stop": pd.Index(stop_ids), "route": pd.Index(route_ids),
+               "trip": pd.Index(trip_ids)}
+    names = [side+"_"+kind for kind in indices for side in ("from", "to")]
+    kept = [pd.DataFrame({name: np.zeros(0, dtype=np.int32) for name in names})]
+    n_read = 0
+    table = read_table(feed, "transfers.txt", chunksize)
+    for chunk in (table if table is not None else []):
+        n_read += len(chunk)
+        codes = {}
+        keep = np.ones(len(chunk), dtype=bool)
+        for name in names:
+            column = name+"_id"
+            if column not in chunk:
+                codes[name] = np.full(len(chunk), -1, dtype=np.int32)
+                continue
+            values = chunk[column].to_numpy()
+            index = indices[name.split("_")[1]]
+            codes[name] = index.get_indexer(values).astype(np.int32)
+            keep &= (codes[name] >= 0) | (values == '')
+        keep &= (codes['from_stop'] >= 0) & (codes['to_stop'] >= 0)
+        frame = pd.DataFrame({name: codes[name][keep] for name in names})
+        types = (chunk['transfer_type'] if 'transfer_type' in chunk
+                 else pd.Series('', index=chunk.index))
+        frame['transfer_type'] = pd.to_numeric(types[keep], errors='coerce'
+                                               ).fillna(0).to_numpy(np.int8)
+        frame['min_transfer_time'] = (
+            chunk['min_transfer_time'][keep].to_numpy(np.float64)
+            if 'min_transfer_time' in chunk else np.nan)
+        kept.append(frame)
+    transfers = pd.concat(kept, ignore_index=True)
+    instrument.rows(n_read, len(transfers))
+    return transfers
+
+# -------------------------------------------------------------------------------------------------
+def trip_times(stop_times, n_trips):
+    """Returns, per trip code, the number of stop times, the first departure
+    and the last arrival (seconds; -1 for trips without stop times). A missing
+    departure or arrival is taken from the other time of the same stop.
+    """
+    trip = stop_times['trip'].to_numpy()
+    arrival = stop_times['arrival'].to_numpy()
+    departure = stop_times['departure'].to_numpy()
+    departure = np.where(departure < 0, arrival, departure)
+    arrival = np.where(arrival < 0, departure, arrival)
+
+    first = np.flatnonzero(np.r_[True, trip[1:] != trip[:-1]]) if len(trip) \
+        else np.zeros(0, dtype=np.int64)
+    last = np.r_[first[1:], len(trip)] - 1
+    sizes = np.zeros(n_trips, dtype=np.int64)
+    starts = np.full(n_trips, -1, dtype=np.int64)
+    ends = np.full(n_trips, -1, dtype=np.int64)
+    sizes[trip[first]] = last - first + 1
+    starts[trip[first]] = departure[first]
+    ends[trip[first]] = arrival[last]
+    return sizes, starts, ends
+
+def run_times(stop_times, trip_line, n_stops):
+    """Average run times (seconds, departure to next arrival) between
+    consecutive stops, over all trips of a line.
+
+    Requires the stop times, the line of every trip code (-1 for trips to
+    leave out) and the number of stop codes. Returns the sorted pair keys,
+    (line*n_stops + tail)*n_stops + head, and the average time of each pair.
+    """
+    trip = stop_times['trip'].to_numpy()
+    stop = stop_times['stop'].to_numpy().astype(np.int64)
+    arrival = stop_times['arrival'].to_numpy()
+    departure = stop_times['departure'].to_numpy()
+    departure = np.where(departure < 0, arrival, departure)
+
+    line = trip_line[trip[:-1]].astype(np.int64)
+    seconds = arrival[1:] - departure[:-1]
+    valid = ((trip[1:] == trip[:-1]) & (line >= 0) & (arrival[1:] >= 0) &
+             (departure[:-1] >= 0))
+    keys = (line[valid]*n_stops + stop[:-1][valid])*n_stops + stop[1:][valid]
+    keys, pair = np.unique(keys, return_inverse=True)
+    totals = np.bincount(pair, seconds[valid], len(keys))
+    return keys, totals/np.maximum(np.bincount(pair, minlength=len(keys)), 1)
+
+def headways(starts, lines, n_lines, windows=headway_windows):
+    """Average headways (seconds) of the lines in every time window.
+
+    Requires the first departures of the trips (seconds), their lines and the
+    number of lines. The departures of each line are sorted per window and
+    the headway is the mean of their differences; NaN where a line departs
+    less than twice in a window. Returns the headways and the number of
+    departures, both as (n_lines, n_windows) arrays.
+    """
+    bounds = np.asarray(windows, dtype=np.int64)*3600
+    n_windows = len(bounds) - 1
+    window = np.clip(np.searchsorted(bounds, starts, side='right') - 1, 0,
+                     n_windows - 1)
+    group = np.asarray(lines, dtype=np.int64)*n_windows + window
+    order = np.lexsort((starts, group))
+    group = group[order]
+    starts = np.asarray(starts)[order]
+
+    same = group[1:] == group[:-1]
+    size = n_lines*n_windows
+    gaps = np.bincount(group[1:][same], np.diff(starts)[same], size)
+    n_gaps = np.bincount(group[1:][same], minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        headway = np.where(n_gaps > 0, gaps/n_gaps, np.nan)
+    departures = np.bincount(group, minlength=size)
+    return (headway.reshape(n_lines, n_windows),
+            departures.reshape(n_lines, n_windows))
+
+def fleet_sizes(durations, routes, headway):
+    """Cycle times (seconds) and implied fleet sizes of the lines.
+
+    Requires the mean trip duration and the route of every line, and the
+    headways per window (see headways). Every direction of a route is a line
+    of its own, so the cycle time of a line is its own duration plus the mean
+    duration of the other directions of its route, or twice its own if it has
+    none. The fleet is the cycle time over the peak (shortest) headway,
+    rounded up, and at least 1.
+    """
+    routes = pd.Series(np.asarray(routes))
+    total = pd.Series(durations).groupby(routes).transform('sum').to_numpy()
+    count = routes.groupby(routes).transform('size').to_numpy()
+    others = np.where(count > 1, (total - durations)/np.maximum(count - 1, 1),
+                      durations)
+    cycles = durations + others
+
+    peak = np.full(len(durations), np.nan)
+    finite = np.isfinite(headway).any(axis=1)
+    peak[finite] = np.nanmin(headway[finite], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fleets = np.ceil(cycles/peak - 1e-9)
+    fleets = np.where(np.isfinite(fleets), np.maximum(fleets, 1), 1)
+    return cycles, fleets.astype(np.int64)
+
+# -------------------------------------------------------------------------------------------------
+def _decimal_comma(values):
+    # Format coordinates the way busstops.csv stores them
+    return [str(v).replace('.', ',') for v in np.round(values, 6)]
+
+def gtfs_extract(feed, stop_output, route_times_output, route_output,
+                 bbox=None, agencies=None, date=None,
+                 route_types=(bus_route_type,), chunksize=chunk_rows,
+                 headway_output=None, windows=headway_windows):
+    """Extracts the pipeline's raw input files from a GTFS feed.
+
+    Requires the feed (zip or folder) and the output file names for the
+    busstops.csv, route_times.csv and routes.csv equivalents. Accepts optional
+    filters: a bounding box (lat min, lat max, lng min, lng max), a list of
+    agency IDs, a service date (YYYYMMDD) and the route types to keep, and
+    the name of a file to write the headways per time window to.
+
+    Every (route, direction) pair becomes one line, as in routes.csv. Its stop
+    sequence is that of its longest trip on the service date, with the
+    average run times of all its trips between those stops; the frequency
+    column holds the average number of departures per hour over the service
+    span of the line, and starttime the minute past the hour of its first
+    departure. The fleet and circuit (cycle time, minutes) columns hold the
+    timetable fleet of the line (see fleet_sizes), which transit_finalization
+    uses instead of the frequency. Stop names are made unique, since
+    stop_processing matches stops by name. The GTFS stop, route and direction
+    IDs are kept in extra columns, for preprocessing.transfer_processing.
+    """
+    routes = select_routes(feed, agencies, route_types)
+    stops = select_stops(feed, bbox, chunksize)
+    services = active_services(feed, date, chunksize) if date else None
+    trips = select_trips(feed, routes['route_id'], services, chunksize)
+    stop_times = select_stop_times(feed, trips['trip_id'], stops['stop_id'],
+                                   chunksize)
+
+    # Per trip: number of stops, first departure and last arrival. Trips that
+    # visit fewer than two retained stops are dropped.
+    sizes, starts, ends = trip_times(stop_times, len(trips))
+    trips['code'] = np.arange(len(trips))
+    trips['stops'] = sizes
+    trips['start'] = starts
+    trips['end'] = ends
+    trips = trips[trips['stops'] > 1]
+    trips = trips.merge(routes[['route_id', 'route_short_name']], on='route_id')
+
+    # Lines in (route, direction) order; the representative trip of each is
+    # its longest, then earliest
+    trips = trips.sort_values(['route_id', 'direction_id', 'stops', 'start'],
+                              ascending=[True, True, False, True],
+                              kind='stable')
+    trips['line'] = trips.groupby(['route_id', 'direction_id'],
+                                  sort=False).ngroup()
+    representative = trips.groupby('line', sort=False).head(1)
+    n_lines = len(representative)
+    trip_line = np.full(len(sizes), -1, dtype=np.int64)
+    trip_line[trips['code'].to_numpy()] = trips['line'].to_numpy()
+
+    # Timetable analysis
+    line = trips['line'].to_numpy()
+    start = trips['start'].to_numpy()
+    span = trips.groupby('line')['start'].agg(['min', 'max', 'size'])
+    first, last, departures = (span[c].to_numpy() for c in span.columns)
+    durations = np.bincount(line, trips['end'].to_numpy() - start,
+                            n_lines)/np.maximum(departures, 1)
+    headway, window_departures = headways(start, line, n_lines, windows)
+    cycles, fleets = fleet_sizes(durations, representative['route_id'],
+                                 headway)
+    pair_keys, pair_times = run_times(stop_times, trip_line, len(stops))
+
+    # Unique stop names for the retained stops that are actually served
+    kept = trip_line[stop_times['trip'].to_numpy()] >= 0
+    served = np.zeros(len(stops), dtype=bool)
+    served[stop_times['stop'].to_numpy()[kept]] = True
+    served = stops[served].reset_index(drop=True)
+    names = served['stop_name'].fillna('').astype(str)
+    duplicate = names.duplicated(keep=False)
+    code = served['stop_code'] if 'stop_code' in served else served['stop_id']
+    names = names.where(~duplicate, names+" ("+code.astype(str)+")")
+    stop_names = np.full(len(stops), '', dtype=object)
+    stop_names[pd.Index(stops['stop_id']).get_indexer(served['stop_id'])] = \
+        names.to_numpy()
+
+    pd.DataFrame({'ID': np.arange(1, len(served)+1),
+                  'Halte': names,
+                  'lat': _decimal_comma(served['stop_lat']),
+                  'lng': _decimal_comma(served['stop_lon']),
+                  'stop_id': served['stop_id']}
+                 ).to_csv(stop_output, sep=';', index=False,
+                          encoding='utf-8-sig')
+
+    # One row per stop of each representative trip, in line order
+    line_names = (representative['route_short_name'].astype(str)+" - "+
+                  representative['trip_headsign'].astype(str)).to_numpy()
+    is_representative = np.zeros(len(sizes), dtype=bool)
+    is_representative[representative['code'].to_numpy()] = True
+    rows = stop_times[is_representative[stop_times['trip'].to_numpy()]]
+    row_line = trip_line[rows['trip'].to_numpy()]
+    order = np.argsort(row_line, kind='stable')
+    row_line = row_line[order]
+    row_stop = rows['stop'].to_numpy().astype(np.int64)[order]
+    same = row_line[1:] == row_line[:-1]
+    keys = (row_line[:-1]*len(stops) + row_stop[:-1])*len(stops) + row_stop[1:]
+    seconds = pd.Series(pair_times, index=pair_keys).reindex(keys).fillna(0)
+    seconds = np.where(same, seconds.to_numpy(), 0)
+    minutes = np.append(np.round(seconds/60, run_time_decimals),
+                        0)[:len(row_line)]
+    pd.DataFrame({'route_ID': row_line + 1,
+                  'name': line_names[row_line],
+                  'bus_stop': stop_names[row_stop],
+                  'traveltime to next stop': minutes}
+                 ).to_csv(route_times_output, sep=';', index=False,
+                          encoding='utf-8-sig')
+
+    hours = np.maximum((last - first)/3600, 1.0)
+    pd.DataFrame({'ID': np.arange(1, n_lines+1),
+                  'name': line_names,
+                  'frequency': np.maximum(np.round(departures/hours), 1
+                                          ).astype(np.int64),
+                  'starttime': (first // 60) % 60,
+                  'number': representative['route_short_name'].to_numpy(),
+                  'direction': representative['trip_headsign'].to_numpy(),
+                  'fleet': fleets,
+                  'circuit': np.round(cycles/60, run_time_decimals),
+                  'route_id': representative['route_id'].to_numpy(),
+                  'direction_id': representative['direction_id'].to_numpy()}
+                 ).to_csv(route_output, sep=';', index=False,
+                          encoding='utf-8-sig')
+
+    if headway_output is not None:
+        n_windows = len(windows) - 1
+        pd.DataFrame({'route_ID': np.repeat(np.arange(1, n_lines+1), n_windows),
+                      'name': np.repeat(line_names, n_windows),
+                      'from': np.tile(windows[:-1], n_lines),
+                      'to': np.tile(windows[1:], n_lines),
+                      'departures': window_departures.ravel(),
+                      'headway': np.round(headway.ravel()/60, run_time_decimals)}
+                     ).to_csv(headway_output, sep=';', index=False,
+                              encoding='utf-8-sig')
+
+    print("Extracted "+str(len(served))+" stops and "+str(n_lines)+
+          " lines from "+str(len(stop_times))+" stop times.")
@@ -5,50 +5,39 @@ import matplotlib.pyplot as plt
 import os
 import networkx as nx
 
+import loaders
+
 """ Program that can make illustrations of the multiple graphs 
 and maps
 """
 
+# Achtergrondkaarten en hun extent [lng_min, lng_max, lat_min, lat_max]
+kaart_pc4 = "Images/pc4_cropped.png"
+extent_pc4 = [4.435435, 4.550754, 52.116441, 52.18667]
+kaart_leiden = "Images/Gemeente_Leiden.png"
+extent_leiden = [4.42753, 4.53527, 52.11850, 52.18488]
+
 
 # Bushaltes -----------------------------------------------------------------------
 class Bushalte:
-    instanties = []
+    __slots__ = ("naam", "ID", "lijnen", "plek")
     
     def __init__(self, x: float, y: float, name: str, id: int):
         self.naam = name
         self.ID = id
         self.lijnen = [] # buslijnen appenden bij het maken van de lijn
         self.plek = (x,y)
-        Bushalte.instanties.append(self)
     
     def __str__(self):
         return f"{self.naam}"
     
     def __repr__(self):  
         return self.__str__()
-
-def zoek_bushalte(id: int) -> Bushalte:
-    #plek = alle_bushaltes[naam]
-    #halte = arr[plek[0], plek[1]]
-    halte = next((obj for obj in Bushalte.instanties if obj.ID == id), None)
-    return halte
-
-def maak_bushalte(x: float, y: float, naam: str, id: int):
-    halte = Bushalte(x, y, naam, id)
-
-# CSV bestand voor plaatsen van bushaltes importeren
-def import_haltes():
-    df = pd.read_csv("Rawdata/busstops.csv", sep=';')
-    for i, row in df.iterrows():
-        maak_bushalte(float(row['lng'].replace(",", ".")), 
-                        float(row['lat'].replace(",", ".")),
-                        row['Halte'],
-                        row['ID'])
                     
 
 # Buslijnen -----------------------------------------------------------------------
 class Buslijn:
-    instanties = []
+    __slots__ = ("naam", "id", "haltes", "color")
 
     def __init__(self, ID: int, name: str, haltes: dict): 
         'Old functionality: , frequentie: int, starttijd: int'
@@ -60,7 +49,6 @@ class Buslijn:
         '''
         self.haltes = haltes
         self.color = tuple(np.random.random(size=3))
-        Buslijn.instanties.append(self)
 
     def __str__(self):
         return self.naam
@@ -78,6 +66,51 @@ class Buslijn:
         return volg
 
 
+# Netwerk -------------------------------------------------------------------------
+class Netwerk:
+    """ Register van de bushaltes en buslijnen van één netwerk, op ID.
+    Meerdere netwerken kunnen naast elkaar bestaan en worden opgeruimd
+    zodra ze niet meer gebruikt worden.
+    """
+    __slots__ = ("haltes", "lijnen")
+
+    def __init__(self):
+        self.haltes = {} # ID : Bushalte
+        self.lijnen = {} # ID : Buslijn
+
+    def __len__(self):
+        return len(self.haltes)
+
+    def zoek_bushalte(self, id: int) -> Bushalte:
+        return self.haltes.get(id)
+
+    def maak_bushalte(self, x: float, y: float, naam: str, id: int) -> Bushalte:
+        halte = Bushalte(x, y, naam, id)
+        self.haltes[id] = halte
+        return halte
+
+    def maak_buslijn(self, ID: int, naam: str, haltes: dict) -> Buslijn:
+        lijn = Buslijn(ID, naam, haltes)
+        self.lijnen[ID] = lijn
+        for halteID in haltes:
+            self.haltes[halteID].lijnen.append(lijn)
+        return lijn
+
+def zoek_bushalte(netwerk: Netwerk, id: int) -> Bushalte:
+    return netwerk.zoek_bushalte(id)
+
+def maak_bushalte(netwerk: Netwerk, x: float, y: float, naam: str, id: int):
+    return netwerk.maak_bushalte(x, y, naam, id)
+
+# CSV bestand voor plaatsen van bushaltes importeren
+def import_haltes(netwerk: Netwerk, bestand="RawData/busstops.csv") -> Netwerk:
+    df = loaders.load_stops(bestand)
+    for plek, naam, id in zip(loaders.coords(df, ("lng", "lat")).tolist(),
+                              df['Halte'].tolist(), df['ID'].tolist()):
+        netwerk.maak_bushalte(plek[0], plek[1], naam, id)
+    return netwerk
+
+
 def import_busrit(csv_bestand, naam_buslijn: str) -> dict:
     # CSV bestand voor rit van één buslijn importeren
     haltes = {}
@@ -88,22 +121,18 @@ def import_busrit(csv_bestand, naam_buslijn: str) -> dict:
             haltes[row.Bushalte] = row.TijdTotVolgende
     return haltes
 
-def import_lijnen(csv_bestand):
+def import_lijnen(netwerk: Netwerk, csv_bestand,
+                  lijnen_bestand="RawData/routes.csv") -> Netwerk:
     # CSV bestand met alle buslijnen importeren
-    routes = {}
-    routes_df = pd.read_csv(csv_bestand)
-    for i, row in routes_df.iterrows():
-        if row['route_ID'] not in routes.keys():
-            routes[row['route_ID']] = {}
-        routes[row['route_ID']][row['StopID']] =row['traveltime to next stop']
-
-    lijnen_df = pd.read_csv("Rawdata/routes.csv", sep=';')
-    for i, row in lijnen_df.iterrows():
-        ID = row['ID']
-        lijn = Buslijn(ID, row['name'], routes[ID])
-        for halteID in routes[ID].keys(): 
-            halte = zoek_bushalte(halteID)
-            halte.lijnen.append(lijn)
+    routes_df = loaders.load_stop_times(csv_bestand)
+    routes = {ID: dict(zip(groep['StopID'].tolist(),
+                           groep['traveltime to next stop'].tolist()))
+              for ID, groep in routes_df.groupby('route_ID', sort=False)}
+
+    lijnen_df = loaders.load_routes(lijnen_bestand)
+    for ID, naam in zip(lijnen_df['ID'].tolist(), lijnen_df['name'].tolist()):
+        netwerk.maak_buslijn(ID, naam, routes[ID])
+    return netwerk
 
 # -------------------------------------------------------------------------------------------------
 def get_coords(file: str) -> list:
@@ -115,13 +144,7 @@ def get_coords(file: str) -> list:
         print(f"{file} is not a csv file!")
         return -1
     
-    coords = []
-    df = pd.read_csv(file, sep=';')
-    for i, row in df.iterrows():
-        coords.append([float(row['lng'].replace(",", ".")), 
-                       float(row['lat'].replace(",", "."))])
-    
-    return coords
+    return loaders.load_coords(file)[:, ::-1].tolist()
 
 def get_coords_csv(file: str) -> list:
     """ Converts csv file to list of coordinates, needs csv file
@@ -132,13 +155,7 @@ def get_coords_csv(file: str) -> list:
         print(f"{file} is not a csv file!")
         return -1
     
-    coords = []
-    df = pd.read_csv(file)
-    for i, row in df.iterrows():
-        coords.append([float(row['lng']), 
-                       float(row['lat'])])
-    
-    return coords
+    return loaders.load_coords(file, sep=',', decimal='.')[:, ::-1].tolist()
 
 # -------------------------------------------------------------------------------------------------
 def forceAspect(ax,aspect=1):
@@ -146,6 +163,26 @@ def forceAspect(ax,aspect=1):
     extent =  im[0].get_extent()
     ax.set_aspect(abs((extent[1]-extent[0])/(extent[3]-extent[2]))/aspect)
 
+def teken_achtergrond(ax, img, extent: list, begrens=False):
+    """ Draws a background map with the given [lng_min, lng_max, lat_min,
+    lat_max] extent, optionally limiting the axes to it
+    """
+    if begrens:
+        ax.set_xlim(extent[:2])
+        ax.set_ylim(extent[2:])
+    ax.imshow(img, extent=extent)
+    forceAspect(ax)
+
+def teken_voronoi(ax, coords):
+    """ Draws the voronoi diagram of a list/array of [lng, lat] points"""
+    vor = Voronoi(np.asarray(coords))
+    voronoi_plot_2d(vor, point_size=10, ax=ax, show_vertices =False)
+
+def teken_punten(ax, coords, **kwargs):
+    """ Draws a list/array of [lng, lat] points"""
+    points = np.asarray(coords)
+    ax.scatter(points[:, 0], points[:, 1], **kwargs)
+
 # -------------------------------------------------------------------------------------------------
 def draw_voronoi():
     """ Draws a voronoi diagram on a map of Leiden. Busstops are used as 'weightpoints' in diagram.
@@ -153,95 +190,140 @@ def draw_voronoi():
     """
     busstop_coords = get_coords("RawData/busstops.csv")
     
-    img = plt.imread('Images/pc4_cropped.png')
+    img = plt.imread(kaart_pc4)
     fig, ax = plt.subplots()
-    ax.imshow(img, extent=[4.435435, 4.550754, 52.116441, 52.18667])
-    forceAspect(ax)
-
-    points = np.array(busstop_coords)
-    vor = Voronoi(points)
-    voronoi_plot_2d(vor, point_size=10, ax=ax, show_vertices =False)
+    teken_achtergrond(ax, img, extent_pc4)
+    teken_voronoi(ax, busstop_coords)
     plt.show()
 
 def draw_gp():
     """ Draws the locations of the different GP practices on a map of Leiden"""
     health_coords = get_coords_csv("Intermediate/healthdata.csv")
-    img = plt.imread("Images/Gemeente_Leiden.png")
+    img = plt.imread(kaart_leiden)
     fig, ax = plt.subplots()
-    ax.set_xlim([4.42753, 4.53527])
-    ax.set_ylim([52.11850, 52.18488])
-    ax.imshow(img, extent=[4.42753, 4.53527, 52.11850, 52.18488])
-    forceAspect(ax)
-    
-    
-
-    points = np.array(health_coords)
-    ax.scatter(points[:, 0], points[:, 1])
+    teken_achtergrond(ax, img, extent_leiden, begrens=True)
+    teken_punten(ax, health_coords)
     plt.show()
 
 # -------------------------------------------------------------------------------------------------
-def make_graph() -> nx.Graph:
+def make_graph(netwerk: Netwerk) -> nx.Graph:
     G = nx.MultiDiGraph() # Directed graph, allowing multiple arrows between vertices
-    for h in Bushalte.instanties:
-        G.add_node(h, name=h.naam)
-    for lijn in Buslijn.instanties:
-        halte_namen = list(lijn.haltes.keys()) 
-        a = zoek_bushalte(halte_namen[0])
-        for i in range(1, len(halte_namen)):
-            b = zoek_bushalte(halte_namen[i])
-            gewicht = lijn.haltes[halte_namen[i-1]]
-            G.add_edge(a, b, weight= gewicht, color=lijn.color)
-            a = b
+    G.add_nodes_from((h, {"name": h.naam}) for h in netwerk.haltes.values())
+    haltes = netwerk.haltes
+    for lijn in netwerk.lijnen.values():
+        halte_ids = list(lijn.haltes.keys())
+        gewichten = list(lijn.haltes.values())
+        G.add_edges_from((haltes[a], haltes[b], {"weight": gewicht,
+                                                 "color": lijn.color})
+                         for a, b, gewicht in zip(halte_ids, halte_ids[1:],
+                                                  gewichten))
 
-    
     return G
 
 # -------------------------------------------------------------------------------------------------
 def teken_graaf(G: nx.Graph, naam: str):
     # Draw background
-    node_pos = {}
-    for h in Bushalte.instanties: node_pos.update({h : (h.plek[0], h.plek[1])})
-
-    img = plt.imread('Images/pc4_cropped.png')
+    img = plt.imread(kaart_pc4)
     fig, ax = plt.subplots()
-    ax.imshow(img, extent=[4.435435, 4.550754, 52.116441, 52.18667]) 
-    forceAspect(ax)
-    
+    teken_achtergrond(ax, img, extent_pc4)
+    teken_lijnen(ax, G)
+    plt.savefig(naam + ".png")
+
+def teken_lijnen(ax, G: nx.Graph, randen="collectie"):
+    """ Draws the stops and the (curved) bus line edges of a graph made by
+    make_graph. Parallel edges curve further out (arc3, rad=0.2*(key+1)).
+
+    With randen="collectie" all edges are drawn as one LineCollection (see
+    teken_randen); randen="patches" draws one FancyArrowPatch per edge
+    through networkx, which is slow for large graphs.
+    """
+    node_pos = {h : (h.plek[0], h.plek[1]) for h in G}
+    node_size = 10
+
+    if randen == "collectie":
+        teken_randen(ax, G, node_pos)
     
     # Teken knopen
-    node_size = 10
     nx.draw_networkx_nodes(G, 
                      pos = node_pos, 
                      node_size = node_size,
-                     node_color='k')
+                     node_color='k',
+                     ax = ax)
+    if randen == "collectie":
+        return
     
-    # Teken randen 
-    edges = list(G.edges(data=True, keys=True))
+    # Teken randen. networkx picks the connection style of a parallel edge
+    # by its index among the edges between the same nodes, i.e. its key
+    keys = [key for u, v, key in G.edges(keys=True)]
     con_style = []
     colors = nx.get_edge_attributes(G, 'color').values()
-    for i, (u, v, key, data) in enumerate(edges):
+    for key in range(max(keys, default=0) + 1):
         offset = 0.2 * (key + 1)
         con_style.append(f"arc3,rad={offset}")
-        #print(f"{(u, v, key)}, Offset: {offset}")
-        #data['connectionstyle'] = f'arc3,rad={offset}'
-        #print(f"{(u, v, key, data['connectionstyle'])}")
     nx.draw_networkx_edges(G, 
                            node_pos, 
                            arrows=True, 
                            edge_color=colors, 
                            connectionstyle=con_style,
                            arrowstyle='-',
-                           node_size= node_size
+                           node_size= node_size,
+                           ax = ax
                             )
-    
-    plt.savefig(naam + ".png")
+
+def boog_punten(begin, eind, rad, verhouding=1.0, punten=16) -> np.ndarray:
+    """ Samples arc3 curves (as matplotlib's connectionstyle "arc3,rad=...")
+    between arrays of begin and end points, returning an (edges, punten, 2)
+    array. The curves bend in screen space, so the y/x display scale
+    verhouding of the axes is needed to get the same shape in data space.
+    """
+    begin = np.asarray(begin, dtype=float)
+    eind = np.asarray(eind, dtype=float)
+    rad = np.asarray(rad, dtype=float)[:, None]
+    midden = (begin + eind) / 2
+    d = eind - begin
+    controle = midden + rad * np.column_stack((d[:, 1] * verhouding,
+                                               -d[:, 0] / verhouding))
+
+    # Quadratic Bezier curve through the control point
+    t = np.linspace(0, 1, punten)[None, :, None]
+    return ((1 - t)**2 * begin[:, None, :] + 2 * (1 - t) * t * controle[:, None, :]
+            + t**2 * eind[:, None, :])
+
+def teken_randen(ax, G: nx.Graph, node_pos: dict, punten=16):
+    """ Draws all edges of a MultiDiGraph as one LineCollection of arc3
+    curves with offset 0.2*(key+1) and the edge 'color' attributes
+    """
+    from matplotlib.collections import LineCollection
+
+    edges = list(G.edges(keys=True, data='color'))
+    if not edges:
+        return None
+    begin = np.array([node_pos[u] for u, v, key, kleur in edges])
+    eind = np.array([node_pos[v] for u, v, key, kleur in edges])
+    rad = 0.2 * (np.array([key for u, v, key, kleur in edges]) + 1)
+    kleuren = [kleur if kleur is not None else 'k' for u, v, key, kleur in edges]
+
+    # Display units per data unit in y over x (1 for equal aspect)
+    aspect = ax.get_aspect()
+    if aspect == "auto":
+        ax.apply_aspect()
+        schaal = ax.transData.transform([[0, 0], [1, 1]])
+        verhouding = (schaal[1, 1] - schaal[0, 1]) / (schaal[1, 0] - schaal[0, 0])
+    else:
+        verhouding = 1.0 if aspect == "equal" else float(aspect)
+
+    collectie = LineCollection(boog_punten(begin, eind, rad, verhouding, punten),
+                               colors=kleuren, linewidths=1.0, zorder=1)
+    ax.add_collection(collectie, autolim=False)
+    return collectie
 
 
 # -------------------------------------------------------------------------------------------------
 def draw_buslines():
-    import_haltes()
-    import_lijnen("Intermediate/stopID_times.csv")
-    G = make_graph()
+    netwerk = Netwerk()
+    import_haltes(netwerk)
+    import_lijnen(netwerk, "Intermediate/stopID_times.csv")
+    G = make_graph(netwerk)
     teken_graaf(G, "Images/buslijnen_pc4")
 
     
@@ -254,4 +336,5 @@ def main():
     draw_gp()
     pass
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
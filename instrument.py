@@ -0,0 +1,160 @@
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+""" Instrumentation of the preprocessing stages.
+
+A stage runs inside stage(), which records its wall time and the peak
+resident memory of the process before and after it, and optionally a cProfile profile and the
+tracemalloc peak. While it runs, the stage and the spatial helpers add
+counters to its record through count(): rows read and written, and pairs
+tested and accepted by the spatial filters. Outside a stage these calls do
+nothing. Long loops report through Progress, which prints at most once per
+progress_interval seconds. pipeline.py runs every stage this way and writes
+the records to a JSON run report.
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+progress_interval = 5.0 # minimum seconds between progress lines
+profile_folder = "Intermediate/profiles" # cProfile output, one file per stage
+
+_current = None # record of the stage running in this process
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+class StageRecord:
+    """Measurements of one stage run."""
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.counters = {}
+        self.start_rss_bytes = None
+        self.max_rss_bytes = None
+        self.traced_peak_bytes = None
+        self.profile = None
+
+    def as_dict(self):
+        return {"name": self.name, "seconds": self.seconds,
+                "counters": dict(self.counters),
+                "start_rss_bytes": self.start_rss_bytes,
+                "max_rss_bytes": self.max_rss_bytes,
+                "traced_peak_bytes": self.traced_peak_bytes,
+                "profile": self.profile}
+
+def max_rss():
+    """Peak resident size of this process so far (bytes), or None where the
+    resource module is not available.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss*1024 # kB except on macOS
+
+@contextlib.contextmanager
+def stage(name, profile=False, trace_memory=False, folder=profile_folder):
+    """Context manager recording a stage run, yields its StageRecord.
+
+    With profile=True the stage is run under cProfile and the statistics are
+    written to <folder>/<name>.prof; with trace_memory=True the peak of the
+    memory traced by tracemalloc is recorded. The peak RSS is that of the
+    whole process, at the start and at the end of the stage: it only belongs
+    to the stage if the end value is higher, or if the process runs nothing
+    else (as in pipeline.py, which gives every stage a fresh worker).
+    """
+    global _current
+    record = StageRecord(name)
+    outer, _current = _current, record
+    tracing = trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if profile else None
+    record.start_rss_bytes = max_rss()
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        record.seconds = time.perf_counter() - start
+        if profiler is not None:
+            os.makedirs(folder, exist_ok=True)
+            record.profile = os.path.join(folder, name+".prof")
+            profiler.dump_stats(record.profile)
+        if tracing:
+            record.traced_peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        record.max_rss_bytes = max_rss()
+        _current = outer
+
+def count(name, n=1):
+    """Adds n to a counter of the running stage, if any."""
+    if _current is not None:
+        _current.counters[name] = _current.counters.get(name, 0) + int(n)
+
+def rows(n_in=0, n_out=0):
+    """Counts rows read and written by the running stage."""
+    count("rows_in", n_in)
+    count("rows_out", n_out)
+
+# -------------------------------------------------------------------------------------------------
+class Progress:
+    """Rate-limited progress of a loop over a known number of items.
+
+    Prints "<label>: done / total" to stderr when at least interval seconds
+    have passed since the last line (or since the start), so short loops
+    print nothing.
+    """
+
+    def __init__(self, total, label, interval=None, stream=None):
+        self.total = total
+        self.label = label
+        self.interval = progress_interval if interval is None else interval
+        self.stream = stream
+        self.done = 0
+        self.last = time.perf_counter()
+
+    def update(self, n=1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            print(self.label+": "+str(self.done)+" / "+str(self.total),
+                  file=self.stream or sys.stderr, flush=True)
+
+def progress(items, label, total=None):
+    """Iterates over items, reporting progress through a Progress."""
+    tracker = Progress(len(items) if total is None else total, label)
+    for item in items:
+        yield item
+        tracker.update()
+
+# -------------------------------------------------------------------------------------------------
+def write_report(records, path, **extra):
+    """Writes stage records (StageRecord or dictionaries) and any extra
+    fields as a JSON run report.
+    """
+    report = dict(extra)
+    report["stages"] = [r.as_dict() if isinstance(r, StageRecord) else r
+                        for r in records]
+    report["seconds"] = sum(r["seconds"] for r in report["stages"])
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
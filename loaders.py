@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+""" Typed loaders for the raw and intermediate csv files.
+
+Each file is read in one pass with its own separator, decimal and thousands
+marks and encoding (the csv files exported from Excel start with a byte order
+mark), so callers get numeric columns directly instead of fixing "52,170112"
+or "11.355" strings row by row. Frames are cached per file and reloaded when
+the file changes; callers get a shallow copy they may add columns to.
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+# read_csv options per file format
+formats = {
+    "stops": {"sep": ';', "decimal": ',', "encoding": 'utf-8-sig',
+              "dtype": {"ID": np.int64, "Halte": str, "stop_id": str}},
+    "population": {"sep": ';', "decimal": ',', "thousands": '.',
+                   "encoding": 'utf-8-sig',
+                   "dtype": {"ID": np.int64, "Inwoners": np.int64}},
+    "raw_facilities": {"sep": ';', "decimal": ',', "encoding": 'utf-8-sig',
+                       "dtype": {"Name": str, "Hoeveelheid artsen": np.int64,
+                                 "Adres": str}},
+    "facilities": {"sep": ',', "encoding": 'utf-8-sig',
+                   "dtype": {"Name": str, "Hoeveelheid artsen": np.int64,
+                             "Adres": str, "lat": np.float64,
+                             "lng": np.float64}},
+    "routes": {"sep": ';', "encoding": 'utf-8-sig',
+               "dtype": {"ID": np.int64, "name": str, "frequency": np.int64,
+                         "number": str, "direction": str, "fleet": np.int64,
+                         "circuit": np.float64, "route_id": str,
+                         "direction_id": str}},
+    "route_times": {"sep": ';', "encoding": 'utf-8-sig',
+                    "dtype": {"route_ID": np.int64, "name": str,
+                              "bus_stop": str}},
+    "stop_times": {"sep": ',', "encoding": 'utf-8-sig',
+                   "dtype": {"route_ID": np.int64, "name": str,
+                             "bus_stop": str, "StopID": np.int64}},
+}
+
+_cache = {} # (format, path) -> (file signature, frame)
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def load(path, kind):
+    """Reads a csv file in one of the known formats, cached per file."""
+    signature = os.stat(path)
+    signature = (signature.st_mtime_ns, signature.st_size)
+    cached = _cache.get((kind, path))
+    if cached is None or cached[0] != signature:
+        frame = pd.read_csv(path, **formats[kind])
+        frame.columns = frame.columns.str.strip()
+        _cache[(kind, path)] = (signature, frame)
+        cached = _cache[(kind, path)]
+    return cached[1].copy(deep=False)
+
+def load_stops(path):
+    """Stop file (busstops.csv): ID, Halte, lat, lng, and stop_id if
+    extracted from GTFS.
+    """
+    return load(path, "stops")
+
+def load_population(path):
+    """Population centers (pc4.csv): ID, lat, lng, Inwoners."""
+    return load(path, "population")
+
+def load_raw_facilities(path):
+    """Facilities before geocoding (healthlocations.csv)."""
+    return load(path, "raw_facilities")
+
+def load_facilities(path):
+    """Geocoded facilities (healthdata.csv): Name, Hoeveelheid artsen, Adres,
+    lat, lng.
+    """
+    return load(path, "facilities")
+
+def load_routes(path):
+    """Lines (routes.csv): ID, name, frequency, starttime, number, direction,
+    and fleet, circuit, route_id and direction_id if extracted from GTFS.
+    """
+    return load(path, "routes")
+
+def load_route_times(path):
+    """Raw line stop sequences (route_times.csv): route_ID, name, bus_stop,
+    traveltime to next stop.
+    """
+    return load(path, "route_times")
+
+def load_stop_times(path):
+    """Line stop sequences with stop IDs (stopID_times.csv), as written by
+    stop_processing.
+    """
+    return load(path, "stop_times")
+
+def load_coords(path, sep=';', decimal=','):
+    """Reads only the lat and lng columns of any csv file, as an (n, 2)
+    (lat, lng) float array.
+    """
+    frame = pd.read_csv(path, sep=sep, decimal=decimal, encoding='utf-8-sig',
+                        usecols=["lat", "lng"], dtype=np.float64)
+    return coords(frame)
+
+def coords(frame, order=("lat", "lng")):
+    """Returns the coordinates of a frame as an (n, 2) float array, in
+    (lat, lng) order unless another column order is given.
+    """
+    return frame[list(order)].to_numpy(dtype=np.float64)
@@ -0,0 +1,167 @@
+import json
+import os
+
+import numpy as np
+
+
+""" Storage of the node and arc tables passed between the preprocessing stages.
+
+A table is a dictionary of equally long numpy columns, in file column order.
+It is stored either as the tab separated text the solver reads (any path
+ending in ".txt") or as a columnar store: a folder with one .npy file per
+column and a small meta.json, which is read back memory-mapped. The stages
+read and write their node and arc tables through this module, so they can
+pass stores between themselves and render text only once at the end.
+
+Arc times are kept as floats with a flag column marking the ones that were
+integers, so that rendering reproduces the text pipeline exactly ("0" for
+boarding arcs, "0.0" for a zero length walking arc).
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+text_suffix = ".txt"
+meta_file = "meta.json"
+time_flag = "_TimeIsInt" # hidden column flagging integer arc times
+
+# Types of the known columns; any other column is stored as integers
+column_types = {"Name": str, "Time": float}
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def is_text(path):
+    """Whether a path refers to a text table rather than a columnar store."""
+    return str(path).endswith(text_suffix)
+
+def columns(table):
+    """Returns the visible column names of a table."""
+    return [c for c in table if c != time_flag]
+
+def length(table):
+    """Returns the number of rows of a table."""
+    return len(next(iter(table.values()))) if table else 0
+
+def make_table(names, data):
+    """Builds a table from column names and sequences of values.
+
+    Integer and float columns are converted to int64 and float64 arrays. For
+    a Time column the integer flags are derived from the value types, so that
+    a mix of ints and floats renders as it would with str().
+    """
+    table = {}
+    for name, values in zip(names, data):
+        kind = column_types.get(name, int)
+        if kind is float:
+            table[time_flag] = np.array([isinstance(v, (int, np.integer))
+                                         for v in values], dtype=bool)
+            table[name] = np.asarray(values, dtype=np.float64)
+        elif kind is str:
+            table[name] = np.asarray(values, dtype=str)
+        else:
+            table[name] = np.asarray(values, dtype=np.int64)
+    return table
+
+def concat(*tables):
+    """Concatenates tables with the same columns."""
+    tables = [t for t in tables if length(t) > 0] or tables[:1]
+    return {c: np.concatenate([t[c] for t in tables]) for c in tables[0]}
+
+# -------------------------------------------------------------------------------------------------
+def _format_column(table, name):
+    # Text of one column, as the text pipeline would have printed it
+    values = table[name]
+    if name == "Time":
+        ints = table.get(time_flag, np.zeros(len(values), dtype=bool))
+        return [str(int(v)) if i else str(v) for v, i in
+                zip(values.tolist(), ints.tolist())]
+    return [str(v) for v in values.tolist()]
+
+def _parse_time(text):
+    # Float value and integer flag of the Time column text
+    flags = np.array(["." not in t and "e" not in t and "n" not in t
+                      for t in text], dtype=bool)
+    return np.array(text, dtype=np.float64), flags
+
+def render(table, path):
+    """Writes a table as tab separated text with a header line."""
+    names = columns(table)
+    lines = ["\t".join(row) for row in
+             zip(*(_format_column(table, c) for c in names))]
+    with open(path, 'w') as f:
+        f.write("\t".join(names)+"\n")
+        if lines:
+            f.write("\n".join(lines)+"\n")
+
+def parse(path):
+    """Reads a tab separated text table with a header line."""
+    with open(path, 'r') as f:
+        names = f.readline().rstrip('\n').split('\t')
+        rows = [line.rstrip('\n').split('\t') for line in f]
+    rows = [r for r in rows if len(r) == len(names)] # skip blank lines
+    text = list(zip(*rows)) if rows else [()]*len(names)
+
+    table = {}
+    for name, values in zip(names, text):
+        kind = column_types.get(name, int)
+        if kind is float:
+            table[name], table[time_flag] = _parse_time(values)
+        elif kind is str:
+            table[name] = np.array(values, dtype=str)
+        else:
+            table[name] = np.array(values, dtype=np.int64)
+    return table
+
+# -------------------------------------------------------------------------------------------------
+def save_store(table, path):
+    """Writes a table as a columnar store folder."""
+    os.makedirs(path, exist_ok=True)
+    for name in table:
+        np.save(os.path.join(path, name+".npy"), table[name])
+    with open(os.path.join(path, meta_file), 'w') as f:
+        json.dump({"columns": list(table), "rows": length(table)}, f)
+
+def load_store(path, mmap=True):
+    """Reads a columnar store folder, memory-mapped unless mmap is False."""
+    with open(os.path.join(path, meta_file), 'r') as f:
+        meta = json.load(f)
+    mode = 'r' if mmap else None
+    return {name: np.load(os.path.join(path, name+".npy"), mmap_mode=mode)
+            for name in meta["columns"]}
+
+def read_table(path, mmap=True):
+    """Reads a node or arc table from a text file or a columnar store."""
+    if is_text(path):
+        return parse(path)
+    return load_store(path, mmap)
+
+def write_table(path, table):
+    """Writes a node or arc table to a text file or a columnar store."""
+    if is_text(path):
+        render(table, path)
+    else:
+        save_store(table, path)
+
+def append_table(path, table):
+    """Appends rows to an existing node or arc table."""
+    if is_text(path):
+        names = columns(table)
+        with open(path, 'a') as f:
+            for row in zip(*(_format_column(table, c) for c in names)):
+                f.write("\t".join(row)+"\n")
+    else:
+        save_store(concat(load_store(path, mmap=False), table), path)
+
+def table_size(path):
+    """Returns the number of rows and the size in bytes of a stored table."""
+    if is_text(path):
+        with open(path, 'r') as f:
+            rows = sum(1 for line in f) - 1 # skip comment line
+        return rows, os.path.getsize(path)
+    with open(os.path.join(path, meta_file), 'r') as f:
+        rows = json.load(f)["rows"]
+    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return rows, size
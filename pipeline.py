@@ -0,0 +1,393 @@
+import argparse
+import concurrent.futures
+import hashlib
+import inspect
+import json
+import os
+import types
+import time
+
+import gtfs
+import instrument
+import preprocessing as pp
+import timematrix
+
+
+""" Dependency-aware runner for the preprocessing stages.
+
+Every stage declares the files it reads and writes. A stage is skipped when
+the content hashes of its inputs, its arguments and its source code (the
+module of its function and every module of the repository that one imports,
+directly or not) are the same as in the last run and its outputs are still as
+it left them. Stages
+whose dependencies are done run concurrently in a process pool. Run from the
+repository root:
+    python pipeline.py                  run all default stages
+    python pipeline.py network_assemble run a stage and what it depends on
+    python pipeline.py --list           show the stages
+    python pipeline.py --cluster        build the network on stop clusters
+    python pipeline.py --transfers      add the GTFS transfer rules
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+cache_file = ".pipeline_cache.json"
+report_file = "run_report.json" # stage records of the last run, see instrument
+default_jobs = 2 # worker processes for independent stages
+
+
+class Stage:
+    """A preprocessing stage: a function with its arguments, and the files
+    (or columnar store folders) it reads and writes.
+
+    Stages that are not default only run when asked for by name.
+    """
+
+    def __init__(self, name, function, args, inputs, outputs, kwargs=None,
+                 default=True):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.inputs = inputs
+        self.outputs = outputs
+        self.default = default
+
+    def __repr__(self):
+        return self.name
+
+
+stages = [
+    Stage("gtfs_extract", gtfs.gtfs_extract,
+          [pp.gtfs_feed, pp.stop_data, pp.time_data, pp.route_data],
+          [pp.gtfs_feed],
+          [pp.stop_data, pp.time_data, pp.route_data, pp.headway_data],
+          {"bbox": gtfs.leiden_bbox, "agencies": gtfs.leiden_agencies,
+           "date": pp.gtfs_date, "headway_output": pp.headway_data},
+          default=False),
+    Stage("address_to_coords", pp.address_to_coords,
+          [pp.facility_raw, pp.facility_in],
+          [pp.facility_raw], [pp.facility_in], default=False),
+    Stage("stop_processing", pp.stop_processing,
+          [pp.stop_data, pp.time_data, pp.route_times],
+          [pp.stop_data, pp.time_data], [pp.route_times]),
+    Stage("cluster_boarding", pp.cluster_boarding,
+          [pp.stop_data, pp.route_times, pp.cluster_stops, pp.stop_clusters,
+           pp.cluster_times],
+          [pp.stop_data, pp.route_times],
+          [pp.cluster_stops, pp.stop_clusters, pp.cluster_times],
+          default=False),
+    Stage("transit_processing", pp.transit_processing,
+          [pp.stop_data, pp.route_data, pp.route_times, pp.line_nodes_store,
+           pp.transit_arcs_store],
+          [pp.stop_data, pp.route_data, pp.route_times],
+          [pp.line_nodes_store, pp.transit_arcs_store], {"sparse": True}),
+    Stage("transfer_processing", pp.transfer_processing,
+          [pp.gtfs_feed, pp.stop_data, pp.route_data, pp.transit_arcs_store,
+           pp.transfer_arcs_store],
+          [pp.gtfs_feed, pp.stop_data, pp.route_data, pp.transit_arcs_store],
+          [pp.transfer_arcs_store], default=False),
+    Stage("add_walking", pp.add_walking,
+          [pp.stop_data, pp.transit_arcs_store],
+          [pp.stop_data, pp.transit_arcs_store], [pp.line_arcs_store],
+          {"output_file": pp.line_arcs_store}),
+    Stage("network_assemble", pp.network_assemble,
+          [pp.line_nodes_store, pp.line_arcs_store, pp.population_clustered,
+           pp.facility_in, pp.stop_data, pp.network_nodes_store,
+           pp.network_arcs_store],
+          [pp.line_nodes_store, pp.line_arcs_store, pp.population_clustered,
+           pp.facility_in, pp.stop_data],
+          [pp.network_nodes_store, pp.network_arcs_store]),
+    Stage("compact_ids", pp.compact_ids,
+          [pp.network_nodes_store, pp.network_arcs_store, pp.final_node_data,
+           pp.final_arc_data],
+          [pp.network_nodes_store, pp.network_arcs_store],
+          [pp.final_node_data, pp.final_arc_data]),
+    Stage("od_matrix", pp.od_matrix,
+          [pp.final_node_data, pp.population_clustered, pp.facility_in,
+           pp.od_file],
+          [pp.final_node_data, pp.population_clustered, pp.facility_in],
+          [pp.od_file]),
+    Stage("all_times", timematrix.all_times,
+          [pp.final_node_data, pp.final_arc_data, timematrix.all_times_file],
+          [pp.final_node_data, pp.final_arc_data],
+          [timematrix.all_times_file]),
+    Stage("transit_finalization", pp.transit_finalization,
+          [pp.route_data, pp.final_transit_data],
+          [pp.route_data], [pp.final_transit_data]),
+    Stage("misc_files", pp.misc_files,
+          [pp.vehicle_file, pp.oc_file, pp.uc_file, pp.assignment_file,
+           pp.objective_file, pp.problem_file, pp.route_data],
+          [pp.route_data],
+          [pp.vehicle_file, pp.oc_file, pp.uc_file, pp.assignment_file,
+           pp.objective_file, pp.problem_file]),
+]
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def clustered(stage_list=stages):
+    """Returns the stages with stop clustering: cluster_boarding runs by
+    default, and the stages building the network take the clusters and the
+    stop times on cluster IDs in place of the stops and stop times.
+    """
+    swap = {pp.stop_data: pp.cluster_stops, pp.route_times: pp.cluster_times}
+    result = []
+    for stage in stage_list:
+        if stage.name == "cluster_boarding":
+            stage = Stage(stage.name, stage.function, stage.args, stage.inputs,
+                          stage.outputs, stage.kwargs)
+        elif stage.name == "transfer_processing":
+            stage = Stage(stage.name, stage.function, stage.args,
+                          stage.inputs + [pp.stop_clusters], stage.outputs,
+                          dict(stage.kwargs, mapping_file=pp.stop_clusters),
+                          stage.default)
+        elif stage.name in ("transit_processing", "add_walking",
+                            "network_assemble"):
+            stage = Stage(stage.name, stage.function,
+                          [swap.get(a, a) for a in stage.args],
+                          [swap.get(p, p) for p in stage.inputs],
+                          stage.outputs, stage.kwargs, stage.default)
+        result.append(stage)
+    return result
+
+def with_transfers(stage_list=stages):
+    """Returns the stages with the GTFS transfer rules: transfer_processing
+    runs by default, and add_walking extends the line arcs with the transfers
+    in place of the plain line arcs.
+    """
+    swap = {pp.transit_arcs_store: pp.transfer_arcs_store}
+    result = []
+    for stage in stage_list:
+        if stage.name == "transfer_processing":
+            stage = Stage(stage.name, stage.function, stage.args, stage.inputs,
+                          stage.outputs, stage.kwargs)
+        elif stage.name == "add_walking":
+            stage = Stage(stage.name, stage.function,
+                          [swap.get(a, a) for a in stage.args],
+                          [swap.get(p, p) for p in stage.inputs],
+                          stage.outputs, stage.kwargs, stage.default)
+        result.append(stage)
+    return result
+
+def file_hash(path):
+    """Returns the sha256 of a file, or of all files in a folder, or None if
+    the path does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, f) for root, dirs, names in
+                       os.walk(path) for f in names)
+    else:
+        files = [path]
+    for name in files:
+        digest.update(os.path.relpath(name, path).encode())
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def code_modules(module):
+    """Returns the module and the modules of the repository it imports,
+    directly or through each other, sorted by name.
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    found = {}
+    todo = [module]
+    while todo:
+        module = todo.pop()
+        path = getattr(module, '__file__', None)
+        if (module.__name__ in found or path is None or
+                os.path.dirname(os.path.abspath(path)) != folder):
+            continue
+        found[module.__name__] = module
+        todo.extend(v for v in vars(module).values()
+                    if isinstance(v, types.ModuleType))
+    return [found[name] for name in sorted(found)]
+
+def stage_key(stage, input_hashes):
+    """Hash of everything that determines the outputs of a stage, including
+    the source of every module of the repository it depends on (see
+    code_modules), so that edits to the helpers it calls count too.
+    """
+    digest = hashlib.sha256()
+    for module in code_modules(inspect.getmodule(stage.function)):
+        digest.update(module.__name__.encode())
+        digest.update(inspect.getsource(module).encode())
+    digest.update(repr((stage.args, sorted(stage.kwargs.items()))).encode())
+    digest.update(json.dumps(input_hashes, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def dependencies(stage_list):
+    """Returns, per stage name, the names of the stages producing its inputs."""
+    producer = {}
+    for stage in stage_list:
+        for path in stage.outputs:
+            producer[path] = stage.name
+    return {stage.name: sorted({producer[p] for p in stage.inputs
+                                if p in producer and producer[p] != stage.name})
+            for stage in stage_list}
+
+def select(names=None, stage_list=stages):
+    """Returns the stages to run: the named ones (default: all default
+    stages) and the stages they depend on, in declaration order.
+    """
+    by_name = {s.name: s for s in stage_list}
+    if not names:
+        names = [s.name for s in stage_list if s.default]
+    for name in names:
+        if name not in by_name:
+            raise ValueError("Unknown stage: "+str(name))
+    deps = dependencies(stage_list)
+    wanted = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name not in wanted:
+            wanted.add(name)
+            todo.extend(d for d in deps[name] if by_name[d].default or
+                        d in names)
+    return [s for s in stage_list if s.name in wanted]
+
+def _run_stage(stage, profile=False, trace_memory=False):
+    # Worker entry point, returns the record of the stage (see instrument)
+    with instrument.stage(stage.name, profile, trace_memory) as record:
+        stage.function(*stage.args, **stage.kwargs)
+    return record.as_dict()
+
+def run(names=None, force=False, jobs=default_jobs, stage_list=stages,
+        cache_path=cache_file, profile=False, trace_memory=False,
+        report_path=report_file):
+    """Runs the selected stages, skipping the ones that are up to date.
+
+    Accepts the stage names to run (default: all default stages), whether to
+    rerun everything, and the number of worker processes. Returns a list of
+    (stage, status, seconds) with status "ran", "cached" or "failed".
+
+    Accepts whether to profile the stages that run and to trace their memory
+    (see instrument.stage), and the path of the JSON run report with the
+    status and record of every stage (None for no report).
+    """
+    selected = select(names, stage_list)
+    deps = dependencies(selected)
+    cache = {}
+    if os.path.exists(cache_path) and not force:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+
+    results = {}
+    records = {}
+    done = set()
+    running = {}
+    # A fresh worker per stage, as the peak RSS of a process covers its life
+    with concurrent.futures.ProcessPoolExecutor(
+            max(jobs, 1), max_tasks_per_child=1) as pool:
+        while len(done) < len(selected):
+            # Start every stage whose dependencies are done
+            for stage in selected:
+                if (stage.name in done or
+                        stage.name in {n for n, k in running.values()}):
+                    continue
+                if any(d not in done for d in deps[stage.name]):
+                    continue
+                if any(results.get(d, ("", "ran"))[1] == "failed"
+                       for d in deps[stage.name]):
+                    results[stage.name] = (stage, "failed", 0.0)
+                    done.add(stage.name)
+                    continue
+                inputs = {p: file_hash(p) for p in stage.inputs}
+                key = stage_key(stage, inputs)
+                entry = cache.get(stage.name, {})
+                if (entry.get("key") == key and
+                        all(file_hash(p) == entry["outputs"].get(p)
+                            for p in stage.outputs)):
+                    results[stage.name] = (stage, "cached", 0.0)
+                    done.add(stage.name)
+                    continue
+                running[pool.submit(_run_stage, stage, profile,
+                                    trace_memory)] = (stage.name, key)
+
+            if not running:
+                continue
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name, key = running.pop(future)
+                stage = next(s for s in selected if s.name == name)
+                try:
+                    records[name] = future.result()
+                except Exception as error:
+                    print("Stage "+name+" failed: "+repr(error))
+                    results[name] = (stage, "failed", 0.0)
+                    cache.pop(name, None)
+                else:
+                    results[name] = (stage, "ran", records[name]["seconds"])
+                    cache[name] = {"key": key,
+                                   "outputs": {p: file_hash(p)
+                                               for p in stage.outputs}}
+                done.add(name)
+
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f, indent=1)
+    if report_path is not None:
+        instrument.write_report(
+            [dict(records.get(s.name, {"name": s.name, "seconds": 0.0}),
+                  status=results[s.name][1]) for s in selected], report_path,
+            date=time.strftime("%Y-%m-%dT%H:%M:%S"), jobs=jobs)
+    return [results[s.name] for s in selected]
+
+def report(results):
+    """Prints per-stage status and timings."""
+    print(f"{'stage':<22}{'status':<8}{'seconds':>9}")
+    for stage, status, seconds in results:
+        print(f"{stage.name:<22}{status:<8}{seconds:>9.3f}")
+    hits = sum(1 for r in results if r[1] == "cached")
+    print(str(hits)+" / "+str(len(results))+" stages up to date")
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the preprocessing "
+                                     "stages that are out of date.")
+    parser.add_argument("stages", nargs="*", help="stages to run (default: "
+                        "all default stages), with their dependencies")
+    parser.add_argument("--force", action="store_true",
+                        help="rerun stages even if they are up to date")
+    parser.add_argument("--jobs", type=int, default=default_jobs,
+                        help="worker processes for independent stages")
+    parser.add_argument("--cluster", action="store_true",
+                        help="merge nearby stops first, see cluster_boarding")
+    parser.add_argument("--transfers", action="store_true",
+                        help="add the GTFS transfer rules, see "
+                        "transfer_processing")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the stages with cProfile, see "
+                        "instrument.profile_folder")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="record the tracemalloc peak of the stages")
+    parser.add_argument("--report", default=report_file,
+                        help="JSON run report with the stage records")
+    parser.add_argument("--list", action="store_true",
+                        help="list the stages and their dependencies")
+    args = parser.parse_args()
+
+    stage_list = with_transfers() if args.transfers else stages
+    if args.cluster:
+        stage_list = clustered(stage_list)
+    if args.list:
+        deps = dependencies(stage_list)
+        for stage in stage_list:
+            print(stage.name+("" if stage.default else " (optional)")+
+                  ": after "+(", ".join(deps[stage.name]) or "-"))
+        return
+    results = run(args.stages, args.force, args.jobs, stage_list,
+                  profile=args.profile,
+                  trace_memory=args.trace_memory, report_path=args.report)
+    report(results)
+
+
+if __name__ == "__main__":
+    main()
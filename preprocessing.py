@@ -1,8 +1,17 @@
 import numpy as np
 import geopy.distance as gpd
 import pandas as pd
-import requests
-import json
+import hashlib
+import os
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+import geocoding
+import gtfs
+import instrument
+import loaders
+import netstore
+import spatial
 
 
 """ Program to process raw data to usable data.
@@ -22,9 +31,23 @@ stop_data = "RawData/busstops.csv"
 time_data = "RawData/route_times.csv"
 route_data = "RawData/routes.csv"
 route_times = "Intermediate/stopID_times.csv"
+cluster_stops = "Intermediate/clusters.csv" # cluster centroids, busstops.csv format
+stop_clusters = "Intermediate/stop_clusters.csv" # stop ID to cluster ID
+cluster_times = "Intermediate/clusterID_times.csv" # stop times on cluster IDs
+cluster_radius = 0.05 # taxicab distance (km) within which stops are merged
+gtfs_feed = "RawData/gtfs-nl.zip" # full OVapi feed, not included in the repository
+gtfs_date = 20250512 # service date (YYYYMMDD) to extract from the feed
+headway_data = "Intermediate/headways.csv" # GTFS headways per time window
+transfer_mode = "penalty" # "penalty" or "arcs", see transfer_processing
 
 line_nodes = "Intermediate/line_nodes.txt"
 line_arcs = "Intermediate/line_arcs.txt"
+line_nodes_store = "Intermediate/line_nodes" # columnar versions, see netstore
+line_arcs_store = "Intermediate/line_arcs"
+transit_arcs_store = "Intermediate/transit_arcs" # line arcs before walking arcs
+transfer_arcs_store = "Intermediate/transfer_arcs" # with GTFS transfers
+network_nodes_store = "Intermediate/network_nodes" # final network before
+network_arcs_store = "Intermediate/network_arcs" # ID compaction
 
 
 # Output network file parameters
@@ -37,6 +60,8 @@ aid_board = 1 # boarding arc type
 aid_alight = 2 # alighting arc type
 aid_walk = 3 # standard walking arc type
 aid_walk_health = 4 # walking arc type to connect pop centers and facilities
+node_columns = ["ID", "Name", "Type", "Line", "Value"] # node file columns
+arc_columns = ["ID", "Type", "Line", "Tail", "Head", "Time"] # arc file columns
 final_arc_data = "Data/arc_data.txt"
 final_node_data = "Data/node_data.txt"
 final_transit_data = "Data/transit_data.txt"
@@ -74,36 +99,34 @@ assignment_file = "Data/assignment_data.txt"
 objective_file = "Data/objective_data.txt"
 problem_file = "Data/problem_data.txt"
 
+od_file = "Data/od_data.txt" # population center to facility demand
+od_cache = "Intermediate/od_matrix.npz" # dense demand matrix and its input key
+od_decay = "power" # distance decay of the demand, see od_decays
+od_min_time = 1.0 # minutes, floor on walking times in the distance decay
+od_threshold = 0.0 # demand at or below this is left out of od_file
+od_method = "equirectangular" # distance kernel, see spatial.distances
+
 #==============================================================================
 # Functions
 #==============================================================================
 
-def address_to_coords(inputfile, outputfile):
+def address_to_coords(inputfile, outputfile, provider=None,
+                      cache_file=geocoding.cache_file):
     """Uses the MapQuestAPI to get coordinates of locations, based on adress
+
+    Accepts an optional geocoding provider (default: MapQuest with the key in
+    private.json) and the geocoding cache file. Addresses already in the
+    cache are not requested again (see geocoding.geocode).
     """
-    private = json.load(open("private.json", 'r'))
-    api_key = private['MapQuest']
+    if provider is None:
+        provider = geocoding.MapQuestProvider.from_private()
     
-    df = pd.read_csv(inputfile, sep=';')
-    pd.set_option('display.max_rows', None)
+    df = loaders.load_raw_facilities(inputfile)
 
-    for i, row in df.iterrows():
-        apiAddress = str(df.at[i,'Adres'])
-        
-        parameters = {
-            "key": api_key,
-            "location": apiAddress
-        }
-
-        response = requests.get("http://www.mapquestapi.com/geocoding/v1/address", params=parameters)
-        
-        data = response.text
-        dataJ = json.loads(data)['results']
-        lat = (dataJ[0]['locations'][0]['latLng']['lat'])
-        lng = (dataJ[0]['locations'][0]['latLng']['lng'])
-        
-        df.at[i,'lat'] = lat
-        df.at[i,'lng'] = lng
+    coords = geocoding.geocode(df['Adres'].astype(str).tolist(), provider,
+                               geocoding.GeocodeCache(cache_file))
+    df['lat'] = [c[0] for c in coords]
+    df['lng'] = [c[1] for c in coords]
         
     df.to_csv(outputfile, index= False)
 
@@ -112,6 +135,9 @@ def distance(x, y, taxicab=False):
 
     Accepts an optional argument indicating whether to use taxicab distance
     instead of the default Euclidean distance.
+
+    This is the scalar geopy reference; the pipeline itself computes distances
+    in batches with spatial.distances.
     """
 
     if taxicab == False:
@@ -124,7 +150,7 @@ def distance(x, y, taxicab=False):
 
 # -------------------------------------------------------------------------------------------------
 def facility_processing(input_file, output_file):
-    df = pd.read_csv(input_file)
+    df = loaders.load_facilities(input_file)
     df = df[["Name", "lat", "lng"]]
     df.to_csv(output_file, index= False)
 
@@ -133,27 +159,54 @@ def stop_processing(stop_file, raw_times, processed_times):
     """ Adds stop ID's to route time file
     """
     
-    # Make dictionary of stops, "Name" : ID
-    stops = {}
-    stop_df = pd.read_csv(stop_file, sep=';')
-    for i, row in stop_df.iterrows():
-        stops[row['Halte']] = row['ID']
-
-    # Add stop ID to each row of route times
-    df = pd.read_csv(raw_times, sep=';')
-    stop_id = []
-    for i, row in df.iterrows():
-        stop_name = row['bus_stop']
-        stop_id.append(stops[stop_name])
-    
-    df.insert(3, "StopID", stop_id, True)
+    df = loaders.load_route_times(raw_times)
+    df.insert(3, "StopID", stop_ids(loaders.load_stops(stop_file), df), True)
 
     df.to_csv(processed_times, index= False)
+    instrument.rows(len(df), len(df))
     pass
 
+def stop_ids(stop_df, times_df):
+    """Returns the stop ID of every row of a route times frame, looked up by
+    stop name in a stop frame. Raises a KeyError for unknown stops.
+    """
+    # Make index of stops, "Name" : ID
+    stops = pd.Series(stop_df['ID'].to_numpy(), index=stop_df['Halte'])
+    stops = stops[~stops.index.duplicated(keep='last')]
+
+    unknown = ~times_df['bus_stop'].isin(stops.index)
+    if unknown.any():
+        raise KeyError(times_df['bus_stop'][unknown].iloc[0])
+    return stops.reindex(times_df['bus_stop']).to_numpy()
+
+# -------------------------------------------------------------------------------------------------
+def line_arc_frame(stoptimes_frame):
+    """Returns the line arcs of a stop times frame (route_ID, StopID and
+    traveltime columns) as a frame of route, tail, head and time.
+
+    Consecutive stops of the same route form the line arcs; the table is
+    stably sorted by route first, keeping the file order within each route.
+    A repeated (tail, head) pair of a route keeps its first position but the
+    last time.
+    """
+    route_col = stoptimes_frame['route_ID'].to_numpy().astype(np.int64)
+    order = np.argsort(route_col, kind='stable')
+    route_col = route_col[order]
+    stop_col = stoptimes_frame['StopID'].to_numpy()[order]
+    time_col = stoptimes_frame['traveltime to next stop'].to_numpy()[order]
+
+    same = route_col[1:] == route_col[:-1]
+    arc_frame = pd.DataFrame({'route': route_col[:-1][same],
+                              'tail': stop_col[:-1][same],
+                              'head': stop_col[1:][same],
+                              'time': time_col[:-1][same]})
+    arc_key = ['route', 'tail', 'head']
+    arc_frame['time'] = arc_frame.groupby(arc_key, sort=False)['time'].transform('last')
+    return arc_frame.drop_duplicates(arc_key, keep='first')
+
 # -------------------------------------------------------------------------------------------------
 def transit_processing(stop_file, route_file, stop_time_file,
-                       node_output_file, arc_output_file):
+                       node_output_file, arc_output_file, sparse=False):
     """Preprocessing for transit network data.
 
     Requires the following file names (respectively): GTFS stop data, GTFS trip
@@ -164,116 +217,153 @@ def transit_processing(stop_file, route_file, stop_time_file,
     The node and arc output files treat the cluster IDs as the stop node IDs,
     and include the boarding nodes, boarding arcs, alighting arcs, and line
     arcs for each line, along with the correct base travel times.
-    """
 
-    nodenum = -1 # current node ID
-    arcnum = -1 # current arc ID
+    The stop times are processed in a single pass: the table is stably sorted
+    by route, consecutive stop pairs are taken for all routes at once, and the
+    node and arc files are each written in one go. The outputs may be text
+    files or columnar stores (see netstore).
 
-    # Write header for arc file
-    with open(arc_output_file, 'w') as f:
-        print("ID\tType\tLine\tTail\tHead\tTime", file=f)
+    Accepts an optional keyword "sparse". By default every line receives a
+    boarding node, boarding arc and alighting arc at every stop in the
+    network. In sparse mode these are only created for the stops the line
+    actually serves; boarding node IDs stay consecutive. Returns a report
+    comparing the network size against the dense mode (see network_report).
+    """
 
-    # Dictionary linking stop ID to coordinates
-    stops = {}
+    # Stop IDs, building the initial node list. A stop node takes the
+    # largest stop ID seen so far.
+    stop_ids = loaders.load_stops(stop_file)['ID'].to_numpy()
+    stops = dict.fromkeys(stop_ids.tolist())
+    stop_nodes = np.maximum.accumulate(stop_ids) if len(stop_ids) > 0 else stop_ids
+    node_rows = [(u, "Stop"+str(u), nid_stop, -1) for u in stop_nodes.tolist()]
+    nodenum = int(stop_nodes[-1]) if len(stop_nodes) > 0 else -1 # current node ID
 
-    # Read cluster file while writing the initial node file
-    with open(node_output_file, 'w') as fout:
-        print("ID\tName\tType\tLine", file=fout)
-        
-        with open(stop_file, 'r') as fin:
-            i = -1
-            for line in fin:
-                i += 1
-                if i > 0:
-                    # Skip comment line
-                    dum = line.split(sep=';')
-                    stops[int(dum[0])] = [float(dum[2].replace(',', '.')), float(dum[3].replace(',', '.'))]
-                    if int(dum[0]) > nodenum:
-                        nodenum = int(dum[0])
-                    print(str(nodenum)+"\tStop"+str(nodenum)+"\t"+
-                          str(nid_stop)+"\t-1", file=fout)
-    
     # Create list of all routes
-    routes = []
-    with open(route_file, 'r') as f:
-        i = -1
-        for line in f:
-            i += 1
-            if i > 0:
-                # Skip comment line
-                dum = line.split(';')
-                routes.append(int(dum[0]))
-    
-    # Collect stops for each route
-    stoptimes_frame = pd.read_csv(stop_time_file)
+    routes = loaders.load_routes(route_file)['ID'].tolist()
 
-    for r in routes: 
+    # Line arcs of all routes, (u, v) : time
+    stop_times = loaders.load_stop_times(stop_time_file)
+    arc_frame = line_arc_frame(stop_times)
+    route_arcs = {r: (group['tail'].tolist(), group['head'].tolist(),
+                      group['time'].tolist())
+                  for r, group in arc_frame.groupby('route', sort=False)}
 
-        # Initialize dict for each route, stopID: next traveltime
-        # Still needed?
-        route_stops = {}
-        for i, row in stoptimes_frame.iterrows():
-            if (int(row['route_ID']) == r):
-                route_stops[row['StopID']] = row['traveltime to next stop']
-        
-        
-        # Initialize weighted arc list. (u, v) : traveltime
-        arcs = {}
-        u = -1
-        time = -1
-        for i, row in stoptimes_frame.iterrows():
-            if (int(row['route_ID']) == r):
-                v = row['StopID']
-                if (u > -1):
-                    arcs[(u,v)] = time
-                u = v
-                time = row['traveltime to next stop']
-        #print(arcs)
-        
-        # Create boarding nodes and arcs
+    arc_rows = [] # ID, Type, Line, Tail, Head, Time
+    arcnum = -1 # current arc ID
+    for r in instrument.progress(routes, "transit_processing routes"):
+        tails, heads, times = route_arcs.get(r, ([], [], []))
+        if sparse == True:
+            served = set(tails) | set(heads)
+            route_stops = [u for u in stops if u in served]
+        else:
+            route_stops = stops
+
+        # Create boarding nodes
         boarding = {}
-        for u in stops:
-            if(u in boarding) == False:
-                nodenum += 1
-                boarding[u] = nodenum
-
-        # Add boarding nodes to file
-        with open(node_output_file, 'a') as f:
-            for u in boarding:
-                # ID, Name, Type, Line
-                print(str(boarding[u])+"\tStop"+str(u)+"_Route"+str(r)+
-                      "\t"+str(nid_board)+"\t"+str(r), file=f)
-                
-
-        # Add arcs to arc file
-        with open(arc_output_file, 'a') as f:
-            # Line arcs
-            for a in arcs:
-                # ID, Type, Line, Tail, Head, Time
-                arcnum += 1
-                print(str(arcnum)+"\t"+str(aid_line)+"\t"+str(r)+"\t"+
-                      str(boarding[a[0]])+"\t"+str(boarding[a[1]])+"\t"+
-                      str(arcs[a]), file=f)
+        for u in route_stops:
+            nodenum += 1
+            boarding[u] = nodenum
+            node_rows.append((nodenum, "Stop"+str(u)+"_Route"+str(r),
+                              nid_board, r))
 
-            # Boarding arcs
-            for u in stops:
-                arcnum += 1
-                print(str(arcnum)+"\t"+str(aid_board)+"\t"+str(r)+"\t"+
-                      str(u)+"\t"+str(boarding[u])+"\t0", file=f)
+        # Line arcs
+        for u, v, time in zip(tails, heads, times):
+            arcnum += 1
+            arc_rows.append((arcnum, aid_line, r, boarding[u], boarding[v],
+                             time))
 
-            # Alighting arcs
-            for u in stops:
-                arcnum += 1
-                print(str(arcnum)+"\t"+str(aid_alight)+"\t"+str(r)+"\t"+
-                      str(boarding[u])+"\t"+str(u)+"\t0", file=f)
+        # Boarding arcs
+        for u in route_stops:
+            arcnum += 1
+            arc_rows.append((arcnum, aid_board, r, u, boarding[u], 0))
+
+        # Alighting arcs
+        for u in route_stops:
+            arcnum += 1
+            arc_rows.append((arcnum, aid_alight, r, boarding[u], u, 0))
+
+    netstore.write_table(node_output_file, netstore.make_table(
+        node_columns[:4], zip(*node_rows)))
+    netstore.write_table(arc_output_file, netstore.make_table(
+        arc_columns, zip(*arc_rows) if arc_rows else [[]]*len(arc_columns)))
+    instrument.rows(len(stop_ids) + len(routes) + len(stop_times),
+                    len(node_rows) + len(arc_rows))
 
-        print("Done processing route "+str(r))
+    print("Done processing "+str(len(routes))+" routes.")
+
+    # Size of the same network in dense mode, for the report
+    dense_nodes = len(stops)*(len(routes) + 1)
+    dense_arcs = len(arc_frame[arc_frame['route'].isin(routes)]) + \
+        2*len(stops)*len(routes)
+    return network_report(node_output_file, arc_output_file, dense_nodes,
+                          dense_arcs)
+
+# -------------------------------------------------------------------------------------------------
+def network_report(node_file, arc_file, dense_nodes=None, dense_arcs=None):
+    """Reports the size of a network given by a node and an arc file (or
+    columnar store).
+
+    Accepts the optional node and arc counts of the dense version of the same
+    network, in which case the reduction is included. The file sizes of the
+    dense version are estimated from the average line length. Prints the
+    report and returns it as a dictionary.
+    """
+    report = {}
+    for name, file, dense in (("nodes", node_file, dense_nodes),
+                              ("arcs", arc_file, dense_arcs)):
+        count, size = netstore.table_size(file)
+        report[name] = count
+        report[name+"_bytes"] = size
+        if dense is not None:
+            report["dense_"+name] = dense
+            report["dense_"+name+"_bytes"] = int(size/max(count, 1)*dense)
+
+    print("Network: "+str(report["nodes"])+" nodes ("+str(report["nodes_bytes"])+
+          " bytes), "+str(report["arcs"])+" arcs ("+str(report["arcs_bytes"])+
+          " bytes)")
+    if dense_nodes is not None and dense_arcs is not None:
+        print("Dense equivalent: "+str(dense_nodes)+" nodes, "+str(dense_arcs)+
+              " arcs (reduction "+
+              str(round(100*(1 - report["nodes"]/max(dense_nodes, 1)), 1))+
+              "% nodes, "+
+              str(round(100*(1 - report["arcs"]/max(dense_arcs, 1)), 1))+
+              "% arcs)")
+    return report
 
 # -------------------------------------------------------------------------------------------------
-def add_walking(stop_file, arc_file, cutoff = 0.25):
+def compact_ids(input_nodes, input_arcs, output_nodes, output_arcs):
+    """Renumbers a network so that node and arc IDs are consecutive from 0.
+
+    Requires the node and arc files (or columnar stores) to renumber and the
+    output file names, which may be the same files. Nodes are numbered in file order and arc
+    tails and heads are remapped accordingly; arcs are renumbered in file
+    order. All other columns are copied unchanged.
+    """
+    nodes = dict(netstore.read_table(input_nodes, mmap=False))
+    arcs = dict(netstore.read_table(input_arcs, mmap=False))
+
+    # Position of each node ID in the node table
+    node_ids = pd.Index(nodes['ID'])
+    nodes['ID'] = np.arange(len(node_ids), dtype=np.int64)
+    # ID, Type, Line, Tail, Head, Time
+    arcs['ID'] = np.arange(netstore.length(arcs), dtype=np.int64)
+    for end in ('Tail', 'Head'):
+        arcs[end] = node_ids.get_indexer(arcs[end]).astype(np.int64)
+        if (arcs[end] < 0).any():
+            raise ValueError("Arc "+end.lower()+" not found in "+str(input_nodes))
+
+    netstore.write_table(output_nodes, nodes)
+    netstore.write_table(output_arcs, arcs)
+    rows = len(node_ids) + netstore.length(arcs)
+    instrument.rows(rows, rows)
+
+# -------------------------------------------------------------------------------------------------
+def add_walking(stop_file, arc_file, cutoff = 0.25,
+                backend = spatial.default_backend, method = spatial.default_method,
+                stop_index = None, output_file = None):
     """Generates walking arcs between stops.
 
-    Requires the name of the arc file and the stop file.
+    Requires the name of the arc file (or columnar store) and the stop file.
 
     Accepts an optional keyword argument to specify the (taxicab) distance
     cutoff (km), within which walking arcs will be generated.
@@ -285,86 +375,427 @@ def add_walking(stop_file, arc_file, cutoff = 0.25):
     #In order to reduce the number of arcs in densely-packed clusters of stops,
     we prevent arcs from being generated between pairs of stops if the
     quadrangle defined by them contains another stop.
+
+    Accepts an optional keyword "backend" selecting the neighbour search used
+    to find the pairs (see spatial.StopIndex.walking_pairs). "brute" is the
+    original O(n^3) loop and serves as a reference for the indexed backends,
+    which produce the same arcs. The keyword "method" selects the distance
+    kernel (see spatial.distances).
+
+    Accepts an optional prebuilt spatial.StopIndex over the stop file, which
+    is otherwise built here, and an optional output file. By default the
+    walking arcs are appended to the arc file itself; with an output file the
+    arc file is left untouched and the extended table is written there.
     """
-    ids = []
-    coords = []
-    df = pd.read_csv(stop_file, sep=';')
-    for i, row in df.iterrows():
-        ids.append(row['ID'])
-        coords.append((row['lat'].replace(',', '.'), row['lng'].replace(',', '.')))
-
-    # Go through each unique coordinate pair and generate a dictionary of pairs
-    # within the cutoff distance of each other
+    if stop_index is None:
+        stop_index = spatial.StopIndex.from_file(stop_file, method)
+    ids = stop_index.ids
+
+    # Generate a dictionary of all unobstructed pairs within the cutoff
+    # distance of each other
     count = 0
     pairs = {}
-    for i in range(len(coords)):
-        print("Iteration "+str(i+1)+" / "+str(len(coords)))
-
-        for j in range(i):
-            # Calculate pairwise distance
-            dist = distance(coords[i], coords[j], taxicab=True)
-            if dist <= cutoff:
-                keep = True # whether to keep the current pair
-
-                # Define corners of quadrangle as most extreme lat/lon in pair
-                lat_min = min(coords[i][0], coords[j][0])
-                lat_max = max(coords[i][0], coords[j][0])
-                lon_min = min(coords[i][1], coords[j][1])
-                lon_max = max(coords[i][1], coords[j][1])
-
-                # Scan entire stop list for stops within the quadrangle
-                for k in range(len(coords)):
-                    if (k != i) and (k != j):
-                        if ((lat_min <= coords[k][0] <= lat_max) and
-                            (lon_min <= coords[k][1] <= lon_max)):
-                            # Stop found in quadrangle, making pair invalid
-                            keep = False
-                            break
-
-                # If no stops were found in the quadrangle, then we add the
-                # pair along with their walking time to the dictionary
-                if keep == True:
-                    count += 1
-                    pairs[(ids[i], ids[j])] = dist * km_walk_time
-
-    # Use the final pairs dictionary to generate the new arcs and write them to
-    # the arc file
-    with open(arc_file, 'r+') as f:
-        # Count the number of arcs
-        arcnum = -np.inf
-        f.readline()
-        for line in f:
-            li = f.readline().split()
-            if len(li) > 0:
-                # Skip the blank line at the end
-                arcnum = max(arcnum, int(li[0]))
+    for i, j, dist in stop_index.walking_pairs(cutoff, backend):
+        count += 1
+        pairs[(ids[i], ids[j])] = dist * km_walk_time
+
+    # Use the final pairs dictionary to generate the new arcs and append them
+    # to the arc file, numbering them after the largest existing arc ID
+    existing = netstore.read_table(arc_file)['ID']
+    arcnum = int(existing.max()) + 1 if len(existing) > 0 else 0
+    arc_rows = []
+    for p in pairs:
+        # ID, Type, Line, Tail, Head, Time
+        arc_rows.append((arcnum, aid_walk, -1, p[0], p[1], pairs[p]))
         arcnum += 1
-
-        for p in pairs:
-            # ID, Type, Line, Tail, Head, Time
-            print(str(arcnum)+"\t"+str(aid_walk)+"\t-1\t"+str(p[0])+"\t"+
-                  str(p[1])+"\t"+str(pairs[p]), file=f)
-            arcnum += 1
-            print(str(arcnum)+"\t"+str(aid_walk)+"\t-1\t"+str(p[1])+"\t"+
-                  str(p[0])+"\t"+str(pairs[p]), file=f)
-            arcnum += 1
+        arc_rows.append((arcnum, aid_walk, -1, p[1], p[0], pairs[p]))
+        arcnum += 1
+    walking = netstore.make_table(arc_columns, zip(*arc_rows) if arc_rows
+                                  else [[]]*len(arc_columns))
+    if output_file is not None:
+        netstore.write_table(output_file, netstore.concat(
+            netstore.read_table(arc_file), walking))
+    elif len(arc_rows) > 0:
+        netstore.append_table(arc_file, walking)
+    instrument.rows(len(ids), len(arc_rows))
 
     print("Done. Added a total of "+str(count)+" pairs of walking arcs.")
 
 
+# -------------------------------------------------------------------------------------------------
+def transfer_processing(feed, stop_file, route_file, arc_file, output_file,
+                        mapping_file=None, mode=transfer_mode,
+                        chunksize=gtfs.chunk_rows):
+    """Adds the transfer rules of a GTFS feed (transfers.txt) to the line arcs.
+
+    Requires the feed, the stop and route files written by gtfs.gtfs_extract
+    (which keep the GTFS stop, route and direction IDs), the arc file (or
+    columnar store) with the boarding arcs of the lines, and the output file.
+
+    Only the rules between retained stops, for retained routes and trips,
+    are kept (see gtfs.select_transfers). A rule applies to the lines of its
+    trips, else to those of its routes, else to all lines serving its stops.
+    Of the rules for the same stops and lines only the most specific count,
+    so trip level rules collapse into one rule per pair of lines: not
+    possible if all of them are of type 3, otherwise taking their longest
+    minimum transfer time.
+
+    Accepts an optional stop to cluster mapping file (see cluster_boarding)
+    for a network built on stop clusters, and an optional keyword "mode".
+    With "penalty" (the default) the mean transfer time into a line at a stop
+    is added to the boarding arc of the line there, which is where the
+    waiting cost of the line is charged too; it also applies to passengers
+    starting their trip at that stop. With "arcs" every possible transfer
+    between two different stops becomes a walking arc from the boarding node
+    of the first line to the stop of the second, taking the transfer time but
+    at least the walking time between the stops, so the path still passes
+    the boarding arc of the second line. Transfers at one stop get no arc in
+    this mode, as alighting already costs no more. Transfers that are not
+    possible get no arc or penalty, but stay possible by alighting and
+    boarding. The result is checked with check_transfers.
+    """
+    stops = loaders.load_stops(stop_file)
+    routes = loaders.load_routes(route_file)
+    if 'stop_id' not in stops or 'route_id' not in routes:
+        raise ValueError("The stop and route files have no GTFS IDs, see "
+                         "gtfs.gtfs_extract")
+    directions = routes['direction_id'].fillna('')
+    route_ids = pd.Index(routes['route_id'].unique())
+    trips = gtfs.select_trips(feed, route_ids, None, chunksize)
+    rules = gtfs.select_transfers(feed, stops['stop_id'], route_ids,
+                                  trips['trip_id'], chunksize)
+
+    # Line of every trip, route of every line
+    lines = pd.MultiIndex.from_arrays([routes['route_id'], directions])
+    position = lines.get_indexer(pd.MultiIndex.from_arrays(
+        [trips['route_id'], trips['direction_id']]))
+    trip_line = np.where(position >= 0, routes['ID'].to_numpy()[position], -1)
+    line_route = pd.Series(route_ids.get_indexer(routes['route_id']),
+                           index=routes['ID'])
+
+    # Lines serving each stop, with their boarding node and arc
+    arcs = netstore.read_table(arc_file)
+    board = np.flatnonzero(np.asarray(arcs['Type']) == aid_board)
+    served = pd.DataFrame({'stop': np.asarray(arcs['Tail'])[board],
+                           'line': np.asarray(arcs['Line'])[board],
+                           'node': np.asarray(arcs['Head'])[board],
+                           'arc': board})
+
+    # Both ends of every rule, one row per line it applies to
+    stop_ids = stops['ID'].to_numpy()
+    if mapping_file is not None:
+        mapping = pd.read_csv(mapping_file, sep=';')
+        stop_ids = pd.Series(mapping['ClusterID'].to_numpy(),
+                             index=mapping['StopID']).reindex(stop_ids)
+        stop_ids = stop_ids.to_numpy()
+    ends = []
+    for side in ("from", "to"):
+        trip = rules[side+'_trip'].to_numpy()
+        route = rules[side+'_route'].to_numpy()
+        end = pd.DataFrame({'rule': np.arange(len(rules)),
+                            'point': rules[side+'_stop'].to_numpy(),
+                            'stop': stop_ids[rules[side+'_stop'].to_numpy()],
+                            'trip_line': np.where(trip >= 0, trip_line[trip],
+                                                  -1),
+                            'route': route,
+                            'rank': 2*(trip >= 0) + (route >= 0)})
+        end = end.merge(served, on='stop')
+        line = end['line'].to_numpy()
+        keep = (((end['rank'] < 2) | (end['trip_line'] == line)) &
+                ((end['route'] < 0) |
+                 (line_route.reindex(line).to_numpy() == end['route'])))
+        ends.append(end[keep][['rule', 'point', 'stop', 'line', 'node', 'arc',
+                               'rank']])
+    pairs = ends[0].merge(ends[1], on='rule', suffixes=('_from', '_to'))
+    pairs = pairs[(pairs['stop_from'] != pairs['stop_to']) |
+                  (pairs['line_from'] != pairs['line_to'])]
+
+    # Collapse to one rule per pair of boarding nodes, keeping the most
+    # specific rules
+    rule = pairs['rule'].to_numpy()
+    types = rules['transfer_type'].to_numpy()[rule]
+    seconds = rules['min_transfer_time'].fillna(0).to_numpy()[rule]
+    pairs = pairs.assign(rank=pairs['rank_from'] + pairs['rank_to'],
+                         possible=types != 3,
+                         seconds=np.where(types == 2, seconds, 0))
+    key = ['node_from', 'node_to']
+    pairs = pairs[pairs['rank'] == pairs.groupby(key)['rank'].transform('max')]
+    pairs = pairs[pairs['possible']].groupby(key, sort=False).agg(
+        arc=('arc_to', 'first'), seconds=('seconds', 'max'),
+        stop_from=('stop_from', 'first'), stop_to=('stop_to', 'first'),
+        point_from=('point_from', 'first'), point_to=('point_to', 'first')
+        ).reset_index()
+
+    if mode == "penalty":
+        penalty = pairs.groupby('arc')['seconds'].mean()
+        penalty = penalty[penalty > 0]
+        result = {c: np.array(arcs[c]) for c in arcs}
+        result['Time'][penalty.index] += penalty.to_numpy()/60
+        result[netstore.time_flag][penalty.index] = False
+        added = len(penalty)
+    elif mode == "arcs":
+        # One arc per boarding node and stop of the second line; the fastest
+        # transfer to any line there, as the stop node serves all of them
+        pairs = pairs[pairs['stop_from'] != pairs['stop_to']]
+        coords = loaders.coords(stops)
+        walk = spatial.distances(coords[pairs['point_from'].to_numpy()],
+                                 coords[pairs['point_to'].to_numpy()],
+                                 matrix=False)*km_walk_time
+        links = pairs.assign(time=np.maximum(pairs['seconds']/60, walk)).groupby(
+            ['node_from', 'stop_to'], sort=False)['time'].min().reset_index()
+        existing = arcs['ID']
+        arcnum = int(existing.max()) + 1 if len(existing) > 0 else 0
+        transfer = netstore.make_table(arc_columns, [
+            range(arcnum, arcnum + len(links)), [aid_walk]*len(links),
+            [-1]*len(links), links['node_from'].tolist(),
+            links['stop_to'].tolist(), links['time'].tolist()])
+        result = netstore.concat(arcs, transfer)
+        added = len(links)
+    else:
+        raise ValueError("Unknown transfer mode: "+str(mode))
+    check_transfers(arcs, result)
+    netstore.write_table(output_file, result)
+    instrument.rows(len(rules), added)
+
+    print("Done. Collapsed "+str(len(rules))+" transfer rules into "+
+          str(len(pairs))+" line pairs, "+str(added)+" "+
+          ("boarding arcs penalized." if mode == "penalty" else
+           "transfer arcs added."))
+
+def check_transfers(before, after):
+    """Checks that the transfers added to an arc table (see
+    transfer_processing) cost at least as much as alighting and boarding.
+
+    Requires the arc table before and after. Boarding arcs may only become
+    more expensive, and every added arc must be a walking arc from a boarding
+    node to a stop node taking at least the alighting time there, so the
+    boarding arc of the next line (and its waiting cost) stays on the path.
+    Raises a ValueError otherwise.
+    """
+    n = netstore.length(before)
+    types = np.asarray(before['Type'])
+    board = types == aid_board
+    if np.any(np.asarray(after['Time'])[:n][board] <
+              np.asarray(before['Time'])[board]):
+        raise ValueError("A transfer made a boarding arc cheaper")
+
+    alight = types == aid_alight
+    alight_time = pd.Series(np.asarray(before['Time'])[alight],
+                            index=np.asarray(before['Tail'])[alight])
+    alight_time = alight_time.groupby(level=0).min()
+    stop_nodes = set(np.asarray(before['Tail'])[board].tolist())
+    tails = np.asarray(after['Tail'])[n:]
+    times = np.asarray(after['Time'])[n:]
+    if (np.any(np.asarray(after['Type'])[n:] != aid_walk) or
+            not set(np.asarray(after['Head'])[n:].tolist()) <= stop_nodes or
+            np.any(~np.isin(tails, alight_time.index)) or
+            np.any(times < alight_time.reindex(tails).to_numpy())):
+        raise ValueError("A transfer arc bypasses the boarding arc of a line "
+                         "or costs less than alighting")
 
-    pass
+# -------------------------------------------------------------------------------------------------
+def cluster_boarding(stop_file, stop_time_file, cluster_file, mapping_file,
+                     cluster_time_file, radius=cluster_radius, cutoff=0.25,
+                     method=spatial.default_method):
+    """Merges stops within walking distance of each other into clusters.
+
+    Requires the stop file, the stop time file with stop IDs (as written by
+    stop_processing), and output file names for the clusters, the stop to
+    cluster mapping, and the stop times on cluster IDs.
+
+    Accepts an optional keyword "radius", the taxicab distance (km) within
+    which two stops (opposite platforms, station bays) belong to the same
+    cluster. Clusters are the connected components of the graph linking all
+    such pairs, found with the spatial index and scipy's connected components
+    (a union-find). They are numbered consecutively from the smallest stop ID,
+    in the order of their first stop in the stop file, and are written in the
+    busstops.csv format with the name of their first stop and the centroid of
+    their stops, so that the later stages can take them as the stop file.
+
+    In the rewritten stop times, consecutive stops of a route that fall in the
+    same cluster are merged, adding up their travel times.
+
+    Accepts the walking cutoff and distance method of add_walking for the
+    size report. Prints and returns the sizes of the (sparse) transit network
+    before and after clustering.
+    """
+    stop_df = loaders.load_stops(stop_file)
+    stop_ids = stop_df['ID'].to_numpy()
+    coords = loaders.coords(stop_df)
+
+    # Clusters, as connected components of the pairs within the radius
+    i, j, dist = spatial.pairs_within(coords, coords, radius, taxicab=True,
+                                      method=method)
+    pairs = sp.coo_matrix((np.ones(len(i)), (i, j)),
+                          shape=(len(stop_ids), len(stop_ids)))
+    n_clusters, labels = connected_components(pairs, directed=False)
+    first_id = int(stop_ids.min()) if len(stop_ids) > 0 else 0
+    cluster_ids = np.arange(n_clusters) + first_id
+    first = np.unique(labels, return_index=True)[1]
+    size = np.bincount(labels, minlength=n_clusters)
+    clusters = pd.DataFrame({
+        'ID': cluster_ids,
+        'Halte': stop_df['Halte'].to_numpy()[first],
+        'lat': np.bincount(labels, coords[:, 0], n_clusters)/size,
+        'lng': np.bincount(labels, coords[:, 1], n_clusters)/size})
+    clusters.to_csv(cluster_file, sep=';', decimal=',', index=False)
+    pd.DataFrame({'StopID': stop_ids, 'ClusterID': cluster_ids[labels]}
+                 ).to_csv(mapping_file, sep=';', index=False)
+
+    # Stop times on cluster IDs, merging consecutive stops in one cluster
+    times = loaders.load_stop_times(stop_time_file)
+    cluster_of = pd.Series(cluster_ids[labels], index=stop_ids)
+    name_of = pd.Series(clusters['Halte'].to_numpy(), index=cluster_ids)
+    clustered = times.copy()
+    clustered['StopID'] = cluster_of.reindex(times['StopID']).to_numpy()
+    clustered['bus_stop'] = name_of.reindex(clustered['StopID']).to_numpy()
+    route_col = clustered['route_ID'].to_numpy()
+    stop_col = clustered['StopID'].to_numpy()
+    repeat = np.zeros(len(clustered), dtype=bool)
+    repeat[1:] = (route_col[1:] == route_col[:-1]) & (stop_col[1:] == stop_col[:-1])
+    run = np.cumsum(~repeat)
+    time_col = 'traveltime to next stop'
+    clustered[time_col] = clustered.groupby(run)[time_col].transform('sum')
+    clustered = clustered[~repeat]
+    clustered.to_csv(cluster_time_file, index=False)
+    instrument.rows(len(stop_ids) + len(times), n_clusters + len(clustered))
+
+    # Size of the transit network before and after
+    report = {}
+    for name, index, frame in (
+            ("stops", spatial.StopIndex(stop_ids, coords, method), times),
+            ("clusters", spatial.StopIndex(cluster_ids, loaders.coords(clusters),
+                                           method), clustered)):
+        boarding = len(frame[['route_ID', 'StopID']].drop_duplicates())
+        walking = 2*len(index.walking_pairs(cutoff))
+        report[name] = len(index)
+        report[name+"_nodes"] = len(index) + boarding
+        report[name+"_arcs"] = len(line_arc_frame(frame)) + 2*boarding + walking
+    print("Clustered "+str(report["stops"])+" stops into "+
+          str(report["clusters"])+" clusters within "+str(radius)+" km.")
+    print("Transit network: "+str(report["stops_nodes"])+" nodes, "+
+          str(report["stops_arcs"])+" arcs before, "+
+          str(report["clusters_nodes"])+" nodes, "+
+          str(report["clusters_arcs"])+" arcs after clustering")
+    return report
+
+
+# -------------------------------------------------------------------------------------------------
+def file_digest(paths, extra=""):
+    """Returns the sha256 of the contents of files (or of all files in
+    folders) and an extra string.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        names = ([os.path.join(path, f) for f in sorted(os.listdir(path))]
+                 if os.path.isdir(path) else [path])
+        for name in names:
+            with open(name, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+    digest.update(extra.encode())
+    return digest.hexdigest()
+
+def power_decay(times, falloff):
+    """Distance decay t^-falloff, as the gravity metric of the objective."""
+    return times**-falloff
+
+def exponential_decay(times, falloff):
+    """Distance decay exp(-falloff t)."""
+    return np.exp(-falloff*times)
+
+od_decays = {"power": power_decay, "exponential": exponential_decay}
+
+def od_matrix(node_file, pop_file, fac_file, output_file, cache_file=od_cache,
+              falloff=obj_parameters[1], decay=od_decay,
+              threshold=od_threshold, method=od_method):
+    """Builds the population center to facility demand matrix.
+
+    Requires the final node file (for the node IDs), the population center
+    and facility files, and the output file name. Every center distributes
+    its population over the facilities in proportion to their weight (the
+    number of doctors) times the distance decay of the taxicab walking time
+    between them, floored at od_min_time:
+        T_ij = P_i S_j f(t_ij) / sum_k S_k f(t_ik)
+    computed as a single broadcast over the centers x facilities matrix.
+
+    Accepts the cache file, the falloff (by default the Gravity Falloff of
+    obj_parameters), the decay function name (see od_decays), the threshold
+    below which demand is left out of the output, and the distance method
+    (by default the equirectangular kernel, which is accurate enough for
+    demand and much faster than the ellipsoidal one).
+    The dense matrix is kept in the cache file (an .npz) together with a
+    hash of the inputs and parameters, and is only recomputed when those
+    change. The output file lists the remaining pairs by node ID:
+        ID  Origin  Destination  Volume
+    Returns the origin node IDs, the destination node IDs and the matrix.
+    """
+    if decay not in od_decays:
+        raise ValueError("Unknown distance decay: "+str(decay))
+
+    key = file_digest([node_file, pop_file, fac_file],
+                      repr((falloff, decay, od_min_time, method)))
+    cached = None
+    if cache_file is not None and os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            if str(data['key']) == key:
+                cached = {name: data[name] for name in data.files}
+    if cached is not None:
+        origins, destinations, matrix = (cached['origins'],
+                                         cached['destinations'], cached['matrix'])
+    else:
+        # Node IDs of the centers and facilities, in file order
+        nodes = netstore.read_table(node_file)
+        order = np.argsort(nodes['ID'], kind='stable')
+        ids, types = np.asarray(nodes['ID'])[order], np.asarray(nodes['Type'])[order]
+        origins, destinations = ids[types == nid_pop], ids[types == nid_fac]
+
+        pop_df = loaders.load_population(pop_file)
+        fac_df = loaders.load_facilities(fac_file)
+        if len(origins) != len(pop_df) or len(destinations) != len(fac_df):
+            raise ValueError(str(node_file)+" does not match "+str(pop_file)+
+                             " and "+str(fac_file)+", rerun network_assemble")
+        populations = pop_df['Inwoners'].to_numpy(dtype=np.float64)
+        weights = fac_df['Hoeveelheid artsen'].to_numpy(dtype=np.float64)
+
+        times = km_walk_time*spatial.distances(
+            loaders.coords(pop_df), loaders.coords(fac_df), taxicab=True,
+            method=method)
+        attraction = weights[None, :]*od_decays[decay](
+            np.maximum(times, od_min_time), falloff)
+        total = attraction.sum(axis=1, keepdims=True)
+        matrix = populations[:, None]*np.divide(
+            attraction, total, out=np.zeros_like(attraction), where=total > 0)
+
+    # Pairs above the threshold, by node ID. The output is only rewritten if
+    # the matrix, the threshold or the file itself changed.
+    i, j = np.nonzero(matrix > threshold)
+    written = (cached is not None and float(cached['threshold']) == threshold
+               and os.path.exists(output_file) and
+               file_digest([output_file]) == str(cached['output']))
+    if not written:
+        pd.DataFrame({'ID': np.arange(len(i)), 'Origin': origins[i],
+                      'Destination': destinations[j], 'Volume': matrix[i, j]}
+                     ).to_csv(output_file, sep='\t', index=False)
+        if cache_file is not None:
+            os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+            np.savez(cache_file, key=key, origins=origins,
+                     destinations=destinations, matrix=matrix,
+                     threshold=threshold, output=file_digest([output_file]))
+    instrument.rows(len(origins) + len(destinations), len(i))
+    print("Wrote "+str(len(i))+" OD pairs"+(" (cached)" if cached is not None
+                                           else "")+".")
+    return origins, destinations, matrix
 
 
 #TODO ---------------------------------------------------------------------------------------------
-#def cluster_boarding   (need user data)
 #def gamma              (need user data)
-#def all_times          (need user data)
-#def od_matrix          (need user data)
+# all_times: see timematrix.py
 
 # -------------------------------------------------------------------------------------------------
 def network_assemble(input_stop_nodes, input_line_arcs, input_pop_nodes,
-                     input_fac_nodes, input_stops, output_nodes, output_arcs, cutoff=0.25):
+                     input_fac_nodes, input_stops, output_nodes, output_arcs, cutoff=0.25,
+                     method=spatial.default_method, stop_index=None, jobs=1):
     """Assembles most of the intermediate files into the final network files.
 
     Requires the following file names in order:
@@ -386,223 +817,124 @@ def network_assemble(input_stop_nodes, input_line_arcs, input_pop_nodes,
     mostly the same way as the walking arc script, except that each facility
     and population center is guaranteed to receive at least one walking arc,
     which is connected to the nearest stop node if none were within the cutoff.
+
+    Accepts an optional keyword "method" selecting the distance kernel (see
+    spatial.distances), and an optional prebuilt spatial.StopIndex over the
+    stop file, which is otherwise built here. All linking goes through
+    spatial.StopIndex.link, which searches all centers at once. Accepts an
+    optional keyword "jobs" to split the linking over that many worker
+    processes (see spatial.link_parallel); the output does not depend on it.
+
+    The core network inputs and the outputs may be text files or columnar
+    stores (see netstore).
     """
 
-    # Read in lists of stop IDs and coordinates
-    stop_ids = []
-    stop_coords = []
-    stop_df = pd.read_csv(input_stops, sep=';')
-    for i, row in stop_df.iterrows():
-        stop_ids.append(row['ID'])
-        stop_coords.append((float(row['lat'].replace(',', '.')), 
-                            float(row['lng'].replace(',', '.'))))
+    if stop_index is None:
+        stop_index = spatial.StopIndex.from_file(input_stops, method)
+    stop_ids = stop_index.ids
         
-    # Read in dictionaries indexed by population center IDs to contain the
-    # population values, center names, and coordinates
-    pop_names = {}
-    populations = {}
-    pop_coords = {}
-    pop_df = pd.read_csv(input_pop_nodes, sep=';')
-    pop_id = -1
-    for i, row in pop_df.iterrows():
-        pop_id = pop_id + 1
-        populations[pop_id]=int(str(row['Inwoners']).replace('.',''))
-        pop_names[pop_id] = row['ID']
-        pop_coords[pop_id] =((float(row['lat'].replace(',', '.')), 
-                            float(row['lng'].replace(',', '.'))))
-
-    # Go through each population center and generate a dictionary of stop IDs
-    # that should be linked to each center
+    # Read in the population values, center names, and coordinates, indexed
+    # by population center number
+    pop_df = loaders.load_population(input_pop_nodes)
+    populations = pop_df['Inwoners'].tolist()
+    pop_names = dict(enumerate(pop_df['ID'].tolist()))
+    pop_coords = loaders.coords(pop_df)
+
+    # Read in the facility names, coordinates and quality
+    fac_df = loaders.load_facilities(input_fac_nodes)
+    fac_names = fac_df['Name'].tolist()
+    fac_coords = loaders.coords(fac_df)
+    fac_qual = fac_df['Hoeveelheid artsen'].tolist()
+
+    # Link each population center and facility to all unobstructed stops
+    # within the cutoff, growing the cutoff for those that received no links
+    links, radii = spatial.link_parallel(
+        stop_index, np.concatenate([pop_coords, fac_coords]), cutoff, jobs)
+    n_pop = len(pop_coords)
+
     count = 0
     pop_links = {}
     pop_link_times = {}
-    for i in pop_coords:
-        print("Population center "+str(i))
-
-        # Continue searching until we find at least one link to add
-        effective_cutoff = cutoff
-        pop_links[i] = []
-        pop_link_times[i] = []
-        while len(pop_links[i]) == 0:
-
-            for j in range(len(stop_coords)):
-                # Calculate pairwise distance
-                dist = distance(pop_coords[i], stop_coords[j], taxicab=True)
-                if dist <= effective_cutoff:
-                    keep = True # whether to keep the current pair
-
-                    # Define corners of quadrangle
-                    lat_min = min(pop_coords[i][0], stop_coords[j][0])
-                    lat_max = max(pop_coords[i][0], stop_coords[j][0])
-                    lon_min = min(pop_coords[i][1], stop_coords[j][1])
-                    lon_max = max(pop_coords[i][1], stop_coords[j][1])
-
-                    # Scan entire stop list for stops within the quadrangle
-                    for k in range(len(stop_coords)):
-                        if k != j:
-                            if ((lat_min <= stop_coords[k][0] <= lat_max) and
-                                (lon_min <= stop_coords[k][1] <= lon_max)):
-                                # Stop found in quadrangle, making pair invalid
-                                keep = False
-                                break
-
-                    # If no stops were found in the quadrangle, then we add the
-                    # pair along with their walking time to the dictionary
-                    if keep == True:
-                        count += 1
-                        pop_links[i].append(stop_ids[j])
-                        pop_link_times[i].append(dist*km_walk_time)
-
-            # Double the effective cutoff in case the search was unsuccessful
-            # and must be repeated
-            if len(pop_links[i]) == 0:
-                effective_cutoff *= 2
-                print("No links found. Trying again with cutoff "+
-                      str(effective_cutoff))
+    for i, (stops, dist) in enumerate(links[:n_pop]):
+        count += len(stops)
+        pop_links[i] = [stop_ids[j] for j in stops.tolist()]
+        pop_link_times[i] = (dist*km_walk_time).tolist()
+    grown = int((radii[:n_pop] > cutoff).sum())
+    if grown > 0:
+        print(str(grown)+" population centers needed a larger cutoff.")
 
     print("Adding a total of "+str(count)+" population walking arcs.")
 
-    # Read in lists to contain the facility names, coordinates and quality
-    fac_names = []
-    fac_coords = []
-    fac_qual = []
-    fac_df = pd.read_csv(input_fac_nodes)
-    for i, row in fac_df.iterrows():
-        fac_names.append(row['Name'])
-        fac_coords.append((row['lat'], row['lng']))
-        fac_qual.append(row['Hoeveelheid artsen'])
-    
-    # Go through each facility and generate a dictionary of stop IDs that
-    # should be linked to each facility
     count = 0
     fac_links = {}
     fac_link_times = {}
-    for i in range(len(fac_coords)):
-        print("Facility center "+str(i+1)+" / "+str(len(fac_coords)))
-
-        # Continue searching until we find at least one link to add
-        effective_cutoff = cutoff
-        fac_links[i] = []
-        fac_link_times[i] = []
-        while len(fac_links[i]) == 0:
-
-            for j in range(len(stop_coords)):
-                # Calculate pairwise distance
-                dist = distance(fac_coords[i], stop_coords[j], taxicab=True)
-                if dist <= effective_cutoff:
-                    keep = True # whether to keep the current pair
-
-                    # Define corners of quadrangle
-                    lat_min = min(fac_coords[i][0], stop_coords[j][0])
-                    lat_max = max(fac_coords[i][0], stop_coords[j][0])
-                    lon_min = min(fac_coords[i][1], stop_coords[j][1])
-                    lon_max = max(fac_coords[i][1], stop_coords[j][1])
-
-                    # Scan entire stop list for stops within the quadrangle
-                    for k in range(len(stop_coords)):
-                        if k != j:
-                            if ((lat_min <= stop_coords[k][0] <= lat_max) and
-                                (lon_min <= stop_coords[k][1] <= lon_max)):
-                                # Stop found in quadrangle, making pair invalid
-                                keep = False
-                                break
-
-                    # If no stops were found in the quadrangle, then we add the
-                    # pair along with their walking time to the dictionary
-                    if keep == True:
-                        count += 1
-                        fac_links[i].append(stop_ids[j])
-                        fac_link_times[i].append(dist*km_walk_time)
-
-            # Double the effective cutoff in case the search was unsuccessful
-            # and must be repeated
-            if len(fac_links[i]) == 0:
-                effective_cutoff *= 2
-                print("No links found. Trying again with cutoff "+
-                      str(effective_cutoff))
+    for i, (stops, dist) in enumerate(links[n_pop:]):
+        count += len(stops)
+        fac_links[i] = [stop_ids[j] for j in stops.tolist()]
+        fac_link_times[i] = (dist*km_walk_time).tolist()
+    grown = int((radii[n_pop:] > cutoff).sum())
+    if grown > 0:
+        print(str(grown)+" facilities needed a larger cutoff.")
 
     print("Adding a total of "+str(count)+" facility walking arcs.")
 
-     # Write new nodes to final output files
-    with open(output_nodes, 'w') as fout:
-        # Comment line
-        print("ID\tName\tType\tLine\tValue", file=fout)
-
-        # Copy old node file contents
-        with open(input_stop_nodes, 'r') as fin:
-            i = -1
-            nodenum = -1
-            for line in fin:
-                i += 1
-                if i > 0:
-                    # Skip comment line
-                    dum = line.split()
-                    # ID, Name, Type, Line
-                    if int(dum[0]) > nodenum:
-                        nodenum = int(dum[0])
-                    print(dum[0]+"\t"+dum[1]+"\t"+dum[2]+"\t"+dum[3]+"\t-1",
-                          file=fout)
-
-        # Write population center nodes
-        pop_nodes = {}
-        for i in pop_names:
-            nodenum += 1
-            pop_nodes[i] = nodenum
-            print(str(nodenum)+"\t"+str(i)+"_"+str(pop_names[i])+"\t"+
-                  str(nid_pop)+"\t-1\t"+str(populations[i]), file=fout)
-
-        # Write facility nodes
-        fac_nodes = []
-        for i in range(len(fac_names)):
-            nodenum += 1
-            fac_nodes.append(nodenum)
-            print(str(nodenum)+"\t"+str(fac_names[i])+"\t"+str(nid_fac)+
-                  "\t-1\t"+str(fac_qual[i]), file=fout)
-    
-    # Write new arcs to output files
-    with open(output_arcs, 'w') as fout:
-        # Comment line
-        print("ID\tType\tLine\tTail\tHead\tTime", file=fout)
-
-        # Copy old arc file contents
-        with open(input_line_arcs, 'r') as fin:
-            i = -1
-            arcnum = -1
-            for line in fin:
-                i += 1
-                if i > 0:
-                    # Skip comment line
-                    dum = line.split()
-                    # ID, Type, Line, Tail, Head, Time
-                    if int(dum[0]) > arcnum:
-                        arcnum = int(dum[0])
-                    print(line.strip(), file=fout)
-
-        # Write population center walking arcs
-        for i in pop_links:
-            for j in range(len(pop_links[i])):
+    # Copy the core network nodes, adding their values
+    nodes = netstore.read_table(input_stop_nodes)
+    core_nodes = {c: nodes[c] for c in node_columns[:4]}
+    core_nodes['Value'] = np.full(netstore.length(nodes), -1, dtype=np.int64)
+    nodenum = int(nodes['ID'].max()) if len(nodes['ID']) > 0 else -1
+
+    # Population center and facility nodes
+    node_rows = [] # ID, Name, Type, Line, Value
+    pop_nodes = {}
+    for i in pop_names:
+        nodenum += 1
+        pop_nodes[i] = nodenum
+        node_rows.append((nodenum, str(i)+"_"+str(pop_names[i]), nid_pop, -1,
+                          populations[i]))
+    fac_nodes = []
+    for i in range(len(fac_names)):
+        nodenum += 1
+        fac_nodes.append(nodenum)
+        node_rows.append((nodenum, str(fac_names[i]), nid_fac, -1, fac_qual[i]))
+
+    # Copy the core network arcs
+    arcs = netstore.read_table(input_line_arcs)
+    arcnum = int(arcs['ID'].max()) if len(arcs['ID']) > 0 else -1
+
+    # Population center and facility walking arcs
+    arc_rows = [] # ID, Type, Line, Tail, Head, Time
+    for nodes_out, links, link_times in ((pop_nodes, pop_links, pop_link_times),
+                                         (fac_nodes, fac_links, fac_link_times)):
+        for i in links:
+            for j in range(len(links[i])):
                 arcnum += 1
-                print(str(arcnum)+"\t"+str(aid_walk_health)+"\t-1\t"+
-                      str(pop_nodes[i])+"\t"+str(pop_links[i][j])+"\t"+
-                      str(pop_link_times[i][j]), file=fout)
+                arc_rows.append((arcnum, aid_walk_health, -1, nodes_out[i],
+                                 links[i][j], link_times[i][j]))
                 arcnum += 1
-                print(str(arcnum)+"\t"+str(aid_walk_health)+"\t-1\t"+
-                      str(pop_links[i][j])+"\t"+str(pop_nodes[i])+"\t"+
-                      str(pop_link_times[i][j]), file=fout)
+                arc_rows.append((arcnum, aid_walk_health, -1, links[i][j],
+                                 nodes_out[i], link_times[i][j]))
 
-        # Write facility walking arcs
-        for i in fac_links:
-            for j in range(len(fac_links[i])):
-                arcnum += 1
-                print(str(arcnum)+"\t"+str(aid_walk_health)+"\t-1\t"+
-                      str(fac_nodes[i])+"\t"+str(fac_links[i][j])+"\t"+
-                      str(fac_link_times[i][j]), file=fout)
-                arcnum += 1
-                print(str(arcnum)+"\t"+str(aid_walk_health)+"\t-1\t"+
-                      str(fac_links[i][j])+"\t"+str(fac_nodes[i])+"\t"+
-                      str(fac_link_times[i][j]), file=fout)
+    netstore.write_table(output_nodes, netstore.concat(
+        core_nodes, netstore.make_table(node_columns, zip(*node_rows))))
+    netstore.write_table(output_arcs, netstore.concat(
+        arcs, netstore.make_table(arc_columns, zip(*arc_rows))))
+    instrument.rows(n_pop + len(fac_names), len(node_rows) + len(arc_rows))
 
 # -------------------------------------------------------------------------------------------------
+def route_fleets(routes_df):
+    """Returns the fleet and circuit time of every line of a routes frame.
+
+    Lines extracted from a GTFS timetable have fleet and circuit (minutes)
+    columns (see gtfs.gtfs_extract). Otherwise the hand-entered frequency
+    column is the fleet, with a circuit time of 1.
+    """
+    if 'fleet' in routes_df and 'circuit' in routes_df:
+        return (routes_df['fleet'].to_numpy(),
+                routes_df['circuit'].to_numpy())
+    fleets = routes_df['frequency'].to_numpy()
+    return fleets, np.ones(len(fleets), dtype=np.int64)
+
 def transit_finalization(transit_input, transit_output):
     """Converts the intermediate transit data file into the final version.
 
@@ -611,32 +943,36 @@ def transit_finalization(transit_input, transit_output):
 
     Data fields to be added for the final file include boarding fare, upper and
     lower fleet size bounds, and the values of the initial line frequency and
-    capacity.
+    capacity. Fleet and circuit time are taken from the transit data file (see
+    route_fleets).
     """
 
+    routes_df = loaders.load_routes(transit_input)
+    line_type = type_bus
+    ub = finite_infinity
+    vcap = bus_capacity
+    fleets, circuits = route_fleets(routes_df)
+    # Set bounds
+    lbs = np.minimum(2, fleets)
+    # Calculate initial frequency and line capacity
+    freqs = fleets/circuits
+    caps = vcap*freqs*(1440*1)
+
     with open(transit_output, 'w') as fout:
         # Comment line
         print("ID\tName\tType\tFleet\tCircuit\tScaling\tLB\tUB\tFare\t"+
               "Frequency\tCapacity", file=fout)
         
-        routes_df = pd.read_csv(transit_input, sep=';')
-        for i, row in routes_df.iterrows():
-            labels = row['name']
-            line_type = type_bus
-            fleet = row['frequency']
-
-            # Set bounds
-            lb = min(2, fleet)
-            ub = finite_infinity
-            vcap = bus_capacity
-            # Calculate initial frequency and line capacity
-            freq = fleet/1
-            cap = vcap*freq*(1440*1)
-            # Write line
-            print(labels+"\t"+str(line_type)+"\t"+str(fleet)+"\t"+
-                    str(1)+"\t"+str(1)+"\t"+str(lb)+"\t"+
+        for line_id, labels, fleet, circuit, lb, freq, cap in zip(
+                routes_df['ID'].tolist(), routes_df['name'].tolist(),
+                fleets.tolist(), circuits.tolist(), lbs.tolist(),
+                freqs.tolist(), caps.tolist()):
+            # Write line, the ID being the line ID used in the network files
+            print(str(line_id)+"\t"+labels+"\t"+str(line_type)+"\t"+str(fleet)+"\t"+
+                    str(circuit)+"\t"+str(1)+"\t"+str(lb)+"\t"+
                     str(ub)+"\t"+str(1)+"\t"+str(freq)+"\t"+
                     str(cap), file=fout)
+    instrument.rows(len(routes_df), len(routes_df))
 
 # -------------------------------------------------------------------------------------------------
 def misc_files(vehicle_output, operator_output, user_output, assignment_output,
@@ -661,10 +997,9 @@ def misc_files(vehicle_output, operator_output, user_output, assignment_output,
     """
 
     # Read transit data to calculate vehicle totals
-    bus_total = 0
-    routes_df = pd.read_csv(transit_input, sep=';')
-    for i, row in routes_df.iterrows():
-        bus_total += row['frequency']
+    routes_df = loaders.load_routes(transit_input)
+    bus_total = int(route_fleets(routes_df)[0].sum())
+    instrument.rows(len(routes_df))
     print("Total of "+str(bus_total)+" buses")
 
     # Vehicle file
@@ -731,25 +1066,10 @@ def misc_files(vehicle_output, operator_output, user_output, assignment_output,
 
 
 def main():
-    #(un)comment lines based on what needs to be processed-----------------------------------------
-    
-    #address_to_coords(facility_raw, facility_in)
-    
-    #facility_processing(facility_in, facility_out) #redundant
-    
-    #stop_processing(stop_data, time_data, route_times)
-    
-    #transit_processing(stop_data, route_data, route_times, line_nodes, line_arcs)
-    
-    #add_walking(stop_data, line_arcs)
-        
-    #network_assemble(line_nodes, line_arcs, population_clustered, facility_in,
-    #             stop_data, final_node_data, final_arc_data)
-    
-    #transit_finalization(route_data, final_transit_data)
-    
-    #misc_files(vehicle_file, oc_file, uc_file, assignment_file, objective_file, 
-    #           problem_file, route_data)
-    
-    pass
-main()
\ No newline at end of file
+    # The stages, their inputs and outputs are declared in pipeline.py, which
+    # only reruns the stages whose inputs changed since the last run
+    import pipeline
+    pipeline.main()
+
+if __name__ == "__main__":
+    main()
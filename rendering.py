@@ -0,0 +1,198 @@
+import argparse
+import concurrent.futures
+import functools
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.image as mpimg
+import networkx as nx
+import numpy as np
+from matplotlib.figure import Figure
+
+import imaging
+import loaders
+
+
+""" Headless batch rendering of the imaging.py maps.
+
+A figure is described by a FigureSpec (what to draw, on which background, in
+which formats). render() draws a list of specs without pyplot on the Agg
+backend, so it runs without a display, and writes the files to an output
+folder. Decoded background images, coordinate arrays and bus networks are
+cached per process and reused across renders; they are reloaded when their
+files change. Several specs are rendered in parallel by a process pool. Run
+from the repository root:
+    python rendering.py                  render the default figures
+    python rendering.py --format png svg --jobs 4 --output Images/render
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+output_folder = "Images/render"
+default_jobs = os.cpu_count() or 1
+default_formats = ("png",)
+default_size = (6.4, 4.8) # inches
+default_dpi = 100
+
+stop_file = "RawData/busstops.csv"
+facility_file = "Intermediate/healthdata.csv"
+stop_times_file = "Intermediate/stopID_times.csv"
+route_file = "RawData/routes.csv"
+
+# Background name : (image file, [lng_min, lng_max, lat_min, lat_max], limit
+# the axes to the extent)
+backgrounds = {
+    "pc4": (imaging.kaart_pc4, imaging.extent_pc4, False),
+    "leiden": (imaging.kaart_leiden, imaging.extent_leiden, True),
+    None: (None, None, False),
+}
+
+
+class FigureSpec:
+    """A figure to render: a name (the output file name without extension),
+    the kind of figure ("voronoi", "gp" or "buslines"), a background name
+    (see backgrounds), the output formats and figure options.
+
+    Options of the "buslines" figure: "seed" for the random line colors, or
+    "color" to draw every line in one color.
+    """
+
+    def __init__(self, name, kind, background="pc4", formats=default_formats,
+                 options=None, size=default_size, dpi=default_dpi):
+        self.name = name
+        self.kind = kind
+        self.background = background
+        self.formats = tuple(formats)
+        self.options = options or {}
+        self.size = size
+        self.dpi = dpi
+
+    def __repr__(self):
+        return self.name
+
+
+# The map variants kept in Images/
+default_specs = [
+    FigureSpec("voronoi_on_pc4", "voronoi"),
+    FigureSpec("gp_leiden", "gp", background="leiden"),
+    FigureSpec("buslijnen_pc4_random_kleuren", "buslines"),
+    FigureSpec("buslijnen_pc4_zwart", "buslines", options={"color": "k"}),
+]
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def _signature(path):
+    # Cache key of a file, changes when the file does
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+@functools.lru_cache(maxsize=8)
+def _read_image(signature):
+    return mpimg.imread(signature[0])
+
+@functools.lru_cache(maxsize=32)
+def _read_coords(signature, sep, decimal):
+    # [lng, lat] points, read only
+    points = loaders.load_coords(signature[0], sep, decimal)[:, ::-1].copy()
+    points.flags.writeable = False
+    return points
+
+@functools.lru_cache(maxsize=8)
+def _read_network(stops, stop_times, routes, seed):
+    state = np.random.get_state()
+    np.random.seed(seed) # line colors
+    try:
+        netwerk = imaging.Netwerk()
+        imaging.import_haltes(netwerk, stops[0])
+        imaging.import_lijnen(netwerk, stop_times[0], routes[0])
+    finally:
+        np.random.set_state(state)
+    return netwerk
+
+def background_image(path):
+    """Decoded background image, cached."""
+    return _read_image(_signature(path))
+
+def coordinates(path, sep=';', decimal=','):
+    """[lng, lat] points of a csv file (see loaders.load_coords), cached."""
+    return _read_coords(_signature(path), sep, decimal)
+
+def network(seed=0):
+    """imaging.Netwerk of the stop and line files with line colors drawn from
+    the given seed, cached.
+    """
+    return _read_network(_signature(stop_file), _signature(stop_times_file),
+                         _signature(route_file), seed)
+
+# -------------------------------------------------------------------------------------------------
+def draw_voronoi(ax, spec):
+    imaging.teken_voronoi(ax, coordinates(stop_file))
+
+def draw_gp(ax, spec):
+    imaging.teken_punten(ax, coordinates(facility_file, sep=',', decimal='.'))
+
+def draw_buslines(ax, spec):
+    G = imaging.make_graph(network(spec.options.get("seed", 0)))
+    if "color" in spec.options:
+        nx.set_edge_attributes(G, spec.options["color"], "color")
+    imaging.teken_lijnen(ax, G)
+
+
+drawers = {"voronoi": draw_voronoi, "gp": draw_gp, "buslines": draw_buslines}
+
+# -------------------------------------------------------------------------------------------------
+def render_figure(spec, folder=output_folder):
+    """Renders one figure spec, returning the paths of the written files."""
+    if spec.kind not in drawers:
+        raise ValueError("Unknown figure kind: "+str(spec.kind))
+    fig = Figure(figsize=spec.size, dpi=spec.dpi)
+    ax = fig.add_subplot()
+    image, extent, limit = backgrounds[spec.background]
+    if image is not None:
+        imaging.teken_achtergrond(ax, background_image(image), extent, limit)
+    drawers[spec.kind](ax, spec)
+
+    paths = []
+    for extension in spec.formats:
+        path = os.path.join(folder, spec.name+"."+extension)
+        fig.savefig(path)
+        paths.append(path)
+    return paths
+
+def render(specs, folder=output_folder, jobs=default_jobs):
+    """Renders a list of figure specs into a folder, in a pool of jobs worker
+    processes (in this process for a single job). Returns the list of written
+    files per spec.
+    """
+    os.makedirs(folder, exist_ok=True)
+    if jobs <= 1 or len(specs) <= 1:
+        return [render_figure(spec, folder) for spec in specs]
+    chunk = max(1, len(specs)//(4*jobs)) # keep the worker caches warm
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        return list(pool.map(render_figure, specs, [folder]*len(specs),
+                             chunksize=chunk))
+
+def main():
+    parser = argparse.ArgumentParser(description="Renders the maps without "
+                                     "a display.")
+    parser.add_argument("--output", default=output_folder,
+                        help="folder to write the figures to")
+    parser.add_argument("--format", nargs="+", default=list(default_formats),
+                        help="output formats, e.g. png svg")
+    parser.add_argument("--jobs", type=int, default=default_jobs,
+                        help="worker processes")
+    args = parser.parse_args()
+
+    specs = [FigureSpec(s.name, s.kind, s.background, args.format, s.options)
+             for s in default_specs]
+    for paths in render(specs, args.output, args.jobs):
+        print("Wrote "+", ".join(paths))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,648 @@
+import concurrent.futures
+from multiprocessing import shared_memory
+
+import numpy as np
+import geopy.distance as gpd
+from scipy.spatial import cKDTree
+
+import instrument
+import loaders
+
+
+""" Spatial search helpers used by the preprocessing stages.
+
+Coordinates are always (lat, lng) pairs in degrees, in the same order as the
+tuples passed to preprocessing.distance().
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+# Lower bounds on the length (km) of one degree of latitude and of one degree
+# of longitude at the equator on the WGS84 ellipsoid. Scaling coordinates by
+# these (times a safety factor) gives a projection in which taxicab distances
+# never exceed the geodesic taxicab distance, so it can be used as a filter.
+km_per_deg_lat_min = 110.574
+km_per_deg_lng_max = 111.320
+projection_safety = 0.99
+
+# WGS84 ellipsoid
+wgs84_a = 6378.137 # semi-major axis (km)
+wgs84_f = 1/298.257223563 # flattening
+wgs84_b = wgs84_a*(1 - wgs84_f) # semi-minor axis (km)
+wgs84_e2 = wgs84_f*(2 - wgs84_f) # squared eccentricity
+earth_radius = 6371.0088 # mean earth radius (km), used by haversine
+vincenty_tol = 1e-12 # convergence tolerance (rad) for the ellipsoidal kernel
+vincenty_max_iter = 200
+
+default_backend = "kdtree" # neighbour search backend used by add_walking
+default_method = "ellipsoidal" # distance kernel used by the pipeline
+link_chunk = 2000 # points per task of link_parallel
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def lower_bound_projection(coords, lat_max=None):
+    """Projects (lat, lng) coordinates to a planar (x, y) frame in km.
+
+    The scales are chosen such that the taxicab distance between two projected
+    points is a lower bound for the taxicab geodesic distance between them, for
+    any pair of points with an absolute latitude of at most lat_max (by default
+    the largest one in the input).
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) == 0:
+        return np.empty((0, 2))
+    if lat_max is None:
+        lat_max = np.abs(coords[:, 0]).max()
+    x_scale = km_per_deg_lng_max * np.cos(np.radians(lat_max))*projection_safety
+    y_scale = km_per_deg_lat_min * projection_safety
+    return np.column_stack((coords[:, 1] * x_scale, coords[:, 0] * y_scale))
+
+# -------------------------------------------------------------------------------------------------
+def _geopy_kernel(lat1, lng1, lat2, lng2):
+    # Scalar reference, the geopy geodesic used by preprocessing.distance()
+    return np.array([gpd.geodesic((a, b), (c, d)).km for a, b, c, d in
+                     zip(lat1.tolist(), lng1.tolist(), lat2.tolist(),
+                         lng2.tolist())])
+
+def _vincenty_terms(lam, sinU1, cosU1, sinU2, cosU2):
+    # Auxiliary sphere terms of Vincenty's inverse formula for the current
+    # longitude difference on it
+    sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+    sin_sigma = np.hypot(cosU2*sin_lam, cosU1*sinU2 - sinU1*cosU2*cos_lam)
+    cos_sigma = sinU1*sinU2 + cosU1*cosU2*cos_lam
+    sigma = np.arctan2(sin_sigma, cos_sigma)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sin_alpha = np.where(sin_sigma == 0, 0.0,
+                             cosU1*cosU2*sin_lam/sin_sigma)
+        cos2_alpha = 1 - sin_alpha**2
+        cos_2sm = np.where(cos2_alpha == 0, 0.0,
+                           cos_sigma - 2*sinU1*sinU2/cos2_alpha)
+    return sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sm
+
+def _ellipsoidal_kernel(lat1, lng1, lat2, lng2):
+    # Vincenty's inverse formula on the WGS84 ellipsoid, iterated on all
+    # pairs at once. Each pair stops iterating when it has converged, so its
+    # distance does not depend on the other pairs in the batch. Pairs that
+    # fail to converge (nearly antipodal points) fall back to the geopy
+    # reference.
+    U1 = np.arctan((1 - wgs84_f)*np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - wgs84_f)*np.tan(np.radians(lat2)))
+    L = np.radians(lng2 - lng1)
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    todo = np.arange(len(L))
+    for it in range(vincenty_max_iter):
+        sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sm = \
+            _vincenty_terms(lam[todo], sinU1[todo], cosU1[todo], sinU2[todo],
+                            cosU2[todo])
+        C = wgs84_f/16*cos2_alpha*(4 + wgs84_f*(4 - 3*cos2_alpha))
+        lam_new = L[todo] + (1 - C)*wgs84_f*sin_alpha*(sigma + C*sin_sigma*(
+            cos_2sm + C*cos_sigma*(-1 + 2*cos_2sm**2)))
+        moved = np.abs(lam_new - lam[todo]) > vincenty_tol
+        lam[todo] = lam_new
+        todo = todo[moved]
+        if len(todo) == 0:
+            break
+    active = np.zeros(len(L), dtype=bool)
+    active[todo] = True
+    sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sm = \
+        _vincenty_terms(lam, sinU1, cosU1, sinU2, cosU2)
+
+    u2 = cos2_alpha*(wgs84_a**2 - wgs84_b**2)/wgs84_b**2
+    A = 1 + u2/16384*(4096 + u2*(-768 + u2*(320 - 175*u2)))
+    B = u2/1024*(256 + u2*(-128 + u2*(74 - 47*u2)))
+    d_sigma = B*sin_sigma*(cos_2sm + B/4*(cos_sigma*(-1 + 2*cos_2sm**2) -
+                           B/6*cos_2sm*(-3 + 4*sin_sigma**2)*
+                           (-3 + 4*cos_2sm**2)))
+    dist = wgs84_b*A*(sigma - d_sigma)
+    if active.any():
+        dist[active] = _geopy_kernel(lat1[active], lng1[active],
+                                     lat2[active], lng2[active])
+    return dist
+
+def _haversine_kernel(lat1, lng1, lat2, lng2):
+    # Great circle distance on a sphere with the mean earth radius
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    h = (np.sin((phi2 - phi1)/2)**2 +
+         np.cos(phi1)*np.cos(phi2)*np.sin(np.radians(lng2 - lng1)/2)**2)
+    return 2*earth_radius*np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+def _equirectangular_kernel(lat1, lng1, lat2, lng2):
+    # Local projection using the ellipsoid's meridional and prime vertical
+    # radii of curvature at the mean latitude of each pair
+    phi = np.radians((lat1 + lat2)/2)
+    w = 1 - wgs84_e2*np.sin(phi)**2
+    M = wgs84_a*(1 - wgs84_e2)/w**1.5
+    N = wgs84_a/np.sqrt(w)
+    return np.hypot(np.radians(lat2 - lat1)*M,
+                    np.radians(lng2 - lng1)*N*np.cos(phi))
+
+distance_methods = {"geopy": _geopy_kernel,
+                    "ellipsoidal": _ellipsoidal_kernel,
+                    "haversine": _haversine_kernel,
+                    "equirectangular": _equirectangular_kernel}
+
+def distances(origins, destinations, taxicab=False, method=default_method,
+              matrix=True):
+    """Batched version of preprocessing.distance() (km).
+
+    Requires arrays of (lat, lng) origin and destination coordinates. By
+    default returns the len(origins) x len(destinations) distance matrix;
+    with matrix=False the two arrays are paired up elementwise instead.
+
+    Accepts an optional argument indicating whether to use taxicab distance
+    instead of the default Euclidean distance, and the kernel to use. Error
+    bounds are relative to the geopy geodesic ("geopy", the scalar reference
+    used by preprocessing.distance()) and were measured for points within the
+    Netherlands at distances up to 50 km:
+        "ellipsoidal"     Vincenty on WGS84, below 1e-9 km
+        "equirectangular" local ellipsoidal projection, below 2e-6 relative
+                          (below 1e-8 relative up to 5 km)
+        "haversine"       mean earth radius sphere, below 0.35% relative
+    At the walking distances used here (up to a few km) the ellipsoidal and
+    equirectangular walking times in arc_data.txt stay within 1e-7 minutes of
+    the geopy ones, haversine within 0.015 minutes per 0.25 km.
+    """
+    if method not in distance_methods:
+        raise ValueError("Unknown distance method: "+str(method))
+    kernel = distance_methods[method]
+    x = np.asarray(origins, dtype=float).reshape(-1, 2)
+    y = np.asarray(destinations, dtype=float).reshape(-1, 2)
+    if matrix:
+        shape = (len(x), len(y))
+        x = np.repeat(x, len(y), axis=0)
+        y = np.tile(y, (shape[0], 1))
+    else:
+        shape = (len(x),)
+    if len(x) == 0:
+        return np.zeros(shape)
+
+    if taxicab == False:
+        dist = kernel(x[:, 0], x[:, 1], y[:, 0], y[:, 1])
+    else:
+        # Shortest of the two L-shaped paths through the corners (x0, y1)
+        # and (y0, x1), as in preprocessing.distance()
+        dist = np.minimum(kernel(x[:, 0], x[:, 1], x[:, 0], y[:, 1]) +
+                          kernel(x[:, 0], y[:, 1], y[:, 0], y[:, 1]),
+                          kernel(x[:, 0], x[:, 1], y[:, 0], x[:, 1]) +
+                          kernel(y[:, 0], x[:, 1], y[:, 0], y[:, 1]))
+    return dist.reshape(shape)
+
+def pairs_within(origins, destinations, cutoff, taxicab=False,
+                 method=default_method):
+    """Sparse version of distances(), for pairs within a cutoff (km).
+
+    Returns arrays (i, j, dist) of the origin index, destination index and
+    distance of every pair with dist <= cutoff, sorted by (i, j). Candidates
+    are found with a KD-tree over a conservative projection, so that only
+    nearby pairs are passed to the distance kernel.
+    """
+    x = np.asarray(origins, dtype=float).reshape(-1, 2)
+    y = np.asarray(destinations, dtype=float).reshape(-1, 2)
+    if len(x) == 0 or len(y) == 0:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0))
+    xy = lower_bound_projection(np.concatenate((x, y)))
+    found = cKDTree(xy[:len(x)]).sparse_distance_matrix(
+        cKDTree(xy[len(x):]), cutoff, p=1 if taxicab else 2,
+        output_type="ndarray")
+    i = found["i"].astype(np.int64)
+    j = found["j"].astype(np.int64)
+    order = np.lexsort((j, i))
+    i, j = i[order], j[order]
+    dist = distances(x[i], y[j], taxicab=taxicab, method=method, matrix=False)
+    keep = dist <= cutoff
+    return i[keep], j[keep], dist[keep]
+
+# -------------------------------------------------------------------------------------------------
+class RangeCounter:
+    """Static 2-D range counting structure.
+
+    Counts the points inside closed axis-aligned rectangles. Internally this
+    is a merge sort tree over the first coordinate, flattened into a single
+    sorted key array so that batches of queries run as a few numpy
+    searchsorted calls (O(log^2 n) per query).
+    """
+
+    def __init__(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        n = len(points)
+        self.n = n
+
+        # Sort points by the first coordinate, rank them by the second
+        order = np.argsort(points[:, 0], kind="stable")
+        self.xs = points[order, 0]
+        self.ys = np.sort(points[:, 1])
+        yrank = np.searchsorted(self.ys, points[order, 1], side="left")
+
+        # Implicit segment tree over the x-sorted positions, leaves at size+p
+        size = 1
+        while size < max(n, 1):
+            size *= 2
+        self.size = size
+        depth = int(np.log2(size)) + 1
+
+        # Every point is stored once in each of its ancestors, keyed on
+        # (node, yrank) so that all node lists live in one sorted array
+        nodes = (size + np.arange(n))[:, None] >> np.arange(depth)[None, :]
+        keys = nodes * (n + 1) + yrank[:, None]
+        self.keys = np.sort(keys.ravel())
+
+    def count(self, x_min, x_max, y_min, y_max):
+        """Returns the number of points p with x_min <= p[0] <= x_max and
+        y_min <= p[1] <= y_max, for (arrays of) rectangle bounds.
+        """
+        x_min, x_max, y_min, y_max = np.broadcast_arrays(
+            *(np.asarray(a, dtype=float) for a in (x_min, x_max, y_min, y_max)))
+        shape = x_min.shape
+        lo = np.searchsorted(self.xs, x_min.ravel(), side="left") + self.size
+        hi = np.searchsorted(self.xs, x_max.ravel(), side="right") + self.size
+        y_lo = np.searchsorted(self.ys, y_min.ravel(), side="left")
+        y_hi = np.searchsorted(self.ys, y_max.ravel(), side="right")
+
+        total = np.zeros(len(lo), dtype=np.int64)
+        stride = self.n + 1
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            # Left boundary node is a right child: take it and step right
+            take = active & (lo & 1 == 1)
+            total[take] += self._node_count(lo[take], y_lo[take], y_hi[take],
+                                            stride)
+            lo = np.where(take, lo + 1, lo)
+            # Right boundary (exclusive) is a right child: take its sibling
+            take = active & (hi & 1 == 1)
+            hi = np.where(take, hi - 1, hi)
+            total[take] += self._node_count(hi[take], y_lo[take], y_hi[take],
+                                            stride)
+            lo >>= 1
+            hi >>= 1
+        return total.reshape(shape)
+
+    def _node_count(self, nodes, y_lo, y_hi, stride):
+        base = nodes * stride
+        return (np.searchsorted(self.keys, base + y_hi, side="left") -
+                np.searchsorted(self.keys, base + y_lo, side="left"))
+
+# -------------------------------------------------------------------------------------------------
+def brute_pairs(coords, cutoff, method=default_method):
+    """Reference walking pair search, the original O(n^3) double loop.
+
+    Returns a list of (i, j, dist) with j < i for all pairs within the cutoff
+    whose quadrangle contains no other point, in loop order.
+    """
+    pairs = []
+    for i in range(len(coords)):
+        for j in range(i):
+            # Calculate pairwise distance
+            d = distances(coords[i], coords[j], taxicab=True,
+                          method=method)[0, 0]
+            if d <= cutoff:
+                keep = True # whether to keep the current pair
+
+                # Define corners of quadrangle as most extreme lat/lon in pair
+                lat_min = min(coords[i][0], coords[j][0])
+                lat_max = max(coords[i][0], coords[j][0])
+                lon_min = min(coords[i][1], coords[j][1])
+                lon_max = max(coords[i][1], coords[j][1])
+
+                # Scan entire stop list for stops within the quadrangle
+                for k in range(len(coords)):
+                    if (k != i) and (k != j):
+                        if ((lat_min <= coords[k][0] <= lat_max) and
+                            (lon_min <= coords[k][1] <= lon_max)):
+                            # Stop found in quadrangle, making pair invalid
+                            keep = False
+                            break
+
+                if keep == True:
+                    pairs.append((i, j, d))
+    return pairs
+
+def grid_candidates(xy, radius):
+    """Candidate pairs (i, j), i > j, with projected taxicab distance within
+    the radius, found by hashing the points into square cells of that size.
+    """
+    if len(xy) == 0 or radius <= 0:
+        return np.empty((0, 2), dtype=np.int64)
+    cells = np.floor(xy / radius).astype(np.int64)
+    buckets = {}
+    for p, cell in enumerate(map(tuple, cells)):
+        buckets.setdefault(cell, []).append(p)
+    buckets = {c: np.array(b) for c, b in buckets.items()}
+
+    found = []
+    for (cx, cy), members in buckets.items():
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                other = buckets.get((cx + dx, cy + dy))
+                if other is None:
+                    continue
+                i, j = np.meshgrid(members, other, indexing="ij")
+                i, j = i.ravel(), j.ravel()
+                near = ((i > j) &
+                        (np.abs(xy[i] - xy[j]).sum(axis=1) <= radius))
+                found.append(np.column_stack((i[near], j[near])))
+    return np.concatenate(found)
+
+def kdtree_candidates(xy, radius):
+    """Candidate pairs (i, j), i > j, with projected taxicab distance within
+    the radius, found with a KD-tree.
+    """
+    if len(xy) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    found = cKDTree(xy).query_pairs(radius, p=1, output_type="ndarray")
+    return np.sort(found, axis=1)[:, ::-1]
+
+candidate_backends = {"grid": grid_candidates,
+                      "kdtree": kdtree_candidates}
+
+def walking_pairs(coords, cutoff, backend=default_backend,
+                  method=default_method):
+    """Finds all pairs of points that should be linked by walking arcs.
+
+    Shorthand for StopIndex.walking_pairs on an index over the coordinates.
+    """
+    return StopIndex(range(len(coords)), coords, method).walking_pairs(
+        cutoff, backend)
+
+# -------------------------------------------------------------------------------------------------
+class StopIndex:
+    """Spatial index over the stops, for linking stops to each other and to
+    population centers and facilities.
+
+    Requires the stop IDs and (lat, lng) coordinates, and accepts the
+    distances() method to use. Built once, it holds a KD-tree over the
+    projected stops for radius and nearest neighbour queries, and a
+    RangeCounter for the quadrangle test: a stop is obstructed from a point if
+    the quadrangle spanned by the two contains another stop.
+
+    Query results are stop indices (positions in ids), not stop IDs.
+    """
+
+    def __init__(self, ids, coords, method=default_method):
+        self.ids = list(ids)
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.method = method
+        self.lat_max = np.abs(self.coords[:, 0]).max() if len(self.coords) else 0
+        self.xy = lower_bound_projection(self.coords, self.lat_max)
+        self.tree = cKDTree(self.xy)
+        self.counter = RangeCounter(self.coords)
+
+    @classmethod
+    def from_file(cls, stop_file, method=default_method):
+        """Builds the index from a stop file in the busstops.csv format."""
+        df = loaders.load_stops(stop_file)
+        return cls(df['ID'].tolist(), loaders.coords(df), method)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _project(self, points):
+        # Project query points, widening the search radius for points beyond
+        # the latitude range the projection is a lower bound for
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        lat = np.maximum(np.abs(points[:, 0]), self.lat_max)
+        widen = np.cos(np.radians(self.lat_max))/np.cos(np.radians(lat))
+        return lower_bound_projection(points, self.lat_max), widen
+
+    def _unobstructed(self, points, stops, allowed):
+        # Quadrangle test for point/stop pairs: the quadrangle may contain at
+        # most the given number of stops (the pair itself)
+        a, b = points, self.coords[stops]
+        inside = self.counter.count(np.minimum(a[:, 0], b[:, 0]),
+                                    np.maximum(a[:, 0], b[:, 0]),
+                                    np.minimum(a[:, 1], b[:, 1]),
+                                    np.maximum(a[:, 1], b[:, 1]))
+        return inside <= allowed
+
+    def within(self, point, r, obstruct=True):
+        """Returns arrays (stops, dist) of all stops within taxicab distance r
+        (km) of a point, ordered by stop index. Obstructed stops are left out
+        unless obstruct is False.
+        """
+        stops, dist = self.within_many([point], [r], obstruct)[0]
+        return stops, dist
+
+    def within_many(self, points, radii, obstruct=True):
+        """Batched version of within() with one radius per point. Returns a
+        list of (stops, dist) array pairs.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), len(points))
+        found = self._candidates(points, radii)
+        return self._split(len(points), *self._filter(points, found, radii,
+                                                      obstruct))
+
+    def nearest(self, point, k=1):
+        """Returns arrays (stops, dist) of the k stops with the smallest
+        taxicab distance to a point, nearest first.
+        """
+        k = min(k, len(self))
+        point = np.asarray(point, dtype=float).reshape(1, 2)
+        dist = distances(point, self.coords, taxicab=True,
+                         method=self.method)[0]
+        stops = np.argsort(dist, kind="stable")[:k]
+        return stops, dist[stops]
+
+    def link(self, points, cutoff):
+        """Finds the stops to link each point to, guaranteeing at least one.
+
+        Each point is linked to all unobstructed stops within the taxicab
+        cutoff (km). Points without any link are retried with a doubled
+        radius until one is found; only the ring between the previous and the
+        new radius is searched, since everything closer is known to be
+        obstructed. Returns a list of (stops, dist) array pairs per point and
+        the final radius used for each point.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        n = len(points)
+        links = [(np.empty(0, dtype=np.int64), np.empty(0))]*n
+        radii = np.full(n, float(cutoff))
+        if len(self) == 0:
+            return links, radii
+
+        inner = np.full(n, -np.inf)
+        todo = np.arange(n)
+        while len(todo) > 0:
+            found = self._candidates(points[todo], radii[todo])
+            p, stops, dist = self._filter(points[todo], found, radii[todo],
+                                          True, inner[todo])
+            for k, result in enumerate(self._split(len(todo), p, stops, dist)):
+                links[todo[k]] = result
+            done = np.bincount(p, minlength=len(todo)) > 0
+            todo = todo[~done]
+            # Double the radius for the points that are still unlinked
+            inner[todo] = radii[todo]
+            radii[todo] *= 2
+        return links, radii
+
+    def walking_pairs(self, cutoff, backend=default_backend):
+        """Finds all pairs of stops that should be linked by walking arcs.
+
+        A pair is linked if its taxicab distance is within the cutoff (km) and
+        the quadrangle spanned by the pair contains no other stop. The result
+        is a list of (i, j, dist) stop indices with j < i, ordered as the
+        brute-force loop would produce it, for any of the backends:
+            "brute"  the original double loop, kept as a reference
+            "grid"   uniform grid hashing for the cutoff query
+            "kdtree" KD-tree for the cutoff query
+        Both indexed backends use the RangeCounter for the quadrangle test.
+        """
+        if backend == "brute":
+            return brute_pairs([tuple(c) for c in self.coords.tolist()],
+                               cutoff, self.method)
+        if backend == "kdtree":
+            candidates = np.sort(self.tree.query_pairs(
+                cutoff, p=1, output_type="ndarray"), axis=1)[:, ::-1]
+        elif backend in candidate_backends:
+            candidates = candidate_backends[backend](self.xy, cutoff)
+        else:
+            raise ValueError("Unknown neighbour search backend: "+str(backend))
+        if len(candidates) == 0:
+            return []
+
+        # Quadrangle test first, since it is much cheaper than the distances
+        instrument.count("pairs_tested", len(candidates))
+        candidates = candidates[self._unobstructed(
+            self.coords[candidates[:, 0]], candidates[:, 1], 2)]
+        candidates = candidates[np.lexsort((candidates[:, 1],
+                                            candidates[:, 0]))]
+
+        dist = distances(self.coords[candidates[:, 0]],
+                         self.coords[candidates[:, 1]], taxicab=True,
+                         method=self.method, matrix=False)
+        keep = dist <= cutoff
+        instrument.count("pairs_accepted", keep.sum())
+        return [(i, j, d) for (i, j), d in zip(candidates[keep].tolist(),
+                                               dist[keep].tolist())]
+
+    def walking_pairs_near(self, points, cutoff):
+        """Finds the walking pairs (see walking_pairs) among the stops within
+        taxicab distance cutoff (km) of any of the given points.
+
+        These are all the pairs that a stop placed at, or removed from, one
+        of the points can create or obstruct: a stop inside the quadrangle of
+        a pair is within the pair's distance of both ends. Returns the list
+        of (i, j, dist) pairs, with the same distances as walking_pairs, and
+        the array of nearby stop indices.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        found = self.within_many(points, cutoff, obstruct=False)
+        near = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] +
+                                        [stops for stops, dist in found]))
+        if len(near) < 2:
+            return [], near
+
+        found = self.within_many(self.coords[near], cutoff, obstruct=False)
+        i = np.repeat(near, [len(stops) for stops, dist in found])
+        j = np.concatenate([stops for stops, dist in found])
+        dist = np.concatenate([dist for stops, dist in found])
+        keep = (j < i) & np.isin(j, near)
+        i, j, dist = i[keep], j[keep], dist[keep]
+        keep = self._unobstructed(self.coords[i], j, 2)
+        return list(zip(i[keep].tolist(), j[keep].tolist(),
+                        dist[keep].tolist())), near
+
+    def _candidates(self, points, radii):
+        # KD-tree radius query, returns flat (point, stop) index arrays
+        xy, widen = self._project(points)
+        found = self.tree.query_ball_point(xy, radii*widen, p=1)
+        counts = np.array([len(f) for f in found], dtype=np.int64)
+        p = np.repeat(np.arange(len(points)), counts)
+        stops = (np.concatenate([np.asarray(f, dtype=np.int64) for f in found])
+                 if counts.sum() > 0 else np.empty(0, dtype=np.int64))
+        return p, stops
+
+    def _filter(self, points, found, radii, obstruct, inner=None):
+        # Exact distance and quadrangle filter of candidate pairs, keeping
+        # pairs with inner < dist <= radius
+        p, stops = found
+        instrument.count("pairs_tested", len(p))
+        order = np.lexsort((stops, p))
+        p, stops = p[order], stops[order]
+        dist = distances(points[p], self.coords[stops], taxicab=True,
+                         method=self.method, matrix=False)
+        keep = dist <= radii[p]
+        if inner is not None:
+            keep &= dist > inner[p]
+        p, stops, dist = p[keep], stops[keep], dist[keep]
+        if obstruct:
+            keep = self._unobstructed(points[p], stops, 1)
+            p, stops, dist = p[keep], stops[keep], dist[keep]
+        instrument.count("pairs_accepted", len(p))
+        return p, stops, dist
+
+    def _split(self, n, p, stops, dist):
+        # Split flat (point, stop, dist) arrays sorted by point into a list
+        bounds = np.searchsorted(p, np.arange(n + 1))
+        return [(stops[bounds[k]:bounds[k+1]], dist[bounds[k]:bounds[k+1]])
+                for k in range(n)]
+
+# -------------------------------------------------------------------------------------------------
+_worker_memory = None # shared stop coordinates of a link_parallel worker
+_worker_index = None # StopIndex of a link_parallel worker
+
+def _init_link_worker(name, n, method):
+    # Attach to the shared stop coordinates and index them once per worker
+    global _worker_memory, _worker_index
+    _worker_memory = shared_memory.SharedMemory(name=name)
+    coords = np.ndarray((n, 2), dtype=np.float64, buffer=_worker_memory.buf)
+    _worker_index = StopIndex(range(n), coords, method)
+
+def _link_chunk(points, cutoff):
+    # Links one chunk of points, as flat arrays to keep the results small,
+    # with the counters of the chunk for the stage record of the parent
+    with instrument.stage("link_chunk") as record:
+        links, radii = _worker_index.link(points, cutoff)
+    counts = np.array([len(stops) for stops, dist in links], dtype=np.int64)
+    stops = np.concatenate([np.empty(0, dtype=np.int64)] +
+                           [stops for stops, dist in links])
+    dist = np.concatenate([np.empty(0)] + [dist for stops, dist in links])
+    return counts, stops, dist, radii, record.counters
+
+def link_parallel(stop_index, points, cutoff, jobs=1, chunk=link_chunk):
+    """Runs stop_index.link for many points in a pool of jobs worker
+    processes.
+
+    The points are split into chunks of the given size. The stop coordinates
+    are placed in shared memory once, and every worker builds its own index
+    over them when it starts, so only the points and the results are sent
+    between processes. The results are collected in chunk order and are the
+    same as those of a single stop_index.link call.
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    if jobs <= 1 or len(points) <= chunk or len(stop_index) == 0:
+        return stop_index.link(points, cutoff)
+
+    n = len(stop_index)
+    memory = shared_memory.SharedMemory(create=True, size=stop_index.coords.nbytes)
+    try:
+        np.ndarray((n, 2), dtype=np.float64, buffer=memory.buf)[:] = \
+            stop_index.coords
+        with concurrent.futures.ProcessPoolExecutor(
+                jobs, initializer=_init_link_worker,
+                initargs=(memory.name, n, stop_index.method)) as pool:
+            chunks = [points[k:k+chunk] for k in range(0, len(points), chunk)]
+            results = list(instrument.progress(
+                pool.map(_link_chunk, chunks, [cutoff]*len(chunks)),
+                "linking chunks", len(chunks)))
+    finally:
+        memory.close()
+        memory.unlink()
+
+    links = []
+    for counts, stops, dist, radii, counters in results:
+        for name, value in counters.items():
+            instrument.count(name, value)
+        bounds = np.concatenate([[0], np.cumsum(counts)])
+        links.extend((stops[bounds[k]:bounds[k+1]], dist[bounds[k]:bounds[k+1]])
+                     for k in range(len(counts)))
+    return links, np.concatenate([result[3] for result in results])
@@ -0,0 +1,354 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from scipy.spatial import Voronoi
+
+import imaging
+import rendering
+
+
+""" Tile pyramid export of the maps for large networks.
+
+Writes z/x/y PNG tiles (the usual web map scheme, Web Mercator, 256 pixels)
+with transparent overlays of the bus stops, bus lines, the Voronoi cells of
+the stops and the GP locations. The tile range of every zoom level follows
+from the extent of the data. At low zoom levels the content is simplified:
+points closer than a pixel are merged, parallel line edges become one
+straight segment and the stops are left out. Tiles are rendered in a
+process pool. A manifest in the output folder keeps a hash of the content
+of every tile, so a rerun only renders the tiles whose content changed and
+removes the ones that became empty. Run from the repository root:
+    python tiles.py [--zoom 10 16] [--jobs 4] [--output Images/tiles]
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+output_folder = "Images/tiles"
+manifest_file = "tiles.json"
+default_zooms = (10, 16) # first and last zoom level
+default_jobs = rendering.default_jobs
+tile_size = 256 # pixels
+tile_dpi = 100
+tile_margin = 8 # pixels of content around a tile drawn into it
+earth_radius = 6378137.0 # m, Web Mercator sphere
+world_size = 2*np.pi*earth_radius
+
+lod_zoom = 13 # below this zoom line edges are straight and merged
+stop_zoom = 12 # below this zoom stops are not drawn
+curve_points = 16 # samples per curved line edge
+
+# Drawing style per layer
+style = {
+    "voronoi": {"color": "k", "width": 1.0},
+    "lines": {"width": 1.0},
+    "stops": {"color": "k", "size": 10},
+    "gp": {"color": "C0", "size": 36},
+}
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def mercator(lng_lat):
+    """Projects an (n, 2) array of [lng, lat] to Web Mercator meters."""
+    lng_lat = np.asarray(lng_lat, dtype=float)
+    x = np.radians(lng_lat[..., 0])*earth_radius
+    y = np.log(np.tan(np.pi/4 + np.radians(lng_lat[..., 1])/2))*earth_radius
+    return np.stack((x, y), axis=-1)
+
+def pixel_size(z):
+    """Size of a pixel at zoom level z, in Web Mercator meters."""
+    return world_size/(tile_size*2**z)
+
+def tile_bounds(z, x, y):
+    """Returns (x_min, x_max, y_min, y_max) of tile z/x/y in meters."""
+    size = world_size/2**z
+    x_min = -world_size/2 + x*size
+    y_max = world_size/2 - y*size
+    return (x_min, x_min + size, y_max - size, y_max)
+
+def tile_index(points, z):
+    """Returns the tile x and y numbers containing Web Mercator points."""
+    size = world_size/2**z
+    points = np.asarray(points, dtype=float)
+    tx = np.floor((points[..., 0] + world_size/2)/size).astype(np.int64)
+    ty = np.floor((world_size/2 - points[..., 1])/size).astype(np.int64)
+    return np.clip(tx, 0, 2**z - 1), np.clip(ty, 0, 2**z - 1)
+
+# -------------------------------------------------------------------------------------------------
+def _voronoi_segments(points):
+    # Finite and infinite ridges of the Voronoi diagram of the points, as
+    # scipy's voronoi_plot_2d draws them
+    vor = Voronoi(points)
+    center = points.mean(axis=0)
+    ptp_bound = np.ptp(points, axis=0)
+    reach = ptp_bound.max()*abs(ptp_bound.max()/ptp_bound.min())
+    finite = []
+    infinite = []
+    for pointidx, simplex in zip(vor.ridge_points, vor.ridge_vertices):
+        simplex = np.asarray(simplex)
+        if np.all(simplex >= 0):
+            finite.append(vor.vertices[simplex])
+            continue
+        i = simplex[simplex >= 0][0]
+        t = points[pointidx[1]] - points[pointidx[0]]
+        t /= np.linalg.norm(t)
+        n = np.array([-t[1], t[0]])
+        midpoint = points[pointidx].mean(axis=0)
+        direction = np.sign(np.dot(midpoint - center, n))*n
+        infinite.append([vor.vertices[i], vor.vertices[i] + direction*reach])
+    return (np.array(finite).reshape(-1, 2, 2),
+            np.array(infinite).reshape(-1, 2, 2))
+
+def layers(seed=0):
+    """Reads the stops, lines and GP locations (through the rendering caches)
+    and returns the map layers in Web Mercator meters:
+        stops, gp: (n, 2) points
+        voronoi: (n, 2, 2) segments, with a boolean array of the infinite ones
+        lines: begin and end points, keys and RGBA colors of the line edges
+    """
+    stops = mercator(rendering.coordinates(rendering.stop_file))
+    gp = mercator(rendering.coordinates(rendering.facility_file, sep=',',
+                                        decimal='.'))
+    finite, infinite = _voronoi_segments(stops)
+
+    G = imaging.make_graph(rendering.network(seed))
+    edges = list(G.edges(keys=True, data='color'))
+    begin = mercator([u.plek for u, v, key, color in edges]).reshape(-1, 2)
+    end = mercator([v.plek for u, v, key, color in edges]).reshape(-1, 2)
+    keys = np.array([key for u, v, key, color in edges], dtype=np.int64)
+    colors = matplotlib.colors.to_rgba_array(
+        [color for u, v, key, color in edges]).reshape(-1, 4)
+
+    return {"stops": stops, "gp": gp,
+            "voronoi": np.concatenate((finite, infinite)),
+            "voronoi_infinite": np.arange(len(finite) + len(infinite)) >= len(finite),
+            "line_begin": begin, "line_end": end, "line_key": keys,
+            "line_color": colors}
+
+def extent(data):
+    """Returns (x_min, x_max, y_min, y_max) of the stops, lines and GP
+    locations, in meters.
+    """
+    points = np.concatenate((data["stops"], data["gp"], data["line_begin"],
+                             data["line_end"]))
+    return (points[:, 0].min(), points[:, 0].max(), points[:, 1].min(),
+            points[:, 1].max())
+
+# -------------------------------------------------------------------------------------------------
+def _thin(points, z):
+    # Merges points that fall in the same pixel at zoom z, keeping the first
+    if len(points) == 0:
+        return np.arange(0)
+    cells = np.floor(points/pixel_size(z)).astype(np.int64)
+    first = np.unique(cells, axis=0, return_index=True)[1]
+    return np.sort(first)
+
+def level_of_detail(data, z):
+    """Returns the layers as drawn at zoom level z, with the line edges as
+    polylines: (n, k, 2) points and (n, 4) colors.
+    """
+    out = {"voronoi": data["voronoi"],
+           "voronoi_infinite": data["voronoi_infinite"]}
+    gp = data["gp"][_thin(data["gp"], z)]
+    out["gp"] = gp
+    if z >= stop_zoom:
+        out["stops"] = data["stops"][_thin(data["stops"], z)]
+    else:
+        out["stops"] = np.zeros((0, 2))
+
+    begin, end = data["line_begin"], data["line_end"]
+    colors = data["line_color"]
+    if z >= lod_zoom:
+        lines = imaging.boog_punten(begin, end, 0.2*(data["line_key"] + 1),
+                                    1.0, curve_points)
+    else:
+        # One straight segment per pair of stops, snapped to pixels
+        cells = np.floor(np.concatenate((begin, end), axis=1) /
+                         pixel_size(z)).astype(np.int64)
+        swap = (cells[:, 0] > cells[:, 2]) | ((cells[:, 0] == cells[:, 2]) &
+                                             (cells[:, 1] > cells[:, 3]))
+        pair = np.where(swap[:, None], cells[:, [2, 3, 0, 1]], cells)
+        moving = (cells[:, :2] != cells[:, 2:]).any(axis=1)
+        first = np.unique(pair[moving], axis=0, return_index=True)[1]
+        keep = np.sort(np.flatnonzero(moving)[first])
+        lines = np.stack((begin[keep], end[keep]), axis=1)
+        colors = colors[keep]
+    out["lines"] = lines.reshape(-1, lines.shape[1] if len(lines) else 2, 2)
+    out["line_color"] = colors
+    return out
+
+def _bin(low, high, z, ranges):
+    # Pairs (element, tile) of elements with bounding boxes [low, high]
+    # (n, 2) against the tiles they touch, within the given tile ranges
+    x0, y1 = tile_index(low, z)
+    x1, y0 = tile_index(high, z)
+    x0 = np.maximum(x0, ranges[0]); x1 = np.minimum(x1, ranges[1])
+    y0 = np.maximum(y0, ranges[2]); y1 = np.minimum(y1, ranges[3])
+    width = np.maximum(x1 - x0 + 1, 0)
+    count = width*np.maximum(y1 - y0 + 1, 0)
+    element = np.repeat(np.arange(len(count)), count)
+    offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    tx = x0[element] + offset % np.maximum(width[element], 1)
+    ty = y0[element] + offset // np.maximum(width[element], 1)
+    return element, tx, ty
+
+def tile_contents(data, z, ranges):
+    """Returns {(x, y): content} for all non-empty tiles at zoom z within the
+    tile ranges (x_min, x_max, y_min, y_max). A content holds the parts of
+    each layer touching the tile (plus a margin of tile_margin pixels).
+    """
+    lod = level_of_detail(data, z)
+    margin = tile_margin*pixel_size(z)
+    shapes = {"stops": lod["stops"][:, None, :], "gp": lod["gp"][:, None, :],
+              "voronoi": lod["voronoi"], "lines": lod["lines"]}
+    per_layer = {}
+    for name, shape in shapes.items():
+        if len(shape) == 0:
+            continue
+        element, tx, ty = _bin(shape.min(axis=1) - margin,
+                               shape.max(axis=1) + margin, z, ranges)
+        order = np.lexsort((element, ty, tx))
+        element, tx, ty = element[order], tx[order], ty[order]
+        starts = np.flatnonzero(np.r_[True, (tx[1:] != tx[:-1]) |
+                                      (ty[1:] != ty[:-1])])
+        for group in np.split(np.arange(len(element)), starts[1:]):
+            if len(group) > 0:
+                tile = (int(tx[group[0]]), int(ty[group[0]]))
+                per_layer.setdefault(tile, {})[name] = element[group]
+
+    contents = {}
+    for tile, parts in per_layer.items():
+        content = {}
+        for name in ("stops", "gp"):
+            content[name] = lod[name][parts.get(name, np.arange(0))]
+        index = parts.get("voronoi", np.arange(0))
+        content["voronoi"] = lod["voronoi"][index]
+        content["voronoi_infinite"] = lod["voronoi_infinite"][index]
+        index = parts.get("lines", np.arange(0))
+        content["lines"] = lod["lines"][index]
+        content["line_color"] = lod["line_color"][index]
+        contents[tile] = content
+    return contents
+
+def content_hash(z, content):
+    """Hash of everything drawn on a tile."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([z, tile_size, tile_dpi, style],
+                             sort_keys=True).encode())
+    for name in sorted(content):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(content[name]).tobytes())
+    return digest.hexdigest()
+
+# -------------------------------------------------------------------------------------------------
+def render_tile(job):
+    """Renders one tile, given (path, bounds, content). Returns the path."""
+    path, bounds, content = job
+    fig = Figure(figsize=(tile_size/tile_dpi, tile_size/tile_dpi),
+                 dpi=tile_dpi)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(bounds[0], bounds[1])
+    ax.set_ylim(bounds[2], bounds[3])
+
+    if len(content["voronoi"]) > 0:
+        ax.add_collection(LineCollection(
+            content["voronoi"], colors=style["voronoi"]["color"],
+            linewidths=style["voronoi"]["width"],
+            linestyles=["dashed" if i else "solid"
+                        for i in content["voronoi_infinite"]]))
+    if len(content["lines"]) > 0:
+        ax.add_collection(LineCollection(
+            content["lines"], colors=content["line_color"],
+            linewidths=style["lines"]["width"]))
+    for name in ("stops", "gp"):
+        if len(content[name]) > 0:
+            ax.scatter(content[name][:, 0], content[name][:, 1],
+                       s=style[name]["size"], c=style[name]["color"])
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fig.savefig(path, transparent=True)
+    return path
+
+def export(folder=output_folder, zooms=default_zooms, jobs=default_jobs,
+           force=False, seed=0):
+    """Exports the tile pyramid for zoom levels zooms[0] up to zooms[1] into
+    folder/z/x/y.png, rendering only new and changed tiles unless force is
+    set. Returns the numbers of tiles rendered, unchanged and removed.
+    """
+    data = layers(seed)
+    x_min, x_max, y_min, y_max = extent(data)
+    manifest_path = os.path.join(folder, manifest_file)
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    new_manifest = {}
+    todo = []
+    for z in range(zooms[0], zooms[1] + 1):
+        margin = tile_margin*pixel_size(z)
+        tx, ty = tile_index(np.array([[x_min - margin, y_max + margin],
+                                      [x_max + margin, y_min - margin]]), z)
+        ranges = (tx[0], tx[1], ty[0], ty[1])
+        for (x, y), content in sorted(tile_contents(data, z, ranges).items()):
+            name = str(z)+"/"+str(x)+"/"+str(y)
+            key = content_hash(z, content)
+            new_manifest[name] = key
+            path = os.path.join(folder, name+".png")
+            if manifest.get(name) != key or not os.path.exists(path):
+                todo.append((path, tile_bounds(z, x, y), content))
+
+    # Tiles that are no longer drawn
+    removed = [n for n in manifest if n not in new_manifest]
+    for name in removed:
+        path = os.path.join(folder, name+".png")
+        if os.path.exists(path):
+            os.remove(path)
+
+    if jobs <= 1 or len(todo) <= 1:
+        for job in todo:
+            render_tile(job)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            list(pool.map(render_tile, todo,
+                          chunksize=max(1, len(todo)//(4*jobs))))
+
+    os.makedirs(folder, exist_ok=True)
+    with open(manifest_path+".tmp", 'w') as f:
+        json.dump(new_manifest, f, indent=0, sort_keys=True)
+    os.replace(manifest_path+".tmp", manifest_path)
+    return len(todo), len(new_manifest) - len(todo), len(removed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the maps as a "
+                                     "z/x/y tile pyramid.")
+    parser.add_argument("--output", default=output_folder,
+                        help="folder to write the tiles to")
+    parser.add_argument("--zoom", nargs=2, type=int, default=default_zooms,
+                        metavar=("FIRST", "LAST"), help="zoom levels")
+    parser.add_argument("--jobs", type=int, default=default_jobs,
+                        help="worker processes")
+    parser.add_argument("--force", action="store_true",
+                        help="render all tiles, also unchanged ones")
+    args = parser.parse_args()
+
+    rendered, unchanged, removed = export(args.output, args.zoom, args.jobs,
+                                          args.force)
+    print("Rendered "+str(rendered)+" tiles, "+str(unchanged)+" unchanged, "+
+          str(removed)+" removed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import argparse
+import concurrent.futures
+import time
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+import accessibility
+import instrument
+import preprocessing as pp
+
+
+""" All-pairs stop to stop travel times over the final network.
+
+all_times runs batched Dijkstra searches over the CSR search graph of the
+assembled network (see accessibility.Network), from chunks of stop nodes at a
+time, optionally in a pool of worker processes, and writes the stop x stop
+matrix of shortest in-vehicle plus walking times (minutes, inf if
+unreachable) to a memory-mapped float32 file. When the network is built on
+stop clusters (see preprocessing.cluster_boarding) the stops are the
+clusters. Waiting times are not included, as in accessibility.py.
+
+The file starts with a header of header_size bytes: the magic string, the
+number of stops and the byte offset of the matrix as little-endian uint64,
+followed by the stop node IDs (int64) and, at the offset, the matrix in row
+order. TimeMatrix reads rows and blocks from it without loading the rest, so
+a 20k stop matrix (1.6 GB) can be used on a small machine. Run from the
+repository root:
+    python timematrix.py [--jobs 4]
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+all_times_file = "Intermediate/all_times.bin"
+magic = b"ALLTIME1"
+header_size = 64 # bytes before the stop IDs
+alignment = 4096 # the matrix starts at a multiple of this offset
+chunk_bytes = 1 << 28 # memory per chunk of Dijkstra results (float64)
+default_jobs = 1
+
+_worker_graph = None # search graph of an all_times worker
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def write_header(path, ids):
+    """Creates a matrix file for the given stop node IDs, and returns the
+    offset of the matrix.
+    """
+    ids = np.asarray(ids, dtype='<i8')
+    offset = -(-(header_size + ids.nbytes) // alignment)*alignment
+    with open(path, 'wb') as f:
+        f.write(magic + np.array([len(ids), offset], dtype='<u8').tobytes())
+        f.write(b"\0"*(header_size - f.tell()))
+        f.write(ids.tobytes())
+        f.truncate(offset + 4*len(ids)**2)
+    return offset
+
+def read_header(path):
+    """Returns the stop node IDs and the matrix offset of a matrix file."""
+    with open(path, 'rb') as f:
+        head = f.read(header_size)
+        if head[:len(magic)] != magic:
+            raise ValueError(str(path)+" is not a travel time matrix file")
+        n, offset = np.frombuffer(head, dtype='<u8', count=2, offset=len(magic))
+        ids = np.fromfile(f, dtype='<i8', count=int(n))
+    return ids, int(offset)
+
+def _init_worker(node_file, arc_file):
+    # Build the search graph once per worker
+    global _worker_graph
+    _worker_graph = accessibility.Network(node_file, arc_file).graph()
+
+def _solve_chunk(path, offset, sources, columns, start):
+    # Shortest paths from a chunk of stops, written into the matrix rows
+    times = dijkstra(_worker_graph, directed=True, indices=sources)
+    matrix = np.memmap(path, dtype='<f4', mode='r+', offset=offset,
+                       shape=(len(columns), len(columns)))
+    matrix[start:start+len(sources)] = times[:, columns]
+    matrix.flush()
+    del matrix
+
+def all_times(node_file=pp.final_node_data, arc_file=pp.final_arc_data,
+              output_file=all_times_file, jobs=default_jobs, chunk=None):
+    """Computes the stop x stop travel time matrix of the final network.
+
+    Requires the node and arc files (or columnar stores) and the output file
+    name. Accepts the number of worker processes and the number of source
+    stops per Dijkstra batch; by default a batch holds chunk_bytes of
+    results. Stop order is node ID order. Returns the stop node IDs.
+    """
+    network = accessibility.Network(node_file, arc_file)
+    stops = np.flatnonzero(network.node_types == pp.nid_stop)
+    ids = network.node_ids[stops]
+    offset = write_header(output_file, ids)
+    if chunk is None:
+        chunk = max(1, chunk_bytes//(8*max(network.n, 1)))
+    starts = range(0, len(stops), chunk)
+
+    tasks = [(output_file, offset, stops[k:k+chunk], stops, k) for k in starts]
+    if jobs <= 1 or len(tasks) <= 1:
+        global _worker_graph
+        _worker_graph = network.graph()
+        for task in instrument.progress(tasks, "all_times chunks"):
+            _solve_chunk(*task)
+        _worker_graph = None
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                jobs, initializer=_init_worker,
+                initargs=(node_file, arc_file)) as pool:
+            list(instrument.progress(pool.map(_solve_chunk, *zip(*tasks)),
+                                     "all_times chunks", len(tasks)))
+    instrument.rows(network.n + len(network.tail), len(stops)**2)
+    print("Wrote the travel times between "+str(len(stops))+" stops.")
+    return ids
+
+# -------------------------------------------------------------------------------------------------
+class TimeMatrix:
+    """Read access to a travel time matrix file.
+
+    The matrix is memory-mapped, so rows and blocks are read from disk as
+    they are used. Stops are addressed by node ID.
+    """
+
+    def __init__(self, path=all_times_file):
+        self.ids, offset = read_header(path)
+        self.position = {i: k for k, i in enumerate(self.ids.tolist())}
+        self.times = np.memmap(path, dtype='<f4', mode='r', offset=offset,
+                               shape=(len(self.ids), len(self.ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, ids):
+        """Matrix positions of stop node IDs."""
+        return np.array([self.position[i] for i in np.atleast_1d(ids).tolist()],
+                        dtype=np.int64)
+
+    def row(self, stop):
+        """Travel times from one stop to all stops."""
+        return np.asarray(self.times[self.position[stop]])
+
+    def block(self, origins, destinations):
+        """Travel times from the origin stops to the destination stops."""
+        rows = self.times[self.index(origins)]
+        return np.asarray(rows[:, self.index(destinations)])
+
+    def time(self, origin, destination):
+        """Travel time between two stops."""
+        return float(self.times[self.position[origin], self.position[destination]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Computes the stop to stop "
+                                     "travel time matrix.")
+    parser.add_argument("--nodes", default=pp.final_node_data)
+    parser.add_argument("--arcs", default=pp.final_arc_data)
+    parser.add_argument("--output", default=all_times_file)
+    parser.add_argument("--jobs", type=int, default=default_jobs)
+    parser.add_argument("--chunk", type=int, default=None,
+                        help="source stops per Dijkstra batch")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    ids = all_times(args.nodes, args.arcs, args.output, args.jobs, args.chunk)
+    print(f"{len(ids)} x {len(ids)} matrix in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
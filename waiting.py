@@ -0,0 +1,148 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import accessibility
+import preprocessing as pp
+
+
+""" Frequency dependent waiting costs for the accessibility evaluator.
+
+The boarding arcs of the network files cost nothing; the waiting time at a
+stop depends on the frequency of the line, which follows from its fleet size
+and circuit time in the transit data file (Frequency = Fleet / Circuit). A
+WaitingModel gives every boarding arc of line l the expected waiting time
+wait_factor / f_l (half the headway for regular service). Changing the fleet
+of one line only rewrites the costs of that line's boarding arcs in the
+search graph, so many fleet allocations can be evaluated in a row. Run from
+the repository root to time a sweep of random allocations:
+    python waiting.py [--allocations 1000]
+"""
+
+#==============================================================================
+# Parameters
+#==============================================================================
+
+wait_factor = 0.5 # expected waiting time as a fraction of the headway
+
+#==============================================================================
+# Functions
+#==============================================================================
+
+def read_transit(transit_file=pp.final_transit_data):
+    """Reads the transit data file written by transit_finalization."""
+    df = pd.read_csv(transit_file, sep='\t')
+    if not pd.api.types.is_integer_dtype(df['ID']):
+        raise ValueError(str(transit_file)+" has no line IDs, rerun "
+                         "transit_finalization")
+    return df
+
+def waiting_times(fleets, circuits, factor=wait_factor):
+    """Expected waiting times of lines with the given fleets and circuit
+    times; inf for lines without vehicles.
+    """
+    frequencies = np.asarray(fleets, dtype=np.float64)/np.asarray(circuits)
+    with np.errstate(divide='ignore'):
+        return factor/frequencies
+
+
+class WaitingModel:
+    """Boarding costs of a network for the current fleet of every line, and
+    the search graph with those costs.
+
+    Requires an accessibility.Network and accepts the transit data file and
+    the waiting time factor.
+    """
+
+    def __init__(self, network, transit_file=pp.final_transit_data,
+                 factor=wait_factor):
+        self.network = network
+        self.factor = factor
+        transit = read_transit(transit_file)
+        self.line_ids = transit['ID'].to_numpy()
+        self.line_index = {l: i for i, l in enumerate(self.line_ids.tolist())}
+        self.fleets = transit['Fleet'].to_numpy(dtype=np.float64)
+        self.circuits = transit['Circuit'].to_numpy(dtype=np.float64)
+
+        # Boarding arcs per line, as positions in the search graph data
+        board = np.flatnonzero(network.arc_types == pp.aid_board)
+        lines = np.array([self.line_index.get(l, -1) for l in
+                          network.arc_lines[board].tolist()], dtype=np.int64)
+        if (lines < 0).any():
+            raise ValueError("Boarding arcs of lines missing from "+
+                             str(transit_file))
+        self.costs = network.times.copy()
+        self.costs[board] += waiting_times(self.fleets, self.circuits,
+                                           factor)[lines]
+        self.graph, position = network.graph(self.costs, positions=True)
+
+        order = np.argsort(lines, kind='stable')
+        starts = np.searchsorted(lines[order], np.arange(len(self.line_ids)+1))
+        self.board_arcs = [board[order[starts[i]:starts[i+1]]]
+                           for i in range(len(self.line_ids))]
+        self.board_positions = [position[a] for a in self.board_arcs]
+
+    def set_fleet(self, line, fleet):
+        """Changes the fleet of one line (by line ID), updating only the costs
+        of its boarding arcs.
+        """
+        i = self.line_index[line]
+        self.fleets[i] = fleet
+        arcs = self.board_arcs[i]
+        cost = self.network.times[arcs] + waiting_times(
+            [fleet], [self.circuits[i]], self.factor)[0]
+        self.costs[arcs] = cost
+        positions = self.board_positions[i]
+        kept = positions >= 0
+        self.graph.data[positions[kept]] = cost[kept]
+
+    def set_fleets(self, fleets):
+        """Changes the fleets of several lines, given as {line ID: fleet}.
+        Only the lines whose fleet differs are updated.
+        """
+        for line, fleet in fleets.items():
+            if self.fleets[self.line_index[line]] != fleet:
+                self.set_fleet(line, fleet)
+
+    def evaluate(self, parameters=pp.obj_parameters):
+        """Evaluates the network with the current boarding costs (see
+        accessibility.evaluate).
+        """
+        return accessibility.evaluate(self.network, parameters=parameters,
+                                      graph=self.graph)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluates random fleet "
+                                     "allocations with waiting costs.")
+    parser.add_argument("--allocations", type=int, default=1000)
+    parser.add_argument("--nodes", default=pp.final_node_data)
+    parser.add_argument("--arcs", default=pp.final_arc_data)
+    parser.add_argument("--transit", default=pp.final_transit_data)
+    args = parser.parse_args()
+
+    model = WaitingModel(accessibility.Network(args.nodes, args.arcs),
+                         args.transit)
+    base = model.evaluate()[2]
+    print("Objective with the current fleets: "+str(base))
+
+    # Move one vehicle between two random lines at a time
+    rng = np.random.default_rng(0)
+    best = base
+    start = time.perf_counter()
+    for k in range(args.allocations):
+        a, b = rng.choice(len(model.line_ids), size=2, replace=False)
+        if model.fleets[a] <= 1:
+            continue
+        model.set_fleet(model.line_ids[a], model.fleets[a] - 1)
+        model.set_fleet(model.line_ids[b], model.fleets[b] + 1)
+        best = max(best, model.evaluate()[2])
+    seconds = time.perf_counter() - start
+    print("Best objective: "+str(best))
+    print(f"{args.allocations/seconds*60:.0f} allocations per minute")
+
+
+if __name__ == "__main__":
+    main()